@@ -0,0 +1,16 @@
+import time
+
+from testcase_template import BasicTestcase
+
+
+class SleepCase(BasicTestcase):
+    """
+    a case of a given length for the scheduler benchmark
+    """
+
+    def __init__(self, sn="", seconds=0.1):
+        super().__init__(sn)
+        self.seconds = seconds
+
+    def test_step(self):
+        time.sleep(self.seconds)
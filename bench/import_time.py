@@ -0,0 +1,99 @@
+"""
+import time gate of the command line entry points, measured by python -X importtime in fresh interpreters.
+fails (exit code 1) when a module imports slower than its budget or loads a heavy dependency eagerly.
+the fixed budgets are about twice the time on a developer machine, for slow ci hosts; -o saves the times
+of this machine and --baseline gates on them with a relative threshold instead
+
+usage: python -m bench.import_time [-m run lib.api] [--budget 100] [-r 5] [-o import_base.json]
+       python -m bench.import_time --baseline import_base.json [--threshold 0.2]
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+from lib.settings import Setting
+
+# cumulative import time budget in milliseconds, measured 56/52/48/26/48 ms
+BUDGET_MS = {
+    "run": 110,
+    "lib.api": 100,
+    "testcase_template": 95,
+    "lib.misc_tools": 55,
+    "lib.uart": 100,
+}
+# ms allowed above a baseline besides the threshold, the noise of a fresh interpreter
+BASELINE_SLACK_MS = 5
+# only imported when really used
+LAZY_MODULES = ("PIL", "serial", "colorlog", "asyncio", "sqlite3", "hashlib", "uuid")
+
+
+def import_time(module, repeat=5):
+    """
+    cumulative import time of module
+    Args:
+        module: dotted module name
+        repeat: fresh interpreters, the fastest one is taken
+
+    Returns: milliseconds, set of the top level packages loaded by the import
+
+    """
+    best = None
+    loaded = set()
+    for _ in range(repeat):
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                              cwd=Setting.PROJECT_ROOT, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{proc.stderr}")
+        for line in proc.stderr.splitlines():
+            # import time: self [us] | cumulative | imported package
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line.split("|")
+            name = name.strip()
+            loaded.add(name.split(".")[0])
+            if name == module:
+                cost = int(cumulative) / 1000
+                best = cost if best is None else min(best, cost)
+    return best, loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("import time gate")
+    parser.add_argument("-m", dest="modules", nargs="+", default=list(BUDGET_MS), help="modules to import")
+    parser.add_argument("--budget", type=float, default=None, help="budget in ms for every module")
+    parser.add_argument("-r", dest="repeat", type=int, default=5, help="fresh interpreters per module")
+    parser.add_argument("-o", dest="output", help="save the times as json baseline")
+    parser.add_argument("--baseline", help="json baseline of this machine, budgets are baseline * (1 + threshold)")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative regression over the baseline")
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    failed = False
+    costs = {}
+    for module in args.modules:
+        cost, loaded = import_time(module, args.repeat)
+        costs[module] = cost
+        if args.budget:
+            budget = args.budget
+        elif module in baseline:
+            budget = baseline[module] * (1 + args.threshold) + BASELINE_SLACK_MS
+        else:
+            budget = BUDGET_MS.get(module, 100)
+        eager = sorted(loaded & set(LAZY_MODULES))
+        ok = cost <= budget and not eager
+        failed |= not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {module:<20} {cost:8.1f} ms / budget {budget:.0f} ms"
+              f"{f', eager imports: {eager}' if eager else ''}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(costs, f, indent=2)
+        print(f"saved to {args.output}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
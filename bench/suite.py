@@ -0,0 +1,394 @@
+"""
+benchmarks of the hot paths, everything runs offline: fake adb, pty pairs instead of uarts, temp log/result dirs.
+
+usage:
+    python -m bench.suite run [-k cmder adb_shell] [--scale 2] [-o bench/baseline.json]
+    python -m bench.suite compare bench/baseline.json [new.json] [--threshold 0.2]
+compare runs the suite when new.json is not given, and returns 1 if any metric regressed beyond the threshold
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+from lib.settings import Setting
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    """
+    register a benchmark, func(scale) returns a list of (metric, value, unit, better) where better is higher/lower
+    """
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def best_of(func, repeat=3):
+    """
+    fastest wall time of func in seconds
+    """
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        cost = time.perf_counter() - t0
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+@benchmark
+def cmder(scale):
+    from lib.basic_test_tools import BasicTestTools
+
+    times = 50 * scale
+    cost = best_of(lambda: [BasicTestTools.cmder("true") for _ in range(times)])
+    return [("cmder_spawn", cost / times * 1000, "ms", "lower")]
+
+
+@benchmark
+def adb_shell(scale):
+    from lib.basic_test_tools import BasicTestTools
+    from lib.fake_adb import FAKE_ADB
+
+    adb, Setting.ADB = Setting.ADB, FAKE_ADB
+    try:
+        results = []
+        for use_session, times in ((False, 10 * scale), (True, 200 * scale)):
+            tools = BasicTestTools(use_session=use_session)
+            tools.adb_shell("true", verbosity=0)
+            cost = best_of(lambda: [tools.adb_shell("echo hello", verbosity=0) for _ in range(times)])
+            results.append((f"adb_shell_{'session' if use_session else 'process'}", cost / times * 1000, "ms",
+                            "lower"))
+        return results
+    finally:
+        Setting.ADB = adb
+
+
+@benchmark
+def serial_capture(scale):
+    import pty
+
+    from lib.uart import Serial
+
+    total = 32 * 1024 * 1024 * scale
+    block = b"x" * 4096
+    results = []
+    for name, func_opt in (("direct", 0), ("buffered", 1)):
+        # pty pair stands in for a uart, the feeder writes the master side
+        master, slave = pty.openpty()
+        uart = Serial(True)
+        uart.open_serial(os.ttyname(slave), baudrate=3000000, timeout=0.05)
+        capture_file = Setting.LOG_PATH.joinpath(f"uart_{name}.log")
+        t0, c0 = time.perf_counter(), time.process_time()
+        uart.start_uart_thread(str(capture_file), func_opt)
+        for _ in range(total // len(block)):
+            os.write(master, block)
+        # the data is read when the capture file has it all or the port has nothing left
+        while uart.ser.in_waiting or (uart.ring is not None and len(uart.ring)):
+            time.sleep(0.01)
+        uart.stop_uart_thread()
+        cost, cpu = time.perf_counter() - t0, time.process_time() - c0
+        uart.close_serial()
+        os.close(master)
+        os.close(slave)
+        results.append((f"serial_{name}_throughput", total / cost / 1024 / 1024, "MB/s", "higher"))
+        results.append((f"serial_{name}_cpu", cpu / (total / 1024 / 1024) * 1000, "ms/MB", "lower"))
+    return results
+
+
+# child process writing total bytes to every pty master given by fd, never blocked by one slow port
+PTY_FEEDER = """
+import os, select, sys
+total, fds = int(sys.argv[1]), [int(fd) for fd in sys.argv[2:]]
+left = dict.fromkeys(fds, total)
+block = b"x" * 4096
+for fd in fds:
+    os.set_blocking(fd, False)
+while left:
+    _, writable, _ = select.select([], list(left), [], 1.0)
+    for fd in writable:
+        try:
+            n = os.write(fd, block[:left[fd]])
+        except BlockingIOError:
+            continue
+        left[fd] -= n
+        if not left[fd]:
+            del left[fd]
+"""
+
+
+@benchmark
+def uart_mux(scale):
+    import pty
+
+    from lib.uart import Serial
+    from lib.uart_mux import UartMux
+
+    ports = 16
+    total = 4 * 1024 * 1024 * scale
+    results = []
+    for model in ("threads", "mux"):
+        pairs = [pty.openpty() for _ in range(ports)]
+        uarts = []
+        for i, (_, slave) in enumerate(pairs):
+            uart = Serial(True)
+            uart.open_serial(os.ttyname(slave), baudrate=3000000, timeout=0.05)
+            uarts.append(uart)
+        mux = UartMux() if model == "mux" else None
+        t0, c0 = time.perf_counter(), time.process_time()
+        for i, uart in enumerate(uarts):
+            capture_file = str(Setting.LOG_PATH.joinpath(f"uart_{model}_{i}.log"))
+            mux.add(uart, capture_file, name=str(i)) if mux else uart.start_uart_thread(capture_file, 0)
+        if mux:
+            mux.start()
+        masters = [master for master, _ in pairs]
+        feeder = subprocess.Popen([sys.executable, "-c", PTY_FEEDER, str(total)] + [str(fd) for fd in masters],
+                                  pass_fds=masters)
+        if feeder.wait():
+            raise RuntimeError(f"pty feeder exit {feeder.returncode}")
+        if mux:
+            while sum(port["bytes"] for port in mux.stats().values()) < total * ports:
+                time.sleep(0.005)
+        else:
+            while any(uart.ser.in_waiting for uart in uarts):
+                time.sleep(0.005)
+        cost, cpu = time.perf_counter() - t0, time.process_time() - c0
+        if mux:
+            mux.close()
+        for uart in uarts:
+            if not mux:
+                uart.stop_uart_thread()
+            uart.close_serial()
+        for master, slave in pairs:
+            os.close(master)
+            os.close(slave)
+        results.append((f"uart_{model}_{ports}_ports_throughput", total * ports / cost / 1024 / 1024, "MB/s",
+                        "higher"))
+        results.append((f"uart_{model}_{ports}_ports_cpu", cpu / (total * ports / 1024 / 1024) * 1000, "ms/MB",
+                        "lower"))
+    return results
+
+
+@benchmark
+def log_records(scale):
+    from lib.log_tools import ColorLogTool
+
+    tool = ColorLogTool("bench.log")
+    tool.replace_handler(tool.console_handler, None)
+    records = 5000 * scale
+    results = []
+    for async_mode in (False, True):
+        tool.enable_async() if async_mode else tool.disable_async()
+        t0 = time.perf_counter()
+        for i in range(records):
+            tool.logger.info(f"benchmark record {i}")
+        caller = time.perf_counter() - t0
+        tool.flush()
+        total = time.perf_counter() - t0
+        mode = "async" if async_mode else "sync"
+        results.append((f"log_{mode}_caller", records / caller, "records/s", "higher"))
+        results.append((f"log_{mode}_written", records / total, "records/s", "higher"))
+    tool.disable_async()
+    return results
+
+
+@benchmark
+def save_test_result(scale):
+    from lib import log_tools
+    from lib.result_store import ResultStore
+
+    writes = 2000 * scale
+    results = []
+    project_root, result_txt, report = Setting.PROJECT_ROOT, Setting.result_txt, Setting.report
+    # the legacy result file is written into PROJECT_ROOT
+    Setting.PROJECT_ROOT = Setting.LOG_PATH
+    try:
+        for suffix, txt, with_report in (("", False, False), ("_txt", True, False), ("_report", False, True)):
+            Setting.result_txt, Setting.report = txt, with_report
+
+            def write():
+                for i in range(writes):
+                    log_tools.save_test_result("BenchCase pass", "bench", iteration=i, duration=0.01)
+                ResultStore.get().flush()
+
+            cost = best_of(write)
+            results.append((f"save_test_result{suffix}", writes / cost, "writes/s", "higher"))
+    finally:
+        Setting.PROJECT_ROOT, Setting.result_txt, Setting.report = project_root, result_txt, report
+    return results
+
+
+@benchmark
+def scheduler(scale):
+    from lib.fake_adb import FAKE_ADB
+    from lib.scheduler import DeviceScheduler
+
+    devices = ["fake0", "fake1", "fake2", "fake3"]
+    adb, Setting.ADB = Setting.ADB, FAKE_ADB
+    fake_devices = os.environ.get("FAKE_ADB_DEVICES")
+    os.environ["FAKE_ADB_DEVICES"] = ",".join(devices)
+    # case x params: 8 runs of a long, a middle and a short case
+    durations = [seconds for seconds in (1.0, 0.3, 0.1) for _ in range(8 * scale)]
+    results = []
+    try:
+        for model in ("static", "pool"):
+            pool = DeviceScheduler(devices, health_interval=1.0)
+            for i, seconds in enumerate(durations):
+                # static: every device gets a slice of the list before the run
+                pool.add("SleepCase", case_file="bench/cases.py", seconds=seconds,
+                         sn=devices[i * len(devices) // len(durations)] if model == "static" else None)
+            pool.run()
+            summary = pool.summary()
+            utilization = sum(summary["devices"].values()) / len(devices)
+            results.append((f"scheduler_{model}_makespan", summary["makespan"], "s", "lower"))
+            results.append((f"scheduler_{model}_utilization", utilization * 100, "%", "higher"))
+    finally:
+        Setting.ADB = adb
+        if fake_devices is None:
+            os.environ.pop("FAKE_ADB_DEVICES")
+        else:
+            os.environ["FAKE_ADB_DEVICES"] = fake_devices
+    return results
+
+
+@benchmark
+def run_it(scale):
+    from lib.api import run_it as api_run_it
+    from lib.stress import run_stress
+    from testcase_template import BasicTestcase
+
+    class BenchCase(BasicTestcase):
+        pass
+
+    times = 100 * scale
+    results = []
+    for name, runner in (("run_it", api_run_it), ("run_stress", run_stress)):
+        cost = best_of(lambda: runner(BenchCase, times=times), repeat=2)
+        results.append((f"{name}_iteration", cost / times * 1000, "ms", "lower"))
+    return results
+
+
+def run_suite(names=None, scale=1):
+    """
+    run the benchmarks in a temp dir with the console log off
+    Args:
+        names: benchmark names, default all
+        scale: multiplies the iterations/bytes of every benchmark
+
+    Returns: result dict, saved as json baseline
+
+    """
+    from lib.log_tools import log
+    from lib.report import ReportWriter
+
+    tmp_dir = tempfile.mkdtemp(prefix="bench_")
+    saved = {k: getattr(Setting, k) for k in ("LOG_PATH", "RESULT_DB", "result_txt", "report", "report_dir")}
+    Setting.LOG_PATH = Path(tmp_dir).joinpath("log")
+    Setting.LOG_PATH.mkdir(parents=True, exist_ok=True)
+    Setting.RESULT_DB = Setting.LOG_PATH.joinpath("result.db")
+    Setting.result_txt = False
+    Setting.report_dir = Path(tmp_dir).joinpath("report")
+    # the global log is created in the temp dir, results are printed instead
+    log.replace_handler(log.console_handler, None)
+    metrics = {}
+    try:
+        for name in names or BENCHMARKS:
+            t0 = time.perf_counter()
+            for metric, value, unit, better in BENCHMARKS[name](scale):
+                metrics[metric] = {"value": round(value, 4), "unit": unit, "better": better}
+                print(f"{metric:<32} {value:>14.3f} {unit}")
+            print(f"# {name} done in {time.perf_counter() - t0:.1f}s")
+    finally:
+        ReportWriter.close_all()
+        for k, v in saved.items():
+            setattr(Setting, k, v)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {"meta": machine_info(scale), "metrics": metrics}
+
+
+def machine_info(scale):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Setting.PROJECT_ROOT,
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"time": datetime.now().isoformat(timespec="seconds"), "commit": commit, "host": platform.node(),
+            "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+            "scale": scale}
+
+
+def compare(base, new, threshold=0.2):
+    """
+    compare two results of run_suite
+    Args:
+        base: baseline result dict
+        new: new result dict
+        threshold: relative change counted as regression, 0.2 = 20%
+
+    Returns: list of regressed metric names
+
+    """
+    regressions = []
+    print(f"{'metric':<32} {'base':>12} {'new':>12} {'change':>8}")
+    for metric, old in base["metrics"].items():
+        current = new["metrics"].get(metric)
+        if current is None or not old["value"]:
+            continue
+        change = (current["value"] - old["value"]) / old["value"]
+        worse = change > threshold if old["better"] == "lower" else change < -threshold
+        better = change < -threshold if old["better"] == "lower" else change > threshold
+        flag = "REGRESSION" if worse else ("improved" if better else "")
+        if worse:
+            regressions.append(metric)
+        print(f"{metric:<32} {old['value']:>12.3f} {current['value']:>12.3f} {change:>+8.1%} {old['unit']} {flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("benchmark suite")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run_parser = sub.add_parser("run", help="run benchmarks and save the result as json")
+    compare_parser = sub.add_parser("compare", help="compare a result with a baseline")
+    for p in (run_parser, compare_parser):
+        p.add_argument("-k", dest="names", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run")
+        p.add_argument("--scale", type=int, default=1, help="multiply iterations and bytes")
+    run_parser.add_argument("-o", dest="output", help="json file, default bench/result_<time>.json")
+    compare_parser.add_argument("baseline", help="baseline json")
+    compare_parser.add_argument("new", nargs="?", help="new result json, run the suite if not given")
+    compare_parser.add_argument("--threshold", type=float, default=0.2, help="relative change of a regression")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        result = run_suite(args.names, args.scale)
+        output = args.output or Setting.PROJECT_ROOT.joinpath(
+            "bench", f"result_{datetime.now().strftime('%Y%m%d%H%M%S')}.json")
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"saved to {output}")
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as f:
+        base = json.load(f)
+    if args.new:
+        with open(args.new, encoding="utf-8") as f:
+            new = json.load(f)
+    else:
+        new = run_suite(args.names, args.scale)
+    regressions = compare(base, new, args.threshold)
+    if regressions:
+        print(f"{len(regressions)} regressions beyond {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    print("no regression")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
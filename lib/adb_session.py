@@ -0,0 +1,258 @@
+import atexit
+import os
+import queue
+import shlex
+import subprocess
+import threading
+import time
+import uuid
+
+from lib.basic_test_tools import BasicTestTools
+from lib.log_tools import log
+from lib.settings import Setting
+from lib.watchdog import watch_command
+
+
+class AdbShellSession:
+    """
+    a long-lived `adb shell` process, commands are framed by sentinels on stdout and stderr
+    """
+
+    def __init__(self, sn=""):
+        self.sn = sn
+        self.proc = None
+        self.stdout_lines = None
+        self.stderr_lines = None
+        self.connect()
+
+    @staticmethod
+    def _split(cmd):
+        return shlex.split(cmd) if os.name != "nt" else cmd
+
+    @staticmethod
+    def _read_lines(pipe, lines):
+        for line in iter(pipe.readline, b""):
+            lines.put(line)
+        # EOF, the session is dead
+        lines.put(None)
+
+    def connect(self):
+        """
+        start a new adb shell process
+        Returns:
+
+        """
+        adb = f"{Setting.ADB} -s {self.sn}" if self.sn else Setting.ADB
+        self.proc = subprocess.Popen(self._split(f"{adb} shell"), stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=0,
+                                     **BasicTestTools._new_group_kwargs())
+        self.stdout_lines = queue.Queue()
+        self.stderr_lines = queue.Queue()
+        for pipe, lines in ((self.proc.stdout, self.stdout_lines), (self.proc.stderr, self.stderr_lines)):
+            threading.Thread(target=self._read_lines, args=(pipe, lines), daemon=True).start()
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            BasicTestTools.kill_process_tree(self.proc.pid)
+            self.proc.wait()
+        self.proc = None
+
+    def abort(self):
+        """
+        kill the session and wake up the command waiting for its output, called by the watchdog
+        Returns:
+
+        """
+        proc, stdout_lines, stderr_lines = self.proc, self.stdout_lines, self.stderr_lines
+        if proc is not None:
+            BasicTestTools.kill_process_tree(proc.pid)
+        for lines in (stdout_lines, stderr_lines):
+            if lines is not None:
+                lines.put(None)
+
+    def reconnect(self):
+        log.logger.warning(f"adb shell session of {self.sn} lost, reconnect")
+        if self.proc is not None:
+            BasicTestTools.kill_process_tree(self.proc.pid)
+            self.proc.wait()
+            self.proc = None
+        self.connect()
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    @staticmethod
+    def _collect(lines, tag, deadline):
+        """
+        collect lines until the sentinel line
+        Args:
+            lines: line queue of a pipe
+            tag: sentinel
+            deadline: time.monotonic() deadline, None for no limit
+
+        Returns: output, text after the sentinel or None if the session is dead
+
+        """
+        out = []
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            line = lines.get(timeout=timeout)
+            if line is None:
+                return b"".join(out), None
+            index = line.find(tag)
+            if index >= 0:
+                # output without a trailing newline shares the line with the sentinel
+                out.append(line[:index])
+                return b"".join(out), line[index + len(tag):]
+            out.append(line)
+
+    def run(self, cmd, timeout=None):
+        """
+        run one shell command in the session
+        Args:
+            cmd: shell command
+            timeout: seconds to wait for the command, default Setting.adb_session_timeout
+
+        Returns: exit status (None if the session died), stdout, stderr
+
+        """
+        if not self.alive:
+            self.reconnect()
+        if timeout is None:
+            timeout = Setting.adb_session_timeout
+        tag = uuid.uuid4().hex
+        # subshell keeps cd/exit/variables of a command away from the next one like a fresh adb shell,
+        # eval keeps a parse error of the command, eg: an unbalanced quote, from swallowing the sentinels
+        script = f'(\neval {shlex.quote(cmd)}\n) </dev/null\necho "{tag}$?"\necho "{tag}" >&2\n'
+        try:
+            self.proc.stdin.write(script.encode("utf-8"))
+            self.proc.stdin.flush()
+        except OSError:
+            # the command is not sent, safe to retry once in a new session
+            self.reconnect()
+            self.proc.stdin.write(script.encode("utf-8"))
+            self.proc.stdin.flush()
+        tag = tag.encode()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            # a case deadline kills the session, the command ends as a dead session
+            with watch_command(self.abort):
+                out, status = self._collect(self.stdout_lines, tag, deadline)
+                err, _ = self._collect(self.stderr_lines, tag, deadline)
+        except queue.Empty:
+            self.reconnect()
+            return None, "", f"adb shell session timeout after {timeout}s"
+        if status is None:
+            self.reconnect()
+            code = None
+        else:
+            code = int(status.strip() or -1)
+        return code, out.decode("utf-8", errors="ignore"), err.decode("utf-8", errors="ignore")
+
+
+class AdbSessionPool:
+    """
+    a small pool of adb shell sessions per sn, shared by all BasicTestTools of the same device
+    """
+    __pools = {}
+    __pools_lock = threading.Lock()
+
+    def __init__(self, sn="", size=2):
+        self.sn = sn
+        self.size = size
+        self.created = 0
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, sn="", size=None):
+        """
+        get the pool of sn
+        Args:
+            sn:
+            size: max sessions of the pool, default Setting.adb_session_size
+
+        Returns:
+
+        """
+        with cls.__pools_lock:
+            pool = cls.__pools.get(sn)
+            if pool is None:
+                pool = cls(sn, size or Setting.adb_session_size)
+                cls.__pools[sn] = pool
+            return pool
+
+    @classmethod
+    def close_all(cls):
+        with cls.__pools_lock:
+            for pool in cls.__pools.values():
+                pool.close()
+            cls.__pools.clear()
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                try:
+                    return AdbShellSession(self.sn)
+                except Exception:
+                    self.created -= 1
+                    raise
+        return self.idle.get()
+
+    def release(self, session):
+        self.idle.put(session)
+
+    def run(self, cmd, timeout=None):
+        """
+        run one shell command by an idle session of the pool
+        Args:
+            cmd:
+            timeout:
+
+        Returns: exit status, stdout, stderr
+
+        """
+        session = self.acquire()
+        try:
+            return session.run(cmd, timeout)
+        finally:
+            self.release(session)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+        self.created = 0
+
+
+atexit.register(AdbSessionPool.close_all)
+
+if __name__ == '__main__':
+    from lib.fake_adb import FAKE_ADB
+
+    Setting.ADB = FAKE_ADB
+    times = 50
+    for use_session in (False, True):
+        tools = BasicTestTools(use_session=use_session)
+        tools.adb_shell("true", verbosity=0)
+        t0 = time.perf_counter()
+        for _ in range(times):
+            tools.adb_shell("echo hello", verbosity=0)
+        cost = (time.perf_counter() - t0) / times * 1000
+        print(f"session={use_session}: {cost:.2f} ms per adb_shell")
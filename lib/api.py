@@ -3,6 +3,7 @@ from functools import wraps
 
 from lib.basic_test_tools import BasicTestTools
 from lib.log_tools import log, add_handler_to_case, rename_log_dir
+from lib.result_store import ResultStore
 from lib.settings import Setting
 
 api = None
@@ -84,12 +85,32 @@ def fixed_setting(**kwargs):
 
 
 def run_it(case, times=1, **kwargs):
+    """
+    run case times times, a new instance and log dir each time
+    Args:
+        case: case class
+        times:
+        **kwargs: parameters of the case
+
+    Returns: status of each run, eg: ["pass", "fail"]
+
+    """
+    statuses = []
     for i in range(1, times + 1):
         log.logger.info(f"{case} run {i} times")
         instance = case(**kwargs)
+        instance.iteration = i
+        instance.params = kwargs
         add_handler_to_case(instance)
+        statuses.append(instance.status)
         rename_log_dir(instance)
         log.logger.info(f"{case} {i} run end")
+    ResultStore.get().flush()
+    if Setting.report:
+        from lib.report import ReportWriter
+
+        ReportWriter.flush_all()
+    return statuses
 
 
 @init_api
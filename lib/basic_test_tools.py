@@ -1,40 +1,328 @@
+import codecs
+import os
+import shlex
+import signal
 import subprocess
+import threading
+import time
 import traceback
+import weakref
+from collections import namedtuple
+from functools import partial
 
 from lib.log_tools import log
+from lib.query_cache import ADB_DISCONNECTED, FASTBOOT_WRITE_COMMAND, REBOOT_COMMAND, QueryCache
+from lib.settings import Setting
+from lib.trace import annotate, span, tracer_var
+from lib.watchdog import CaseTimeout, check_deadline, running_commands, watch_command
+
+# result of one item of adb_shell_batch, value is output converted to int/float if it is a number,
+# code is the exit code, None if the item was run again alone after a broken frame
+BatchResult = namedtuple("BatchResult", ["state", "code", "output", "value"])
+
+
+class CommandStream:
+    """
+    iterate the output of a running command as it arrives, memory stays constant however long it runs.
+    stderr is merged into stdout, the child blocks when the consumer falls behind.
+    """
+
+    def __init__(self, cmd, shell=True, chunk_size=None, max_line=64 * 1024, callback=None, until=None,
+                 timeout=None, bufsize=64 * 1024):
+        """
+        Args:
+            cmd: 要执行的命令
+            shell: True使用cmd执行命令，False可指定执行程序
+            chunk_size: yield raw bytes chunks of at most chunk_size instead of decoded lines
+            max_line: longer lines are split, bounds the memory of a line without newline
+            callback: called with every line/chunk
+            until: predicate of a line/chunk, the command is killed after the first match
+            timeout: kill the command after timeout seconds
+            bufsize: buffer size of the pipe reader
+        """
+        self.cmd = cmd
+        self.chunk_size = chunk_size
+        self.max_line = max_line
+        self.callback = callback
+        self.until = until
+        self.matched = None
+        self.timed_out = False
+        self.returncode = None
+        argv = BasicTestTools._shell_argv(cmd) if shell else cmd
+        self.proc = subprocess.Popen(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=bufsize,
+                                     **BasicTestTools._new_group_kwargs())
+        # killed with the running commands when a case deadline expires
+        self.kill = partial(BasicTestTools.kill_process_tree, self.proc.pid)
+        self.commands = running_commands()
+        self.commands.append(self.kill)
+        self.timer = None
+        if timeout is not None:
+            self.timer = threading.Timer(timeout, self._expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _expire(self):
+        self.timed_out = True
+        BasicTestTools.kill_process_tree(self.proc.pid)
+
+    def __iter__(self):
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        stdout = self.proc.stdout
+        try:
+            while True:
+                if self.chunk_size:
+                    item = stdout.read1(self.chunk_size)
+                    if not item:
+                        break
+                else:
+                    data = stdout.readline(self.max_line)
+                    if not data:
+                        break
+                    item = decoder.decode(data).rstrip("\r\n")
+                if self.callback is not None:
+                    self.callback(item)
+                yield item
+                if self.until is not None and self.until(item):
+                    self.matched = item
+                    break
+        finally:
+            self.close()
+
+    def run(self):
+        """
+        consume the whole output, for callback/until only usage
+        Returns: 命令执行状态
+
+        """
+        for _ in self:
+            pass
+        return self.state
+
+    def close(self):
+        if self.kill in self.commands:
+            self.commands.remove(self.kill)
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.proc.poll() is None:
+            BasicTestTools.kill_process_tree(self.proc.pid)
+        self.proc.stdout.close()
+        self.returncode = self.proc.wait()
+
+    @property
+    def state(self):
+        """
+        True if the command exits with 0 or is stopped by until
+        """
+        if self.timed_out:
+            return False
+        return self.matched is not None or self.returncode == 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 class BasicTestTools:
     """
     basic test tools including adb fastboot
     """
+    # max in-flight async commands of one device
+    max_inflight_per_device = 8
+    # {event loop: {sn: semaphore}}, a semaphore can only be used in the loop it is created in
+    _device_semaphores = weakref.WeakKeyDictionary()
 
-    def __init__(self, sn="", logger=None):
+    def __init__(self, sn="", logger=None, use_session=None):
         self.logger = logger or log.logger
         self.sn = sn
+        # adb_shell by long-lived adb shell sessions instead of a new adb process per call
+        self.use_session = Setting.adb_session if use_session is None else use_session
 
     @staticmethod
-    def cmder(cmd, timeout=None, shell=True):
+    def cmder(cmd, timeout=None, shell=True, input=None):
         """
         run cmd by local shell, eg: shell or cmd or powershell
         Args:
             cmd: 要执行的命令
-            timeout: 等待命令执行完成的延迟时间
+            timeout: 等待命令执行完成的时间, 超时后杀掉命令的进程树并返回False, 默认Setting.cmd_timeout
             shell: True使用cmd执行命令，False可指定执行程序
+            input: str/bytes written to the stdin of cmd, stdin is inherited if None
 
         Returns: 命令执行状态, 命令执行返回结果
 
+        Raises: CaseTimeout if the case deadline of this thread expired before or during the command
+
         """
-        sp = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = sp.communicate(timeout=timeout)
+        check_deadline()
+        timeout = Setting.cmd_timeout if timeout is None else timeout
+        if isinstance(input, str):
+            input = input.encode("utf-8")
+        sp = subprocess.Popen(cmd, shell=shell, stdin=None if input is None else subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, **BasicTestTools._new_group_kwargs())
+        timed_out = False
+        with watch_command(partial(BasicTestTools.kill_process_tree, sp.pid)):
+            try:
+                out, err = sp.communicate(input, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                BasicTestTools.kill_process_tree(sp.pid)
+                out, err = BasicTestTools._reap(sp)
+            except BaseException:
+                # KeyboardInterrupt or CaseTimeout, the child is in its own group and gets no signal
+                BasicTestTools.kill_process_tree(sp.pid)
+                BasicTestTools._reap(sp)
+                raise
+        # killed by the watchdog, the case stops here instead of going on with a failed command
+        check_deadline()
         out = out.decode(encoding='utf-8', errors='ignore') if out else ''
         err = err.decode(encoding='utf-8', errors='ignore') if err else ''
+        if timed_out:
+            err = f"{err}timeout after {timeout}s"
+        annotate(exit_code=sp.returncode)
+        return sp.returncode == 0 and not timed_out, BasicTestTools.format_output(out, err)
+
+    @staticmethod
+    def _reap(sp, timeout=5):
+        """
+        collect the output of a killed process
+        Args:
+            sp: Popen
+            timeout: a daemon escaped from the process group may keep the pipes open
+
+        Returns: stdout, stderr
+
+        """
+        try:
+            return sp.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            sp.kill()
+            for pipe in (sp.stdout, sp.stderr):
+                pipe.close()
+            sp.wait()
+            return b"", b""
+
+    @staticmethod
+    def _shell_argv(cmd):
+        """
+        argv of running cmd by local shell
+        Args:
+            cmd:
+
+        Returns:
+
+        """
+        if os.name == "nt":
+            return [os.environ.get("COMSPEC", "cmd.exe"), "/c", cmd]
+        return ["/bin/sh", "-c", cmd]
+
+    @staticmethod
+    def _new_group_kwargs():
+        """
+        Popen kwargs to start the child in a new process group, so that its whole tree can be killed
+        Returns:
+
+        """
+        if os.name == "nt":
+            return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        return {"start_new_session": True}
+
+    @staticmethod
+    def kill_process_tree(pid):
+        """
+        kill a process started with _new_group_kwargs and all of its children
+        Args:
+            pid:
+
+        Returns:
+
+        """
+        try:
+            if os.name == "nt":
+                subprocess.run(["taskkill", "/F", "/T", "/PID", str(pid)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            else:
+                os.killpg(pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    @classmethod
+    async def cmder_async(cls, cmd, timeout=None, shell=True):
+        """
+        asyncio version of cmder, the whole process tree is killed on timeout or cancellation
+        Args:
+            cmd: 要执行的命令
+            timeout: 等待命令执行完成的时间, 超时抛出asyncio.TimeoutError
+            shell: True使用cmd执行命令，False可指定执行程序
+
+        Returns: 命令执行状态, 命令执行返回结果
+
+        """
+        # asyncio is slow to import, it is already loaded when a loop runs this
+        import asyncio
+
+        if shell:
+            argv = cls._shell_argv(cmd)
+        else:
+            argv = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+        proc = await asyncio.create_subprocess_exec(*argv, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                                    **cls._new_group_kwargs())
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(), timeout)
+        except BaseException:
+            # timeout or cancelled
+            cls.kill_process_tree(proc.pid)
+            await asyncio.shield(proc.wait())
+            raise
+        out = out.decode(encoding='utf-8', errors='ignore') if out else ''
+        err = err.decode(encoding='utf-8', errors='ignore') if err else ''
+        return proc.returncode == 0, cls.format_output(out, err)
+
+    @staticmethod
+    def cmder_stream(cmd, **kwargs):
+        """
+        streaming version of cmder for long-running commands, eg: logcat, dd, fio
+        Args:
+            cmd: 要执行的命令
+            **kwargs: see CommandStream
+
+        Returns: CommandStream, iterate it to get lines or chunks
+
+        """
+        return CommandStream(cmd, **kwargs)
+
+    @staticmethod
+    def format_output(out, err):
+        """
+        strip every line, drop blank lines and join stdout and stderr
+        Args:
+            out: decoded stdout
+            err: decoded stderr
+
+        Returns:
+
+        """
         out = '\n'.join([line_strip for line in out.splitlines() if (line_strip := line.strip()) != ""])
         err = '\n'.join([line_strip for line in err.splitlines() if (line_strip := line.strip()) != ""])
-        if sp.returncode == 0:
-            return True, f'{out}\n{err}'
-        else:
-            return False, f'{out}\n{err}'
+        return f'{out}\n{err}'
+
+    @classmethod
+    def list_devices(cls, state="device"):
+        """
+        list sn of the devices attached to this host by `adb devices`
+        Args:
+            state: only return devices in this state, eg: device, recovery, unauthorized
+
+        Returns: sn list
+
+        """
+        _, ret = cls.cmder(f"{Setting.ADB} devices")
+        devices = []
+        for line in ret.splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[1] == state:
+                devices.append(fields[0])
+        return devices
 
     def _cmd_sn_wrapper(self, cmd):
         """
@@ -67,66 +355,369 @@ class BasicTestTools:
         else:
             return f'{cmd} -s {self.sn}'
 
-    def _process_cmd(self, exec_cmd, verbosity):
+    def _session_shell(self, cmd, timeout=None):
+        """
+        run adb shell cmd by the session pool of this device
+        Args:
+            cmd: adb shell命令
+            timeout: default Setting.cmd_timeout
+
+        Returns: 命令执行状态, 命令执行返回结果
+
+        """
+        from lib.adb_session import AdbSessionPool
+
+        code, out, err = AdbSessionPool.get(self.sn).run(cmd, Setting.cmd_timeout if timeout is None else timeout)
+        return code == 0, self.format_output(out, err)
+
+    def _process_cmd(self, exec_cmd, verbosity, runner=None, timeout=None):
         """
         process cmd
         Args:
             exec_cmd:
             verbosity:
+            runner: function to run exec_cmd, default cmder
+            timeout: seconds, the command is killed after it
 
         Returns:
 
         """
+        check_deadline()
         if verbosity >= 1:
             self.logger.info(exec_cmd)
-        try:
-            state, ret = self.cmder(exec_cmd)
-            ret = ret.strip()
-        except Exception:
-            log.logger.error(traceback.format_exc())
-            return False, ""
+        with span(exec_cmd[:80], "cmd", cmd=exec_cmd) as trace_args:
+            try:
+                state, ret = (runner or self.cmder)(exec_cmd, timeout=timeout)
+                # runners other than cmder, eg: an adb session, do not check
+                check_deadline()
+                ret = ret.strip()
+            except CaseTimeout:
+                raise
+            except Exception:
+                log.logger.error(traceback.format_exc())
+                return False, ""
+            trace_args.update(state=state, output_bytes=len(ret))
+        self._log_result(state, ret, verbosity)
+        return state, ret
+
+    def _log_result(self, state, ret, verbosity):
         if verbosity >= 2:
             if state is True:
                 self.logger.info(f'{state}\n{ret}')
             else:
                 self.logger.error(f'{state}\n{ret}')
+
+    def _device_semaphore(self):
+        """
+        semaphore bounding the in-flight async commands of this device in the running loop
+        Returns:
+
+        """
+        import asyncio
+
+        semaphores = self._device_semaphores.setdefault(asyncio.get_running_loop(), {})
+        semaphore = semaphores.get(self.sn)
+        if semaphore is None:
+            semaphore = semaphores[self.sn] = asyncio.Semaphore(self.max_inflight_per_device)
+        return semaphore
+
+    async def _process_cmd_async(self, exec_cmd, verbosity, timeout=None):
+        """
+        asyncio version of _process_cmd
+        Args:
+            exec_cmd:
+            verbosity:
+            timeout: seconds to wait for the command
+
+        Returns:
+
+        """
+        import asyncio
+
+        if verbosity >= 1:
+            self.logger.info(exec_cmd)
+        # no span stack: concurrent commands of a loop share the thread
+        tracer = tracer_var.get()
+        start = time.perf_counter_ns()
+        try:
+            async with self._device_semaphore():
+                state, ret = await self.cmder_async(exec_cmd, timeout=timeout)
+            ret = ret.strip()
+            if tracer is not None:
+                tracer.add(exec_cmd[:80], "cmd", start, time.perf_counter_ns() - start,
+                           {"cmd": exec_cmd, "state": state, "output_bytes": len(ret)})
+        except asyncio.TimeoutError:
+            log.logger.error(f"{exec_cmd} timeout after {timeout}s")
+            # same text as cmder, callers tell a timeout from an empty failure
+            return False, f"timeout after {timeout}s"
+        except Exception:
+            log.logger.error(traceback.format_exc())
+            return False, ""
+        self._log_result(state, ret, verbosity)
         return state, ret
 
-    def adb_exec(self, cmd, verbosity=2):
+    def adb_exec(self, cmd, verbosity=2, timeout=None):
         """
         执行adb命令，并打印命令和执行结果
         Args:
             cmd: 命令
             verbosity: 是否打印命令和结果
+            timeout: 超时时间, 超时后杀掉命令的进程树并返回False, 默认Setting.cmd_timeout
 
         Returns:
 
         """
-        exec_cmd = f"{self.add_sn_to_exec('adb')} {cmd}"
-        return self._process_cmd(exec_cmd, verbosity)
+        exec_cmd = f"{self.add_sn_to_exec(Setting.ADB)} {cmd}"
+        state, ret = self._process_cmd(exec_cmd, verbosity, timeout=timeout)
+        self._check_boot_change(cmd, state, ret)
+        return state, ret
 
-    def adb_shell(self, cmd, verbosity=2):
+    def adb_shell(self, cmd, verbosity=2, timeout=None, cache=None):
         """
         执行adb shell命令，并打印命令和执行结果
         Args:
             cmd: adb shell命令
             verbosity: 是否打印结果
+            timeout: 超时时间, 超时后杀掉命令的进程树并返回False, 默认Setting.cmd_timeout
+            cache: None: cached if cmd starts with one of Setting.cacheable_commands, True/False: force,
+                number: cached for this many seconds. see QueryCache
+        """
+        ttl = QueryCache.ttl_of(cmd, cache)
+        if not ttl:
+            state, ret = self._adb_shell(cmd, verbosity, timeout)
+            self._check_boot_change(cmd, state, ret)
+            return state, ret
+        query_cache = QueryCache.get(self.sn)
+        ret = query_cache.lookup(cmd, self._read_boot_id)
+        if ret is not None:
+            if verbosity >= 1:
+                self.logger.info(f"{cmd} (cached)")
+            self._log_result(True, ret, verbosity)
+            return True, ret
+        state, ret = self._adb_shell(cmd, verbosity, timeout)
+        self._check_boot_change(cmd, state, ret)
+        if state:
+            query_cache.store(cmd, ret, ttl, self._read_boot_id)
+        return state, ret
+
+    def _read_boot_id(self):
+        state, ret = self._adb_shell("cat /proc/sys/kernel/random/boot_id", 0)
+        return ret if state and ret else None
+
+    def _check_boot_change(self, cmd, state, ret):
+        """
+        drop the cached queries after a reboot command or when the device is gone
+        """
+        if REBOOT_COMMAND.search(cmd):
+            QueryCache.get(self.sn).invalidate(cmd)
+        elif not state and ADB_DISCONNECTED.search(ret):
+            QueryCache.get(self.sn).invalidate(ret.splitlines()[-1])
+
+    def _adb_shell(self, cmd, verbosity=2, timeout=None):
+        if self.use_session:
+            return self._process_cmd(cmd, verbosity, runner=self._session_shell, timeout=timeout)
+        shell_cmd = f'{self.add_sn_to_exec(Setting.ADB)} shell "{cmd}"'
+        return self._process_cmd(shell_cmd, verbosity, timeout=timeout)
+
+    def adb_shell_batch(self, items, verbosity=1, timeout=None):
+        """
+        run many adb shell commands in one adb shell, eg: a snapshot of 50 sysfs nodes in one round trip.
+        the script is sent by stdin, so commands may contain quotes and $. every item is framed by a random tag
+        line with its exit code, items whose frame is broken are run again one by one by adb_shell
+        Args:
+            items: list of commands or paths (read by cat), or {key: command or path}
+            verbosity: 是否打印命令
+            timeout: 超时时间, 默认Setting.cmd_timeout
+
+        Returns: {item or key: BatchResult}
+
         """
-        shell_cmd = f'{self.add_sn_to_exec("adb")} shell "{cmd}"'
-        return self._process_cmd(shell_cmd, verbosity)
+        if not isinstance(items, dict):
+            items = {item: item for item in items}
+        commands = {key: f"cat {cmd}" if self._is_path(cmd) else cmd for key, cmd in items.items()}
+        # random tag without importing uuid on the import path of every case
+        tag = f"@@{os.urandom(16).hex()}"
+        lines = []
+        for i, cmd in enumerate(commands.values()):
+            # the extra newline ends output without a trailing newline before the end frame
+            # eval keeps a parse error of one command inside its frame
+            lines.append(f'echo "{tag} {i}"\n(\neval {shlex.quote(cmd)}\n) </dev/null 2>&1\nrc=$?\n'
+                         f'echo\necho "{tag} {i} $rc"')
+        script = "\n".join(lines) + "\n"
+        if verbosity >= 1:
+            self.logger.info(f"adb shell batch of {len(commands)} commands")
+        if self.use_session:
+            state, out = self._process_cmd(script, 0, runner=self._session_shell, timeout=timeout)
+        else:
+            shell_cmd = f"{self.add_sn_to_exec(Setting.ADB)} shell"
+            state, out = self._process_cmd(shell_cmd, 0, runner=partial(self.cmder, input=script), timeout=timeout)
+        frames = self._parse_batch(out, tag) if out else {}
+        results = {}
+        broken = []
+        for i, (key, cmd) in enumerate(commands.items()):
+            frame = frames.get(i)
+            if frame is None:
+                broken.append(key)
+                continue
+            code, output = frame
+            results[key] = BatchResult(code == 0, code, output, self._typed(output))
+        if broken:
+            self.logger.warning(f"adb shell batch: {len(broken)} of {len(commands)} frames broken, run one by one")
+            for key in broken:
+                state, output = self.adb_shell(commands[key], verbosity=0, timeout=timeout)
+                results[key] = BatchResult(state, None, output, self._typed(output))
+        if verbosity >= 2:
+            for key, result in results.items():
+                self.logger.info(f"{key}: {result.output}")
+        return results
+
+    @staticmethod
+    def _is_path(item):
+        return item.startswith("/") and " " not in item and "|" not in item
+
+    @staticmethod
+    def _parse_batch(out, tag):
+        """
+        Returns: {index: (exit code, output)} of the items framed correctly
 
-    def fastboot_exec(self, cmd, verbosity=2):
+        """
+        frames = {}
+        index = None
+        body = []
+        for line in out.splitlines():
+            if not line.startswith(tag):
+                if index is not None:
+                    body.append(line)
+                continue
+            fields = line[len(tag):].split()
+            if len(fields) == 1 and fields[0].isdigit():
+                # a begin frame, an unfinished item before it is broken
+                index, body = int(fields[0]), []
+            elif len(fields) == 2 and index is not None and fields[0] == str(index):
+                try:
+                    code = int(fields[1])
+                except ValueError:
+                    index = None
+                    continue
+                # drop the newline echoed before the end frame
+                frames[index] = (code, "\n".join(body[:-1] if body and body[-1] == "" else body).strip())
+                index = None
+            else:
+                index = None
+        return frames
+
+    @staticmethod
+    def _typed(output):
+        """
+        output as int (decimal or 0x hex) or float if it is one number, else the output
+        """
+        text = output.strip()
+        try:
+            return int(text, 16) if text[:2].lower() == "0x" else int(text)
+        except ValueError:
+            pass
+        try:
+            return float(text)
+        except ValueError:
+            return text
+
+    def adb_exec_stream(self, cmd, verbosity=1, **kwargs):
+        """
+        执行adb命令，逐行返回输出, eg: for line in tools.adb_exec_stream("logcat", until=...)
+        Args:
+            cmd: 命令
+            verbosity: 是否打印命令
+            **kwargs: see CommandStream
+
+        Returns: CommandStream
+
+        """
+        exec_cmd = f"{self.add_sn_to_exec(Setting.ADB)} {cmd}"
+        if verbosity >= 1:
+            self.logger.info(exec_cmd)
+        return self.cmder_stream(exec_cmd, **kwargs)
+
+    def adb_shell_stream(self, cmd, verbosity=1, **kwargs):
+        """
+        执行adb shell命令，逐行返回输出
+        Args:
+            cmd: adb shell命令
+            verbosity: 是否打印命令
+            **kwargs: see CommandStream
+
+        Returns: CommandStream
+
+        """
+        shell_cmd = f'{self.add_sn_to_exec(Setting.ADB)} shell "{cmd}"'
+        if verbosity >= 1:
+            self.logger.info(shell_cmd)
+        return self.cmder_stream(shell_cmd, **kwargs)
+
+    def fastboot_exec(self, cmd, verbosity=2, timeout=None):
         """
         execute cmd by fastboot
         Args:
             cmd:
             verbosity:
+            timeout: 超时时间, 超时后杀掉命令的进程树并返回False, 默认Setting.cmd_timeout
+
+        Returns:
+
+        """
+        exec_cmd = f"{self.add_sn_to_exec(Setting.FASTBOOT)} {cmd}"
+        # the device boots again after a fastboot command writing it
+        if FASTBOOT_WRITE_COMMAND.search(cmd):
+            QueryCache.get(self.sn).invalidate(f"fastboot {cmd}")
+        return self._process_cmd(exec_cmd, verbosity, timeout=timeout)
+
+    async def adb_exec_async(self, cmd, verbosity=2, timeout=None):
+        """
+        asyncio version of adb_exec
+        Args:
+            cmd: 命令
+            verbosity: 是否打印命令和结果
+            timeout: 超时时间, 超时后杀掉命令的进程树并返回False
+
+        Returns:
+
+        """
+        exec_cmd = f"{self.add_sn_to_exec(Setting.ADB)} {cmd}"
+        state, ret = await self._process_cmd_async(exec_cmd, verbosity, timeout)
+        self._check_boot_change(cmd, state, ret)
+        return state, ret
+
+    async def adb_shell_async(self, cmd, verbosity=2, timeout=None):
+        """
+        asyncio version of adb_shell
+        Args:
+            cmd: adb shell命令
+            verbosity: 是否打印结果
+            timeout: 超时时间, 超时后杀掉命令的进程树并返回False
+
+        Returns:
+
+        """
+        shell_cmd = f'{self.add_sn_to_exec(Setting.ADB)} shell "{cmd}"'
+        state, ret = await self._process_cmd_async(shell_cmd, verbosity, timeout)
+        self._check_boot_change(cmd, state, ret)
+        return state, ret
+
+    async def fastboot_exec_async(self, cmd, verbosity=2, timeout=None):
+        """
+        asyncio version of fastboot_exec
+        Args:
+            cmd:
+            verbosity:
+            timeout: 超时时间, 超时后杀掉命令的进程树并返回False
 
         Returns:
 
         """
-        exec_cmd = f"{self.add_sn_to_exec('fastboot')} {cmd}"
-        return self._process_cmd(exec_cmd, verbosity)
+        exec_cmd = f"{self.add_sn_to_exec(Setting.FASTBOOT)} {cmd}"
+        # the device boots again after a fastboot command writing it, as fastboot_exec
+        if FASTBOOT_WRITE_COMMAND.search(cmd):
+            QueryCache.get(self.sn).invalidate(f"fastboot {cmd}")
+        return await self._process_cmd_async(exec_cmd, verbosity, timeout)
 
 
 if __name__ == '__main__':
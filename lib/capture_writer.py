@@ -0,0 +1,355 @@
+import gzip
+import lzma
+import os
+import queue
+import struct
+import threading
+import time
+from pathlib import Path
+
+from lib.log_tools import log
+
+# timestamp sidecar record: offset of the first byte of a received chunk in the segment,
+# host time.monotonic_ns() and time.time_ns() when the chunk was received
+STAMP = struct.Struct("<QQQ")
+STAMP_SUFFIX = ".ts"
+
+
+def read_stamps(path):
+    """
+    records of a timestamp sidecar
+    Args:
+        path: capture segment or its sidecar
+
+    Returns: offsets, monotonic ns, wall ns lists
+
+    """
+    path = Path(path)
+    if path.suffix != STAMP_SUFFIX:
+        path = path.with_name(f"{path.name}{STAMP_SUFFIX}")
+    data = path.read_bytes() if path.is_file() else b""
+    # a record cut by a crash is dropped
+    data = data[:len(data) - len(data) % STAMP.size]
+    offsets, mono, wall = [], [], []
+    for offset, mono_ns, wall_ns in STAMP.iter_unpack(data):
+        offsets.append(offset)
+        mono.append(mono_ns)
+        wall.append(wall_ns)
+    return offsets, mono, wall
+
+
+class CaptureWriter:
+    """
+    binary capture file writer for long captures.
+    small writes are coalesced into large aligned batches, which are written, compressed and fsynced
+    in a background thread; the file is rotated by size and/or time into numbered segments:
+    data.txt is the live segment, data.0001.txt, data.0002.txt... are the rotated ones.
+    with timestamps, stamp() records when chunks are received into a sidecar of fixed size STAMP records
+    next to every segment (data.txt.ts, data.0001.txt.ts...), the capture itself is unchanged
+    """
+    COMPRESSORS = {None: (open, ""), "gzip": (gzip.open, ".gz"), "lzma": (lzma.open, ".xz")}
+
+    def __init__(self, file_path, batch_size=1024 * 1024, align=64 * 1024, max_bytes=None, max_seconds=None,
+                 fsync="rotate", compress=None, flush_interval=1.0, max_pending=32, oversize_helper=None,
+                 timestamps=False, stamp_interval=0.001):
+        """
+        Args:
+            file_path: live capture file
+            batch_size: bytes coalesced before a batch is handed to the writer thread
+            align: batches are multiples of align bytes, except the flushed tail
+            max_bytes: rotate when the segment has max_bytes of (uncompressed) data
+            max_seconds: rotate when the segment is older than max_seconds
+            fsync: "always" after every batch, "rotate" when a segment is closed, "never", or seconds between fsync
+            compress: None, "gzip" or "lzma", compress segments on the fly in the writer thread
+            flush_interval: pending data older than this is handed over even if the batch is not full,
+                by write() or by the writer thread when no data comes
+            max_pending: max batches waiting for the writer thread, write() blocks when reached
+            oversize_helper: callable(writer, size) checking rotation after each batch, default rotate_if_oversize
+            timestamps: write the timestamp sidecar of stamp()
+            stamp_interval: seconds, stamps closer than this to the previous one are skipped,
+                bounds the sidecar to 24 bytes per stamp_interval however small the chunks are
+        """
+        if compress not in self.COMPRESSORS:
+            raise ValueError(f"unknown compress {compress}")
+        self.opener, self.compress_suffix = self.COMPRESSORS[compress]
+        self.base_path = Path(file_path)
+        self.batch_size = max(align, batch_size - batch_size % align)
+        self.align = align
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.fsync = fsync
+        self.flush_interval = flush_interval
+        self.oversize_helper = oversize_helper or CaptureWriter.rotate_if_oversize
+
+        self.pending = bytearray()
+        # guards pending and the handoff, the writer thread takes it without blocking for the timed flush
+        self.lock = threading.Lock()
+        self.timestamps = timestamps
+        self.stamp_interval_ns = int(stamp_interval * 1e9)
+        self.last_stamp = -self.stamp_interval_ns
+        # (stream offset, monotonic ns, wall ns) of the pending data
+        self.pending_stamps = []
+        # stream bytes written by the writer thread, and the stream offset where the live segment starts
+        self.written = 0
+        self.segment_offset = 0
+        self.stamp_fd = None
+        self.last_handoff = time.monotonic()
+        self.batches = queue.Queue(maxsize=max_pending)
+        # bytes accepted by write() since the capture starts
+        self.total = 0
+        # uncompressed bytes in the live segment
+        self.size = 0
+        self.segment_index = self._last_segment_index()
+        self.segment_start = time.monotonic()
+        self.last_fsync = time.monotonic()
+        self.fd = None
+        self.error = None
+        self._open_segment()
+        self.thread = threading.Thread(target=self._io_loop, name=f"capture-{self.base_path.name}", daemon=True)
+        self.thread.start()
+
+    @property
+    def live_path(self):
+        return self.base_path.with_name(f"{self.base_path.name}{self.compress_suffix}")
+
+    def segment_path(self, index):
+        return self.base_path.with_name(
+            f"{self.base_path.stem}.{index:04d}{self.base_path.suffix}{self.compress_suffix}")
+
+    def segments(self):
+        """
+        all segments of the capture in time order, the live one is the last
+        Returns:
+
+        """
+        rotated = sorted(p for p in self.base_path.parent.glob(f"{self.base_path.stem}.[0-9][0-9][0-9][0-9]*")
+                         if p.suffix != STAMP_SUFFIX)
+        return rotated + [self.live_path]
+
+    def _last_segment_index(self):
+        indexes = [int(p.name[len(self.base_path.stem) + 1:][:4]) for p in
+                   self.base_path.parent.glob(f"{self.base_path.stem}.[0-9][0-9][0-9][0-9]*")]
+        return max(indexes, default=0)
+
+    def stamp_path(self, path):
+        return path.with_name(f"{path.name}{STAMP_SUFFIX}")
+
+    def _open_segment(self):
+        self.base_path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = self.opener(self.live_path, "ab")
+        self.size = 0
+        self.segment_start = time.monotonic()
+        if self.timestamps:
+            # offsets continue after the data already in an appended live segment
+            appended = self.live_path.stat().st_size if self.compress_suffix == "" else 0
+            self.segment_offset = self.written - appended
+            self.stamp_fd = open(self.stamp_path(self.live_path), "ab")
+
+    def _sync(self):
+        self.fd.flush()
+        fileobj = getattr(self.fd, "fileobj", None) or self.fd
+        if hasattr(fileobj, "fileno"):
+            try:
+                os.fsync(fileobj.fileno())
+            except (OSError, ValueError):
+                pass
+        self.last_fsync = time.monotonic()
+
+    def stamp(self, offset=None, mono_ns=None, wall_ns=None):
+        """
+        record when the data from offset is received, called by the capture thread before write()
+        Args:
+            offset: stream offset of the first byte of the chunk, default the next byte written
+            mono_ns: time.monotonic_ns() of the chunk, default now
+            wall_ns: time.time_ns() of the chunk, default now
+
+        Returns:
+
+        """
+        if not self.timestamps:
+            return
+        mono_ns = time.monotonic_ns() if mono_ns is None else mono_ns
+        if mono_ns - self.last_stamp < self.stamp_interval_ns:
+            return
+        self.last_stamp = mono_ns
+        self.pending_stamps.append((self.total if offset is None else offset, mono_ns,
+                                    time.time_ns() if wall_ns is None else wall_ns))
+
+    def write(self, data):
+        """
+        add data to the pending batch, called by the capture thread
+        Args:
+            data: bytes-like
+
+        Returns:
+
+        """
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            self.pending += data
+            self.total += len(data)
+            if len(self.pending) >= self.batch_size:
+                size = len(self.pending) - len(self.pending) % self.align
+                self._handoff(size)
+            elif self.pending and time.monotonic() - self.last_handoff >= self.flush_interval:
+                self._handoff(len(self.pending))
+
+    def _take(self, size):
+        stamps = ()
+        if self.pending_stamps:
+            # stamps of the data handed over, the ones of the kept tail stay pending
+            end = self.total - len(self.pending) + size
+            count = 0
+            while count < len(self.pending_stamps) and self.pending_stamps[count][0] < end:
+                count += 1
+            stamps, self.pending_stamps = self.pending_stamps[:count], self.pending_stamps[count:]
+        batch = bytes(self.pending[:size])
+        del self.pending[:size]
+        self.last_handoff = time.monotonic()
+        return batch, stamps
+
+    def _handoff(self, size):
+        self._put(self._take(size))
+
+    def _put(self, item):
+        """
+        queue item for the writer thread, never blocks forever on a full queue the dead writer thread
+        will not drain
+        """
+        while True:
+            if self.error is not None:
+                raise self.error
+            if not self.thread.is_alive():
+                raise RuntimeError(f"capture writer {self.base_path} thread is not running")
+            try:
+                self.batches.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def flush(self):
+        """
+        hand over all pending data to the writer thread
+        Returns:
+
+        """
+        with self.lock:
+            if self.pending:
+                self._handoff(len(self.pending))
+
+    def _timed_flush(self):
+        """
+        take the pending data older than flush_interval when the capture thread is idle, eg: the port is quiet
+        Returns: (batch, stamps) or None
+        """
+        # the capture thread may hold the lock while waiting for a full queue, which only this thread drains
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            # batches put before the lock was taken go first
+            if self.pending and self.batches.empty() and \
+                    time.monotonic() - self.last_handoff >= self.flush_interval:
+                return self._take(len(self.pending))
+            return None
+        finally:
+            self.lock.release()
+
+    def _io_loop(self):
+        while True:
+            timed = False
+            try:
+                item = self.batches.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = self._timed_flush()
+                if item is None:
+                    continue
+                timed = True
+            if item is None:
+                break
+            batch, stamps = item
+            try:
+                if stamps:
+                    # a batch never spans segments, rotation is checked after it
+                    # a stamp arriving after its data was written (buffered capture) points at the segment start
+                    self.stamp_fd.write(b"".join(STAMP.pack(max(0, offset - self.segment_offset), mono_ns, wall_ns)
+                                                 for offset, mono_ns, wall_ns in stamps))
+                self.fd.write(batch)
+                self.size += len(batch)
+                self.written += len(batch)
+                if self.fsync == "always":
+                    self._sync()
+                elif isinstance(self.fsync, (int, float)) and time.monotonic() - self.last_fsync >= self.fsync:
+                    self._sync()
+                elif timed:
+                    # the capture is idle, make the tail visible to readers of the live segment
+                    self.fd.flush()
+                    if self.stamp_fd is not None:
+                        self.stamp_fd.flush()
+                self.oversize_helper(self, self.size)
+            except Exception as e:
+                self.error = e
+                log.logger.error(f"capture writer {self.base_path} error: {e}")
+                break
+
+    def oversize(self, size):
+        """
+        whether the live segment should be rotated
+        Args:
+            size: uncompressed bytes of the live segment
+
+        Returns:
+
+        """
+        if self.max_bytes and size >= self.max_bytes:
+            return True
+        return bool(self.max_seconds) and time.monotonic() - self.segment_start >= self.max_seconds
+
+    @staticmethod
+    def rotate_if_oversize(writer, size):
+        if writer.oversize(size):
+            writer.rotate()
+
+    def rotate(self):
+        """
+        close the live segment and rename it to the next numbered segment, called by the writer thread
+        Returns:
+
+        """
+        if self.fsync != "never":
+            self._sync()
+        self.fd.close()
+        self.segment_index += 1
+        target = self.segment_path(self.segment_index)
+        self.live_path.rename(target)
+        if self.stamp_fd is not None:
+            self.stamp_fd.close()
+            self.stamp_path(self.live_path).rename(self.stamp_path(target))
+        log.logger.info(f"capture rotate to {target}")
+        self._open_segment()
+
+    def close(self):
+        """
+        write all pending data and close the live segment
+        Returns:
+
+        """
+        try:
+            self.flush()
+            self._put(None)
+            self.thread.join()
+        finally:
+            self._close_files()
+
+    def _close_files(self):
+        if self.fsync != "never":
+            self._sync()
+        self.fd.close()
+        if self.stamp_fd is not None:
+            self.stamp_fd.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,210 @@
+import ast
+import json
+import os
+from pathlib import Path
+
+from lib.settings import Setting
+
+
+class CaseIndex:
+    """
+    index of the testcases under Setting.CASE_PATH, found by parsing the case files with ast instead of importing them.
+    the parsed classes are cached on disk and a file is parsed again only when its mtime/size and hash change
+    """
+    VERSION = 1
+    BASE_CASE = "BasicTestcase"
+
+    def __init__(self, case_path=None, index_file=None):
+        self.case_path = Path(case_path or Setting.CASE_PATH)
+        self.index_file = Path(index_file or Setting.CASE_INDEX)
+        self.files = {}
+        self.changed = False
+
+    def load(self):
+        try:
+            with open(self.index_file, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == self.VERSION and data.get("case_path") == str(self.case_path):
+            self.files = data["files"]
+
+    def save(self):
+        if not self.changed:
+            return
+        tmp_file = self.index_file.with_name(f"{self.index_file.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"version": self.VERSION, "case_path": str(self.case_path), "files": self.files}, f)
+        # atomic, concurrent invocations never read a half written index
+        os.replace(tmp_file, self.index_file)
+        self.changed = False
+
+    def _walk(self, directory):
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith((".", "__")):
+                    yield from self._walk(entry.path)
+            elif entry.name.endswith(".py") and not entry.name.startswith("__"):
+                yield entry
+
+    @staticmethod
+    def parse(source, file_name="<case>"):
+        """
+        classes of a case file
+        Args:
+            source: file content
+            file_name:
+
+        Returns: list of {name, bases, params, lineno, doc}, params is None if the class has no __init__
+
+        """
+        tree = ast.parse(source, file_name)
+        classes = []
+        for node in tree.body:
+            if not isinstance(node, ast.ClassDef):
+                continue
+            bases = [ast.unparse(base).split(".")[-1] for base in node.bases]
+            params = None
+            for item in node.body:
+                if isinstance(item, ast.FunctionDef) and item.name == "__init__":
+                    params = CaseIndex._params(item.args)
+            doc = ast.get_docstring(node) or ""
+            classes.append({"name": node.name, "bases": bases, "params": params, "lineno": node.lineno,
+                            "doc": doc.strip().splitlines()[0] if doc.strip() else ""})
+        return classes
+
+    @staticmethod
+    def _params(args):
+        positional = args.posonlyargs + args.args
+        defaults = [None] * (len(positional) - len(args.defaults)) + list(args.defaults)
+        params = [{"name": a.arg, "default": None if d is None else ast.unparse(d)}
+                  for a, d in zip(positional, defaults) if a.arg != "self"]
+        params += [{"name": a.arg, "default": None if d is None else ast.unparse(d)}
+                   for a, d in zip(args.kwonlyargs, args.kw_defaults)]
+        return params
+
+    def update(self):
+        """
+        parse the new and changed case files, drop the deleted ones
+        Returns: self
+
+        """
+        if not self.files:
+            self.load()
+        seen = set()
+        for entry in self._walk(self.case_path):
+            stat = entry.stat()
+            key = str(Path(entry.path).relative_to(self.case_path))
+            seen.add(key)
+            cached = self.files.get(key)
+            if cached and cached["mtime"] == stat.st_mtime_ns and cached["size"] == stat.st_size:
+                continue
+            with open(entry.path, "rb") as f:
+                source = f.read()
+            # hashlib loads openssl, only imported when a file has changed
+            import hashlib
+
+            digest = hashlib.sha1(source).hexdigest()
+            if cached is None or cached["hash"] != digest:
+                try:
+                    classes, error = self.parse(source, entry.path), None
+                except SyntaxError as e:
+                    classes, error = [], str(e)
+                cached = {"classes": classes, "error": error}
+            cached.update(mtime=stat.st_mtime_ns, size=stat.st_size, hash=digest)
+            self.files[key] = cached
+            self.changed = True
+        for key in set(self.files) - seen:
+            self.files.pop(key)
+            self.changed = True
+        self.save()
+        return self
+
+    def cases(self):
+        """
+        subclasses of BasicTestcase, directly or through other case classes
+        Returns: list of {name, file, module, params, lineno, doc}
+
+        """
+        classes = {}
+        for key, info in self.files.items():
+            for cls in info["classes"]:
+                classes.setdefault(cls["name"], []).append((key, cls))
+        case_names = {self.BASE_CASE}
+        while True:
+            found = {name for name, defs in classes.items()
+                     if name not in case_names and any(set(cls["bases"]) & case_names for _, cls in defs)}
+            if not found:
+                break
+            case_names |= found
+        cases = []
+        for name in sorted(case_names - {self.BASE_CASE}):
+            for key, cls in classes[name]:
+                file_path = self.case_path.joinpath(key)
+                cases.append({"name": name, "file": str(file_path), "module": self.path_to_module(file_path),
+                              "params": self._resolve_params(cls, classes), "lineno": cls["lineno"],
+                              "doc": cls["doc"]})
+        return cases
+
+    def _resolve_params(self, cls, classes, depth=0):
+        if cls["params"] is not None or depth > 20:
+            return cls["params"] or []
+        for base in cls["bases"]:
+            if base == self.BASE_CASE:
+                return [{"name": "sn", "default": "''"}]
+            if base in classes:
+                return self._resolve_params(classes[base][0][1], classes, depth + 1)
+        return []
+
+    @staticmethod
+    def path_to_module(case_path):
+        """
+        Convert case path to module
+        Args:
+            case_path: case file path, absolute or relative to project root
+
+        Returns: dotted module path relative to project root, eg: case.storage.test_dd
+
+        """
+        if case_path is None:
+            return None
+        path = Path(case_path)
+        if path.suffix != ".py":
+            # already a module path
+            return str(case_path)
+        if not path.is_absolute():
+            path = Setting.PROJECT_ROOT.joinpath(path)
+        module_path = path.resolve().relative_to(Setting.PROJECT_ROOT.resolve()).with_suffix("")
+        return ".".join(module_path.parts)
+
+    def find(self, case_name, case_file=None):
+        """
+        cases named case_name
+        Args:
+            case_name:
+            case_file: only in this file
+
+        Returns: list of case dict
+
+        """
+        found = [case for case in self.cases() if case["name"] == case_name]
+        if case_file is not None:
+            case_file = Path(case_file).resolve()
+            found = [case for case in found if Path(case["file"]).resolve() == case_file]
+        return found
+
+
+if __name__ == '__main__':
+    import time
+
+    t0 = time.perf_counter()
+    index = CaseIndex().update()
+    for case in index.cases():
+        params = ", ".join(p["name"] if p["default"] is None else f"{p['name']}={p['default']}"
+                           for p in case["params"])
+        print(f"{case['module']}.{case['name']}({params})")
+    print(f"{len(index.files)} files indexed in {(time.perf_counter() - t0) * 1000:.1f} ms")
@@ -0,0 +1,66 @@
+"""
+A local stand-in of adb, runs "device" commands with the host shell, for measuring and testing without a device.
+
+usage: python fake_adb.py [-s SN] devices|get-state|shell [cmd]|exec-out cmd|exec-in cmd|push src dst|pull src dst
+
+environment:
+    FAKE_ADB_DEVICES: comma separated sn of the fake devices, default fake0
+    FAKE_ADB_LATENCY: seconds added to every invocation to mimic the adb connection setup
+"""
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+FAKE_ADB = f'"{sys.executable}" "{Path(__file__).resolve()}"'
+
+
+def fake_devices():
+    return [sn for sn in os.environ.get("FAKE_ADB_DEVICES", "fake0").split(",") if sn]
+
+
+def main(argv):
+    latency = float(os.environ.get("FAKE_ADB_LATENCY", "0"))
+    if latency > 0:
+        time.sleep(latency)
+    devices = fake_devices()
+    sn = devices[0] if devices else ""
+    if len(argv) >= 2 and argv[0] == "-s":
+        sn = argv[1]
+        argv = argv[2:]
+        if sn not in devices:
+            print(f"adb: device '{sn}' not found", file=sys.stderr)
+            return 1
+    if not argv:
+        print("adb: no command", file=sys.stderr)
+        return 1
+    command, args = argv[0], argv[1:]
+    if command == "devices":
+        print("List of devices attached")
+        for device in devices:
+            print(f"{device}\tdevice")
+        return 0
+    if command == "get-state":
+        print("device")
+        return 0
+    if command in ("wait-for-device", "root", "unroot", "reboot", "start-server", "kill-server"):
+        return 0
+    if command in ("shell", "exec-out", "exec-in"):
+        sys.stdout.flush()
+        if not args:
+            # interactive shell reading commands from stdin
+            os.execvp("sh", ["sh"])
+        os.execvp("sh", ["sh", "-c", " ".join(args)])
+    if command == "push" and len(args) == 2:
+        shutil.copy(args[0], args[1])
+        return 0
+    if command == "pull" and len(args) == 2:
+        shutil.copy(args[0], args[1])
+        return 0
+    print(f"adb: unknown command {command}", file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,303 @@
+import threading
+import time
+from array import array
+
+from lib.log_tools import log
+from lib.transport import AdbTransport, LocalTransport
+
+# value of a counter missing in a sample, eg: the process is gone
+MISSING = -1
+
+
+class TimeSeries:
+    """
+    time series of integer counters in typed arrays, one array per counter.
+    memory is bounded: when max_samples is reached every other sample is dropped and only every stride-th
+    new sample is kept, so a 24 hour run takes the same memory as a 10 minute one at a coarser resolution.
+    min/max/last are exact over all the samples
+    """
+
+    def __init__(self, max_samples=2048):
+        """
+        Args:
+            max_samples: samples kept per counter
+        """
+        self.max_samples = max(2, max_samples)
+        self.times = array("d")
+        self.names = None
+        self.columns = {}
+        self.stride = 1
+        # samples added, including the dropped ones
+        self.count = 0
+        self.min = {}
+        self.max = {}
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def add(self, t, values):
+        """
+        Args:
+            t: seconds
+            values: {counter: int}, a counter not seen before adds a column, missing in the earlier samples
+
+        Returns:
+
+        """
+        with self.lock:
+            if self.names is None:
+                self.names = []
+            for name in values:
+                if name not in self.columns:
+                    # eg: a process or a vmstat counter appearing during the run
+                    self.names.append(name)
+                    self.columns[name] = array("q", [MISSING]) * len(self.times)
+            self.count += 1
+            for name in self.names:
+                v = values.get(name, MISSING)
+                self.last[name] = v
+                if v != MISSING:
+                    if v < self.min.get(name, v + 1):
+                        self.min[name] = v
+                    if v > self.max.get(name, v - 1):
+                        self.max[name] = v
+            if len(self.times) >= self.max_samples:
+                self._decimate()
+            if (self.count - 1) % self.stride:
+                return
+            self.times.append(t)
+            for name in self.names:
+                self.columns[name].append(values.get(name, MISSING))
+
+    def _decimate(self):
+        del self.times[1::2]
+        for column in self.columns.values():
+            del column[1::2]
+        self.stride *= 2
+
+    def __len__(self):
+        return len(self.times)
+
+    def points(self, name):
+        """
+        Returns: times, values of the kept samples of name without the missing ones
+
+        """
+        with self.lock:
+            column = self.columns[name]
+            pairs = [(t, v) for t, v in zip(self.times, column) if v != MISSING]
+        return [t for t, _ in pairs], [v for _, v in pairs]
+
+    @staticmethod
+    def regression(times, values):
+        """
+        least squares line of values over times
+        Returns: slope per second, r2
+
+        """
+        n = len(values)
+        if n < 2:
+            return 0.0, 0.0
+        mean_t = sum(times) / n
+        mean_v = sum(values) / n
+        sxx = sum((t - mean_t) ** 2 for t in times)
+        syy = sum((v - mean_v) ** 2 for v in values)
+        sxy = sum((t - mean_t) * (v - mean_v) for t, v in zip(times, values))
+        if sxx == 0 or syy == 0:
+            return 0.0, 0.0
+        return sxy / sxx, sxy * sxy / (sxx * syy)
+
+    def summary(self, name):
+        """
+        Returns: {min, max, mean, p50, p95, last, slope_per_hour, r2} of name, percentiles of the kept samples
+
+        """
+        times, values = self.points(name)
+        if not values:
+            return None
+        ordered = sorted(values)
+        slope, r2 = self.regression(times, values)
+        return {"min": self.min.get(name), "max": self.max.get(name), "mean": round(sum(values) / len(values), 2),
+                "p50": ordered[len(ordered) // 2], "p95": ordered[min(len(ordered) - 1, len(ordered) * 95 // 100)],
+                "last": self.last.get(name), "slope_per_hour": round(slope * 3600, 2), "r2": round(r2, 4)}
+
+
+class MemorySampler:
+    """
+    samples /proc/meminfo, /proc/vmstat and /proc/<pid>/smaps_rollup of the target.
+    one shell loop on the target prints all of them every interval, so a tick costs no process spawn or adb round trip
+    """
+    # counters growing in a leak, and counters shrinking in one
+    LEAK_GROWING = ("Pss", "Rss", "Anonymous", "Swap", "SUnreclaim", "Slab", "VmallocUsed", "KernelStack",
+                    "PageTables", "Shmem", "AnonPages")
+    LEAK_SHRINKING = ("MemAvailable", "MemFree")
+
+    def __init__(self, transport=None, interval=1.0, pids=(), vmstat=True, meminfo_keys=None, vmstat_keys=None,
+                 max_samples=2048):
+        """
+        Args:
+            transport: AdbTransport (default) or LocalTransport
+            interval: seconds between samples
+            pids: processes sampled by smaps_rollup, columns are named <pid>.<key>, eg: 1234.Pss
+            vmstat: sample /proc/vmstat too
+            meminfo_keys: meminfo counters to keep, default all
+            vmstat_keys: vmstat counters to keep, default all
+            max_samples: samples kept per counter, see TimeSeries
+        """
+        self.transport = transport or AdbTransport()
+        self.interval = interval
+        self.pids = [int(pid) for pid in pids]
+        self.vmstat = vmstat
+        self.keys = {"meminfo": set(meminfo_keys) if meminfo_keys else None,
+                     "vmstat": set(vmstat_keys) if vmstat_keys else None}
+        self.series = TimeSeries(max_samples)
+        self.stream = None
+        self.thread = None
+        self.t0 = None
+        self.section = None
+        self.values = {}
+
+    def script(self, loop=True):
+        reads = ["echo @@uptime", "cat /proc/uptime", "echo @@meminfo", "cat /proc/meminfo"]
+        if self.vmstat:
+            reads += ["echo @@vmstat", "cat /proc/vmstat"]
+        for pid in self.pids:
+            reads += [f"echo @@pid {pid}", f"cat /proc/{pid}/smaps_rollup"]
+        reads.append("echo @@end")
+        body = "; ".join(reads)
+        return f"while true; do {body}; sleep {self.interval}; done" if loop else body
+
+    def feed(self, line):
+        """
+        parse one output line of the script, a sample is added at each @@end
+        Args:
+            line:
+
+        Returns:
+
+        """
+        if line.startswith("@@"):
+            if line == "@@end":
+                if self.t0 is None:
+                    self.t0 = time.monotonic()
+                self.series.add(time.monotonic() - self.t0, self.values)
+                self.values = {}
+                self.section = None
+            else:
+                self.section = line[2:]
+            return
+        section = self.section
+        if section is None:
+            return
+        if section == "uptime":
+            try:
+                self.values["uptime_ms"] = int(float(line.split()[0]) * 1000)
+            except (ValueError, IndexError):
+                pass
+            return
+        # meminfo and smaps_rollup: "Rss:   1436 kB", vmstat: "nr_free_pages 123"
+        parts = line.replace(":", " ").split()
+        if len(parts) < 2 or not parts[1].isdigit():
+            return
+        key = parts[0]
+        if section.startswith("pid "):
+            key = f"{section[4:]}.{key}"
+        elif self.keys.get(section) is not None and key not in self.keys[section]:
+            return
+        self.values[key] = int(parts[1])
+
+    def sample_once(self):
+        """
+        take one sample by one command
+        Returns: the counters of the sample
+
+        """
+        state, out = self.transport.shell(self.script(loop=False), verbosity=0)
+        for line in out.splitlines():
+            self.feed(line.strip())
+        return {name: self.series.last[name] for name in self.series.names or ()}
+
+    def start(self):
+        """
+        start the sampling loop on the target and a thread parsing its output
+        Returns:
+
+        """
+        self.stream = self.transport.shell_stream(self.script())
+        self.thread = threading.Thread(target=self._read, name="memory_sampler", daemon=True)
+        self.thread.start()
+        log.logger.info(f"memory sampler start, interval {self.interval}s, pids {self.pids}")
+
+    def _read(self):
+        for line in self.stream:
+            self.feed(line.strip())
+
+    def stop(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.thread.join()
+            self.stream = None
+        log.logger.info(f"memory sampler stop, {self.series.count} samples, {len(self.series)} kept")
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def summary(self, names=None):
+        """
+        Args:
+            names: counters, default all
+
+        Returns: {counter: summary dict}, see TimeSeries.summary
+
+        """
+        return {name: self.series.summary(name) for name in names or self.series.names or ()}
+
+    def detect_leaks(self, min_duration=600, min_r2=0.8, kb_per_hour=1024):
+        """
+        counters with a steady trend: growing process/kernel memory, shrinking available memory
+        Args:
+            min_duration: seconds of samples needed before judging
+            min_r2: how well the samples fit a line, 1 is a perfect line
+            kb_per_hour: minimum trend in kB per hour
+
+        Returns: list of {name, slope_per_hour, r2}
+
+        """
+        if len(self.series) < 2 or self.series.times[-1] - self.series.times[0] < min_duration:
+            return []
+        leaks = []
+        for name in self.series.names:
+            key = name.rsplit(".", 1)[-1]
+            sign = 1 if key in self.LEAK_GROWING else (-1 if key in self.LEAK_SHRINKING else 0)
+            if not sign:
+                continue
+            slope, r2 = TimeSeries.regression(*self.series.points(name))
+            if slope * sign * 3600 >= kb_per_hour and r2 >= min_r2:
+                leaks.append({"name": name, "slope_per_hour": round(slope * 3600, 2), "r2": round(r2, 4)})
+        for leak in leaks:
+            log.logger.warning(f"memory leak suspect: {leak}")
+        return leaks
+
+
+if __name__ == '__main__':
+    import subprocess
+    import sys
+    import tracemalloc
+
+    # a local process leaking 1MiB every 50ms, sampled on the host without device
+    leaker = subprocess.Popen([sys.executable, "-c", "import time\na = []\nwhile True:\n"
+                                                    "    a.append(bytearray(1 << 20))\n    time.sleep(0.05)"])
+    tracemalloc.start()
+    sampler = MemorySampler(LocalTransport(), interval=0.05, pids=[leaker.pid], max_samples=64)
+    with sampler:
+        time.sleep(5)
+    leaker.kill()
+    size, peak = tracemalloc.get_traced_memory()
+    print(f"{sampler.series.count} samples of {len(sampler.series.names)} counters, {len(sampler.series)} kept, "
+          f"stride {sampler.series.stride}, host memory {size / 1024:.0f} KiB (peak {peak / 1024:.0f} KiB)")
+    for name in ("MemAvailable", f"{leaker.pid}.Rss", f"{leaker.pid}.Pss"):
+        print(name, sampler.series.summary(name))
+    print(sampler.detect_leaks(min_duration=2))
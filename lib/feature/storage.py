@@ -0,0 +1,263 @@
+import json
+import re
+from collections import namedtuple
+
+from lib.log_tools import log
+from lib.transport import AdbTransport, LocalTransport
+
+# one point of a storage test, rw: read/write/randread/randwrite, block_size/size: bytes or "4k", "64M"...
+# queue_depth: fio iodepth, parallel dd jobs for dd; runtime: seconds, fio only, size is used if None
+Workload = namedtuple("Workload", ["rw", "block_size", "queue_depth", "size", "runtime"],
+                      defaults=(1, "64M", None))
+# throughput: MB/s, latency_us: mean completion latency (dd: average time of one block), p99 from fio only
+StorageResult = namedtuple("StorageResult", ["tool", "rw", "block_size", "queue_depth", "bytes", "seconds",
+                                             "throughput", "iops", "latency_us", "p99_latency_us"])
+
+SIZE_UNITS = {"": 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+# GNU: "67108864 bytes (67 MB, 64 MiB) copied, 0.0405 s, 1.7 GB/s", toybox: "... copied, 0.040 s, 1.5 G/s"
+DD_RESULT = re.compile(rb"(\d+) bytes.*?copied,\s*([\d.]+)\s*s")
+
+
+def parse_size(size):
+    """
+    Args:
+        size: int or str like "4k", "64M", "1G", "512KiB"
+
+    Returns: bytes
+
+    """
+    if isinstance(size, int):
+        return size
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([kmgtb]?)(?:i?b)?\s*", str(size).lower())
+    if m is None:
+        raise ValueError(f"bad size {size}")
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2)])
+
+
+def parse_dd(output):
+    """
+    totals of the dd results in output, several parallel dd jobs are summed
+    Args:
+        output: dd stderr
+
+    Returns: bytes, seconds (the slowest job), None if no dd result
+
+    """
+    found = DD_RESULT.findall(output.encode() if isinstance(output, str) else output)
+    if not found:
+        return None
+    return sum(int(b) for b, _ in found), max(float(s) for _, s in found)
+
+
+def parse_fio(output, rw):
+    """
+    Args:
+        output: fio --output-format=json output, warnings before the json are skipped
+        rw: workload rw, selects the read or write part of the job
+
+    Returns: bytes, seconds, bytes per second, iops, mean latency us, p99 latency us
+
+    """
+    data = json.loads(output[output.index("{"):])
+    side = data["jobs"][0]["read" if "read" in rw else "write"]
+    lat = side.get("clat_ns") or side.get("lat_ns") or {}
+    p99 = lat.get("percentile", {}).get("99.000000", 0)
+    return (side["io_bytes"], side["runtime"] / 1000, side.get("bw_bytes", side["bw"] * 1024), side["iops"],
+            lat.get("mean", 0) / 1000, p99 / 1000)
+
+
+class Storage:
+    """
+    sequential and random read/write workloads by fio (dd for sequential if there is no fio),
+    results are parsed into StorageResult. the work dir, fio and the test file are prepared once per instance,
+    so the points of a sweep only run the workload
+    """
+    RW = ("read", "write", "randread", "randwrite")
+    TEST_FILE = "storage_test.bin"
+
+    def __init__(self, transport=None, work_dir="/data/local/tmp/storage_test", direct=True, tool="auto",
+                 fio_binary=None, ioengine="libaio"):
+        """
+        Args:
+            transport: AdbTransport (default) or LocalTransport
+            work_dir: dir on the storage under test
+            direct: O_DIRECT io, bypass the page cache. tmpfs does not support it
+            tool: auto/fio/dd
+            fio_binary: local fio binary pushed to work_dir if the target has no fio
+            ioengine: fio ioengine
+        """
+        if tool not in ("auto", "fio", "dd"):
+            raise ValueError(f"bad tool {tool}")
+        self.transport = transport or AdbTransport()
+        self.work_dir = str(work_dir).rstrip("/")
+        self.direct = direct
+        self.tool = tool
+        self.fio_binary = fio_binary
+        self.ioengine = ioengine
+        self.fio = None
+        self.prepared = False
+        self.file_size = 0
+        self.results = []
+
+    @property
+    def test_file(self):
+        return f"{self.work_dir}/{self.TEST_FILE}"
+
+    def prepare(self, size=0):
+        """
+        create the work dir, find or push fio, and make the test file at least size bytes.
+        done once, later calls only grow the test file
+        Args:
+            size: bytes
+
+        Returns:
+
+        """
+        if not self.prepared:
+            self.transport.shell(f"mkdir -p {self.work_dir}", verbosity=0)
+            self.fio = self._find_fio()
+            self.prepared = True
+        if size > self.file_size:
+            # reads need data on the storage, written once and reused by every point
+            block = 1024 * 1024
+            state, out = self.transport.shell(self._dd_cmd("write", block, -(-size // block), 1), verbosity=0)
+            if not state:
+                raise RuntimeError(f"create test file {self.test_file} fail: {out}")
+            self.file_size = size
+
+    def _find_fio(self):
+        if self.tool == "dd":
+            return None
+        state, out = self.transport.shell("command -v fio", verbosity=0)
+        if state and out.strip():
+            return out.strip().splitlines()[-1]
+        if self.fio_binary:
+            remote = f"{self.work_dir}/fio"
+            # pushed only if the target does not have it from an earlier run
+            state, _ = self.transport.shell(f"ls {remote}", verbosity=0)
+            if not state:
+                self.transport.push(self.fio_binary, remote)
+                self.transport.shell(f"chmod 755 {remote}", verbosity=0)
+            return remote
+        if self.tool == "fio":
+            raise RuntimeError(f"no fio on the {self.transport.name} target, give fio_binary")
+        log.logger.warning("no fio, random workloads are not supported, sequential ones run by dd")
+        return None
+
+    def _dd_cmd(self, rw, block_size, count, jobs):
+        """
+        jobs parallel dd on separate regions of the test file
+        """
+        commands = []
+        for job in range(jobs):
+            offset = job * count
+            if rw == "write":
+                flags = "oflag=direct conv=notrunc,fsync" if self.direct else "conv=notrunc,fsync"
+                commands.append(f"dd if=/dev/zero of={self.test_file} bs={block_size} count={count} "
+                                f"seek={offset} {flags}")
+            else:
+                flags = "iflag=direct" if self.direct else ""
+                commands.append(f"dd if={self.test_file} of=/dev/null bs={block_size} count={count} "
+                                f"skip={offset} {flags}")
+        if jobs == 1:
+            return f"{commands[0]} 2>&1"
+        return f"({' & '.join(commands)} & wait) 2>&1"
+
+    def _fio_cmd(self, workload, block_size, size):
+        limit = f"--runtime={workload.runtime} --time_based" if workload.runtime else f"--io_size={size}"
+        return (f"{self.fio} --name=swift --filename={self.test_file} --rw={workload.rw} --bs={block_size} "
+                f"--iodepth={workload.queue_depth} --ioengine={self.ioengine} --direct={int(self.direct)} "
+                f"--size={self.file_size} {limit} --group_reporting --output-format=json")
+
+    def run(self, workload, verbosity=1):
+        """
+        run one workload
+        Args:
+            workload: Workload
+            verbosity:
+
+        Returns: StorageResult
+
+        """
+        if workload.rw not in self.RW:
+            raise ValueError(f"bad rw {workload.rw}, one of {self.RW}")
+        block_size = parse_size(workload.block_size)
+        size = parse_size(workload.size)
+        self.prepare(size)
+        timeout = None if workload.runtime is None else workload.runtime * 2 + 60
+        if self.fio is not None:
+            tool = "fio"
+            state, out = self.transport.shell(self._fio_cmd(workload, block_size, size), timeout, verbosity)
+            try:
+                total, seconds, rate, iops, latency, p99 = parse_fio(out, workload.rw)
+            except (ValueError, KeyError, IndexError):
+                raise RuntimeError(f"fio {workload} fail: {out}")
+        else:
+            if workload.rw.startswith("rand"):
+                raise RuntimeError(f"{workload.rw} needs fio on the target")
+            tool = "dd"
+            jobs = max(1, workload.queue_depth)
+            count = max(1, size // block_size // jobs)
+            state, out = self.transport.shell(self._dd_cmd(workload.rw, block_size, count, jobs), timeout,
+                                              verbosity)
+            parsed = parse_dd(out)
+            if not state or parsed is None:
+                raise RuntimeError(f"dd {workload} fail: {out}")
+            total, seconds = parsed
+            seconds = seconds or 1e-9
+            rate = total / seconds
+            iops = total / block_size / seconds
+            latency = seconds / (total / block_size / jobs) * 1e6
+            p99 = None
+        result = StorageResult(tool, workload.rw, block_size, workload.queue_depth, total, round(seconds, 6),
+                               round(rate / 1024 / 1024, 2), round(iops, 1), round(latency, 2),
+                               None if p99 is None else round(p99, 2))
+        log.logger.info(f"{self.transport.name} {result}")
+        self.results.append(result)
+        return result
+
+    def sweep(self, rws=("write", "read"), block_sizes=("4k", "128k", "1M"), queue_depths=(1,), size="64M",
+              runtime=None, verbosity=1):
+        """
+        run every combination of rw, block size and queue depth on the same prepared test file
+        Args:
+            rws:
+            block_sizes:
+            queue_depths:
+            size: bytes of every point
+            runtime: seconds of every point, fio only
+            verbosity:
+
+        Returns: list of StorageResult
+
+        """
+        self.prepare(parse_size(size))
+        return [self.run(Workload(rw, block_size, queue_depth, size, runtime), verbosity)
+                for rw in rws for block_size in block_sizes for queue_depth in queue_depths]
+
+    def cleanup(self):
+        """
+        remove the test file, fio is kept for the next run
+        Returns:
+
+        """
+        self.transport.shell(f"rm -f {self.test_file}", verbosity=0)
+        self.file_size = 0
+
+    @staticmethod
+    def format_results(results):
+        lines = [f"{'tool':<5}{'rw':<10}{'bs':>9}{'qd':>4}{'MB/s':>10}{'iops':>11}{'lat us':>10}{'p99 us':>10}"]
+        for r in results:
+            lines.append(f"{r.tool:<5}{r.rw:<10}{r.block_size:>9}{r.queue_depth:>4}{r.throughput:>10.1f}"
+                         f"{r.iops:>11.0f}{r.latency_us:>10.1f}{'' if r.p99_latency_us is None else r.p99_latency_us:>10}")
+        return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    # no device needed: sequential sweep on tmpfs by the local host
+    storage = Storage(LocalTransport(), work_dir="/dev/shm/storage_test", direct=False)
+    try:
+        print(Storage.format_results(storage.sweep(block_sizes=("4k", "64k", "1M"), queue_depths=(1, 4),
+                                                   size="64M", verbosity=0)))
+    finally:
+        storage.cleanup()
@@ -0,0 +1,543 @@
+"""
+time range queries on huge logs without reading them: ColorLogTool logs (test.log, case.log) with their
+rotated backups .1 ... .5, and uart capture segments (data.0001.txt ... data.txt).
+
+every file is memory mapped, a sparse time -> offset index (one entry per stride bytes) is built by probing
+a few lines at each stride and cached next to the file as .<file>.idx (the leading dot keeps it out of the
+capture segment globs), a query binary searches the index and scans only the lines of the range.
+time going back (kernel time after a reboot, a clock set back) splits the index into runs of increasing time,
+a query is answered from every run, eg: the same seconds since boot of every boot.
+
+usage:
+    python -m lib.log_query log/test.log --from "2026-10-18 12:00:00" --to "2026-10-18 12:05:00" -g "error|fail"
+    python -m lib.log_query log/uart.txt --kernel --from 120.5 --to 130
+    python -m lib.log_query log/case.log --uart log/uart.txt --around "12:03:10" --window 5
+the last one merges the uart lines timed by the capture timestamp sidecar (Serial.log_timestamps) into the log
+"""
+import argparse
+import hashlib
+import heapq
+import json
+import mmap
+import re
+import sys
+import time
+from bisect import bisect_left
+from datetime import datetime
+from pathlib import Path
+
+from lib.capture_writer import read_stamps
+from lib.log_tools import log
+
+
+class LogTimeParser:
+    """
+    timestamp of a ColorLogTool line: "2026-10-18 12:04:11,508 [INFO] ...", seconds since epoch in local time
+    """
+    name = "log"
+
+    def __init__(self):
+        # epoch of "YYYY-MM-DD HH", mktime once per hour of log
+        self.hours = {}
+
+    def __call__(self, line):
+        if len(line) < 23 or line[4] != 45 or line[10] != 32 or line[19] not in (44, 46):
+            return None
+        hour = line[:13]
+        base = self.hours.get(hour)
+        try:
+            if base is None:
+                base = self.hours[hour] = time.mktime((int(line[:4]), int(line[5:7]), int(line[8:10]),
+                                                       int(line[11:13]), 0, 0, 0, 0, -1))
+            return base + int(line[14:16]) * 60 + int(line[17:19]) + int(line[20:23]) / 1000
+        except ValueError:
+            return None
+
+
+class RegexTimeParser:
+    """
+    timestamp as seconds from the first group of a regex at the line start,
+    eg: kernel messages "[  123.456789] ..." or "<6>[  123.456789] ..." in seconds since boot
+    """
+
+    def __init__(self, pattern=rb"(?:<\d+>)?\[\s*(\d+\.\d+)\]", name="kernel", reset_hint=rb"\[ {4}\d\.\d{6}\]"):
+        """
+        Args:
+            pattern: regex of the line start, the first group is the seconds
+            name: name of the parser in the cached index
+            reset_hint: regex found in the lines where the time may restart, checked in the whole file so that
+                every restart is found, not only those seen between two index entries. default the kernel
+                times below 10s, every boot starts with them. None to only compare the index entries
+        """
+        self.name = name
+        self.regex = re.compile(pattern)
+        self.reset_hint = None if reset_hint is None else re.compile(reset_hint)
+
+    def __call__(self, line):
+        m = self.regex.match(line)
+        return float(m.group(1)) if m else None
+
+
+def parse_time(value):
+    """
+    Args:
+        value: seconds as number/str, or "YYYY-MM-DD HH:MM:SS[,fff]" / "HH:MM:SS" (today) in local time
+
+    Returns: seconds
+
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    value = value.replace(",", ".")
+    for fmt in ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%H:%M:%S.%f", "%H:%M:%S"):
+        try:
+            t = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if not fmt.startswith("%Y"):
+            t = datetime.combine(datetime.now().date(), t.time())
+        return t.timestamp()
+    raise ValueError(f"bad time {value}")
+
+
+class LogFile:
+    """
+    one memory mapped log file and its sparse time index
+    """
+    # version of the cached index format
+    INDEX_VERSION = 2
+    # a line this many seconds before the line before it starts a new run, eg: kernel time after a reboot
+    back_step = 1.0
+
+    def __init__(self, path, parser=None, stride=1024 * 1024, probe=64 * 1024, cache=True):
+        """
+        Args:
+            path:
+            parser: callable(line bytes) -> seconds or None, default LogTimeParser
+            stride: bytes between index entries
+            probe: max bytes read at a stride to find a line with a timestamp
+            cache: save/load the index as .<name>.idx next to the file
+        """
+        self.path = Path(path)
+        self.parser = parser or LogTimeParser()
+        self.stride = stride
+        self.probe = probe
+        self.cache = cache
+        self.times = []
+        self.offsets = []
+        # index positions where a run of increasing time starts, the first run starts at 0
+        self.runs = [0]
+        self.last_time = None
+        self.size = 0
+        self.mm = None
+        self.fd = None
+
+    @property
+    def index_path(self):
+        return self.path.with_name(f".{self.path.name}.idx")
+
+    def open(self):
+        if self.mm is not None:
+            return self
+        self.fd = open(self.path, "rb")
+        self.size = self.path.stat().st_size
+        # an empty file can not be mapped
+        self.mm = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self._load_index()
+        return self
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+        if self.fd is not None:
+            self.fd.close()
+        self.mm = self.fd = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def first_time(self):
+        return self.times[0] if self.times else None
+
+    def _head_hash(self):
+        return hashlib.sha1(self.mm[:4096]).hexdigest()
+
+    def _load_index(self):
+        start = 0
+        if self.cache and self.index_path.is_file():
+            try:
+                data = json.loads(self.index_path.read_text(encoding="utf-8"))
+                valid = (data["version"] == self.INDEX_VERSION and data["parser"] == self.parser.name
+                         and data["stride"] == self.stride and data["size"] <= self.size
+                         and data["head"] == self._head_hash())
+            except (OSError, ValueError, KeyError):
+                valid = False
+            if valid:
+                self.times, self.offsets, self.runs = data["times"], data["offsets"], data["runs"]
+                if data["size"] == self.size:
+                    self.last_time = data["last_time"]
+                    return
+                # the file grew, index the new part only
+                start = self.offsets[-1] + 1 if self.offsets else 0
+        self._build(start)
+        if self.cache:
+            try:
+                self.index_path.write_text(json.dumps(
+                    {"version": self.INDEX_VERSION, "parser": self.parser.name, "stride": self.stride,
+                     "size": self.size, "head": self._head_hash(), "last_time": self.last_time,
+                     "times": self.times, "offsets": self.offsets, "runs": self.runs}), encoding="utf-8")
+            except OSError:
+                pass
+
+    def _line_start(self, pos):
+        if pos <= 0:
+            return 0
+        nl = self.mm.find(b"\n", pos - 1)
+        return self.size if nl < 0 else nl + 1
+
+    def _first_timed_line(self, pos, limit):
+        """
+        Returns: time, offset of the first line with a timestamp in [pos, limit), None if no such line
+
+        """
+        while pos < limit:
+            end = self.mm.find(b"\n", pos)
+            end = self.size if end < 0 else end
+            t = self.parser(self.mm[pos:min(end, pos + 64)])
+            if t is not None:
+                return t, pos
+            pos = end + 1
+        return None
+
+    def _build(self, start=0):
+        t0 = time.perf_counter()
+        if start == 0:
+            self.times, self.offsets, self.runs = [], [], [0]
+        entries = {}
+        for pos in range(start - start % self.stride, self.size, self.stride):
+            line = self._line_start(pos)
+            found = self._first_timed_line(line, min(self.size, line + self.probe))
+            if found is not None and (not self.offsets or found[1] > self.offsets[-1]):
+                entries[found[1]] = found[0]
+        resets = self._hinted_resets(start)
+        entries.update(resets)
+        for offset in sorted(entries):
+            t = entries[offset]
+            if offset not in resets and self.times and t < self.times[-1] - self.back_step:
+                # a run starts between the two entries, index its first line so no run holds lines of another
+                hit = self._run_start(self.offsets[-1], offset)
+                if hit is not None and hit[1] < offset:
+                    self.runs.append(len(self.times))
+                    self.times.append(hit[0])
+                    self.offsets.append(hit[1])
+                else:
+                    resets[offset] = t
+            if offset in resets and self.times:
+                self.runs.append(len(self.times))
+            self.times.append(t)
+            self.offsets.append(offset)
+        # the last timestamp, probing backwards from the end
+        self.last_time = self.times[-1] if self.times else None
+        pos = self.size
+        while pos > 0:
+            begin = self._line_start(max(0, pos - self.probe))
+            if begin >= pos:
+                begin = max(0, pos - self.probe)
+            found, offset = None, begin
+            while (hit := self._first_timed_line(offset, pos)) is not None:
+                found, offset = hit, self._line_start(hit[1] + 1)
+            if found is not None:
+                self.last_time = found[0]
+                break
+            pos = begin
+        cost = time.perf_counter() - t0
+        if cost > 1:
+            log.logger.info(f"index {self.path} {self.size / 1024 / 1024:.0f}MiB in {cost:.1f}s")
+
+    def _run_start(self, begin, end):
+        """
+        Returns: time, offset of the first line in [begin, end] going back more than back_step, None if not found
+
+        """
+        prev = None
+        while (hit := self._first_timed_line(begin, end + 1)) is not None:
+            if prev is not None and hit[0] < prev - self.back_step:
+                return hit
+            prev = hit[0]
+            begin = self._line_start(hit[1] + 1)
+        return None
+
+    def _hinted_resets(self, start):
+        """
+        lines from start matching the reset_hint of the parser and going back more than back_step
+        Returns: {offset: time}
+
+        """
+        hint = getattr(self.parser, "reset_hint", None)
+        resets = {}
+        if hint is None:
+            return resets
+        last = -1
+        for m in hint.finditer(self.mm, start):
+            begin = self.mm.rfind(b"\n", 0, m.start()) + 1
+            if begin == last:
+                continue
+            last = begin
+            t = self.parser(self.mm[begin:begin + 64])
+            prev = self._prev_time(begin) if t is not None else None
+            if prev is not None and t < prev - self.back_step:
+                resets[begin] = t
+        return resets
+
+    def _prev_time(self, pos):
+        """
+        Returns: time of the last line with a timestamp before the line at pos, within probe bytes
+
+        """
+        limit = max(0, pos - self.probe)
+        while pos > limit:
+            begin = self.mm.rfind(b"\n", 0, pos - 1) + 1
+            t = self.parser(self.mm[begin:min(pos, begin + 64)])
+            if t is not None:
+                return t
+            pos = begin
+        return None
+
+    def overlaps(self, t1, t2, slack=1.0):
+        """
+        whether the file may have lines in [t1, t2], files of several runs always may
+        """
+        self.open()
+        if len(self.runs) > 1:
+            return True
+        if t1 is not None and self.last_time is not None and self.last_time < t1 - slack:
+            return False
+        return t2 is None or self.first_time is None or self.first_time <= t2 + slack
+
+    def lines(self, t1=None, t2=None, pattern=None, slack=1.0):
+        """
+        lines of the records in [t1, t2], lines without timestamp belong to the record before them
+        Args:
+            t1: seconds, None from the start
+            t2: seconds, None to the end
+            pattern: regex str/bytes or compiled bytes regex, only matching lines are returned
+            slack: seconds of out-of-order timestamps tolerated, eg: records of threads logged out of order
+
+        Returns: iterator of (time, offset, line str), run by run in file order
+
+        """
+        self.open()
+        if not self.size:
+            return
+        if isinstance(pattern, str):
+            pattern = pattern.encode()
+        if isinstance(pattern, bytes):
+            pattern = re.compile(pattern)
+        bounds = self.runs + [len(self.times)]
+        for lo, hi in zip(bounds, bounds[1:]):
+            # the first run also has the lines before the first index entry
+            pos = self.offsets[lo] if lo else 0
+            stop = self.offsets[hi] if hi < len(self.offsets) else self.size
+            if t1 is not None and hi > lo:
+                i = bisect_left(self.times, t1 - slack, lo, hi) - 1
+                if i >= lo:
+                    pos = self.offsets[i]
+            yield from self._scan(pos, stop, t1, t2, pattern, slack)
+
+    def _scan(self, pos, stop, t1, t2, pattern, slack):
+        mm, parser = self.mm, self.parser
+        current = None
+        while pos < stop:
+            end = mm.find(b"\n", pos, stop)
+            end = stop if end < 0 else end
+            line = mm[pos:end]
+            t = parser(line[:64])
+            if t is not None:
+                current = t
+                if t2 is not None and t > t2 + slack:
+                    return
+            if (current is not None and (t1 is None or current >= t1) and (t2 is None or current <= t2)
+                    and (pattern is None or pattern.search(line))):
+                yield current, pos, line.rstrip(b"\r").decode("utf-8", errors="replace")
+            pos = end + 1
+
+
+class LogQuery:
+    """
+    queries over a log and its rotated files in time order:
+    test.log.5 ... test.log.1 test.log for ColorLogTool logs, data.0001.txt ... data.txt for uart captures
+    """
+
+    def __init__(self, path, parser=None, stride=1024 * 1024, cache=True):
+        """
+        Args:
+            path: the live log or capture file
+            parser: see LogFile
+            stride: see LogFile
+            cache: see LogFile
+        """
+        self.path = Path(path)
+        self.files = [LogFile(p, parser, stride, cache=cache) for p in self.rotated_files(self.path)]
+
+    @staticmethod
+    def rotated_files(path):
+        """
+        Returns: the files of a log from the oldest to the live one, compressed capture segments are skipped
+
+        """
+        backups = [p for p in path.parent.glob(f"{path.name}.*") if p.suffix[1:].isdigit()]
+        backups.sort(key=lambda p: -int(p.suffix[1:]))
+        segments = sorted(p for p in path.parent.glob(f"{path.stem}.[0-9][0-9][0-9][0-9]{path.suffix}"))
+        return backups + segments + ([path] if path.is_file() else [])
+
+    def query(self, t1=None, t2=None, pattern=None, limit=None, slack=1.0):
+        """
+        Args:
+            t1: seconds or time str, see parse_time
+            t2: seconds or time str
+            pattern: regex, see LogFile.lines
+            limit: max lines returned
+            slack: see LogFile.lines
+
+        Returns: iterator of (time, file name, line)
+
+        """
+        t1 = None if t1 is None else parse_time(t1)
+        t2 = None if t2 is None else parse_time(t2)
+        count = 0
+        for f in self.files:
+            if not f.overlaps(t1, t2, slack):
+                continue
+            for t, _, line in f.lines(t1, t2, pattern, slack):
+                yield t, f.path.name, line
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+    def around(self, t, window=30, pattern=None, limit=None):
+        """
+        lines within window seconds before and after t
+        """
+        t = parse_time(t)
+        return self.query(t - window, t + window, pattern, limit)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+
+def uart_lines(path, t1=None, t2=None, pattern=None):
+    """
+    lines of a uart capture and its segments timed by their timestamp sidecars, see CaptureWriter.stamp.
+    a line gets the host time of the chunk its first byte was received in
+    Args:
+        path: live capture file
+        t1: seconds or time str, see parse_time
+        t2: seconds or time str
+        pattern: regex str/bytes of the lines
+
+    Returns: iterator of (time, file name, line)
+
+    """
+    t1 = None if t1 is None else parse_time(t1)
+    t2 = None if t2 is None else parse_time(t2)
+    if isinstance(pattern, str):
+        pattern = pattern.encode()
+    if isinstance(pattern, bytes):
+        pattern = re.compile(pattern)
+    for segment in LogQuery.rotated_files(Path(path)):
+        offsets, _, walls = read_stamps(segment)
+        if not offsets:
+            log.logger.warning(f"{segment} has no timestamp sidecar, skipped")
+            continue
+        walls = [w / 1e9 for w in walls]
+        if (t1 is not None and walls[-1] < t1 - 1) or (t2 is not None and walls[0] > t2):
+            continue
+        with open(segment, "rb") as fd:
+            size = Path(segment).stat().st_size
+            if not size:
+                continue
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                k = 0 if t1 is None else max(0, bisect_left(walls, t1) - 1)
+                pos = mm.rfind(b"\n", 0, offsets[k]) + 1
+                while pos < size:
+                    end = mm.find(b"\n", pos)
+                    end = size if end < 0 else end
+                    while k + 1 < len(offsets) and offsets[k + 1] <= pos:
+                        k += 1
+                    t = walls[k]
+                    if t2 is not None and t > t2:
+                        break
+                    line = mm[pos:end]
+                    if (t1 is None or t >= t1) and (pattern is None or pattern.search(line)):
+                        yield t, segment.name, line.rstrip(b"\r").decode("utf-8", errors="replace")
+                    pos = end + 1
+
+
+def merge(log_path=None, uart_paths=(), t1=None, t2=None, pattern=None):
+    """
+    lines of a ColorLogTool log (eg: case.log) and uart captures in one time ordered stream
+    Args:
+        log_path: log file, its rotated backups are included
+        uart_paths: live capture files with timestamp sidecars
+        t1: seconds or time str, see parse_time
+        t2: seconds or time str
+        pattern: regex of the lines
+
+    Returns: iterator of (time, file name, line)
+
+    """
+    streams = [uart_lines(path, t1, t2, pattern) for path in uart_paths]
+    if log_path is not None:
+        streams.append(LogQuery(log_path).query(t1, t2, pattern))
+    return heapq.merge(*streams, key=lambda item: item[0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("log query")
+    parser.add_argument("path", help="live log or capture file, rotated files are included")
+    parser.add_argument("--from", dest="t1", help="start time, 'YYYY-MM-DD HH:MM:SS[,fff]', 'HH:MM:SS' or seconds")
+    parser.add_argument("--to", dest="t2", help="end time")
+    parser.add_argument("--around", help="time, lines within --window seconds of it")
+    parser.add_argument("--window", type=float, default=30)
+    parser.add_argument("-g", dest="pattern", help="regex of the lines")
+    parser.add_argument("-n", dest="limit", type=int, help="max lines")
+    parser.add_argument("--kernel", action="store_true", help="kernel '[ 123.456]' timestamps, seconds since boot")
+    parser.add_argument("--uart", nargs="+", default=(), help="uart captures with timestamp sidecar merged in")
+    args = parser.parse_args(argv)
+
+    if args.uart:
+        t1, t2 = args.t1, args.t2
+        if args.around:
+            t = parse_time(args.around)
+            t1, t2 = t - args.window, t + args.window
+        for count, (t, name, line) in enumerate(merge(args.path, args.uart, t1, t2, args.pattern)):
+            if args.limit is not None and count >= args.limit:
+                break
+            print(f"{datetime.fromtimestamp(t).strftime('%H:%M:%S.%f')[:-3]} {name}: {line}")
+        return 0
+
+    query = LogQuery(args.path, RegexTimeParser() if args.kernel else None)
+    try:
+        if args.around:
+            lines = query.around(args.around, args.window, args.pattern, args.limit)
+        else:
+            lines = query.query(args.t1, args.t2, args.pattern, args.limit)
+        multi = len(query.files) > 1
+        for _, name, line in lines:
+            print(f"{name}: {line}" if multi else line)
+    finally:
+        query.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,19 +1,150 @@
+import atexit
+import contextvars
 import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from logging import handlers
 from pathlib import Path
 
-import colorlog
-
+from lib.result_store import ResultStore
 from lib.settings import Setting
 
+# case log file of the running case, records are routed to it by CaseLogRouter in async mode
+case_log_var = contextvars.ContextVar("case_log", default=None)
+# case logs of the cases running in this process, the latest one gets the records of threads that do not
+# carry the context, eg: threads started by the case, as the case handler does in sync mode
+active_case_logs = []
+
+
+class RateLimitedStreamHandler(logging.StreamHandler):
+    """
+    console handler printing at most rate records per second, rate None prints all,
+    warnings, errors and records logged with extra={"force_console": True} are always printed
+    """
+
+    def __init__(self, rate=None):
+        super().__init__()
+        self.rate = rate
+        self.window = 0
+        self.count = 0
+        self.suppressed = 0
+
+    def emit(self, record):
+        if self.rate and record.levelno < logging.WARNING and not getattr(record, "force_console", False):
+            window = int(time.monotonic())
+            if window != self.window:
+                self.window = window
+                self.count = 0
+            self.count += 1
+            if self.count > self.rate:
+                self.suppressed += 1
+                return
+        if self.suppressed:
+            self.stream.write(f"... {self.suppressed} records not printed to console, see log file{self.terminator}")
+            self.suppressed = 0
+        super().emit(record)
+
+
+class CaseContextFilter(logging.Filter):
+    """
+    tag records with the case log of the running case, or of the latest case running in this process
+    """
+
+    def filter(self, record):
+        case_log = case_log_var.get()
+        if case_log is None and active_case_logs:
+            try:
+                case_log = active_case_logs[-1]
+            except IndexError:
+                # the case ended meanwhile
+                pass
+        record.case_log = case_log
+        return True
+
+
+class LogQueueHandler(handlers.QueueHandler):
+    """
+    queue handler with a cheaper prepare, records stay in this process so no copy and no formatting is needed
+    """
+
+    def prepare(self, record):
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        return record
+
+
+class CaseLogRouter(logging.Handler):
+    """
+    write records tagged with case_log to the case log file, keeps a few case log files open
+    """
+
+    def __init__(self, formatter, max_open=8):
+        super().__init__()
+        self.setFormatter(formatter)
+        self.max_open = max_open
+        self.case_handlers = OrderedDict()
+
+    def emit(self, record):
+        case_log = getattr(record, "case_log", None)
+        if case_log is None:
+            return
+        handler = self.case_handlers.get(case_log)
+        if handler is None:
+            handler = rotating_file_handler(case_log)
+            handler.setFormatter(self.formatter)
+            self.case_handlers[case_log] = handler
+            if len(self.case_handlers) > self.max_open:
+                self.case_handlers.popitem(last=False)[1].close()
+        else:
+            self.case_handlers.move_to_end(case_log)
+        handler.handle(record)
+
+    def close_case(self, case_log):
+        handler = self.case_handlers.pop(case_log, None)
+        if handler is not None:
+            handler.close()
+
+    def close(self):
+        for handler in self.case_handlers.values():
+            handler.close()
+        self.case_handlers.clear()
+        super().close()
+
+
+class LogListener(handlers.QueueListener):
+    """
+    background listener of async mode, also handles the markers closing case log files
+    """
+
+    def __init__(self, log_queue, router, *log_handlers):
+        super().__init__(log_queue, *log_handlers, respect_handler_level=True)
+        self.router = router
+
+    def handle(self, record):
+        done = getattr(record, "log_marker", None)
+        if done is not None:
+            if record.case_log is not None:
+                self.router.close_case(record.case_log)
+            done.set()
+            return
+        super().handle(record)
+
 
 class ColorLogTool:
     """
     Logging utility, supports outputting color logs to the console.
+    In async mode the caller only puts records into a queue, a background listener formats and writes them.
     """
     __instances = {}
 
-    def __init__(self, log_file=None, level=logging.INFO):
+    def __init__(self, log_file=None, level=logging.INFO, async_mode=None):
+        if getattr(self, "logger", None) is not None:
+            # singleton of log_file, already initialized
+            return
         Setting.LOG_PATH.mkdir(parents=True, exist_ok=True)
         log_file = log_file or 'test.log'
 
@@ -28,18 +159,17 @@ class ColorLogTool:
             "CRITICAL": "bold_red",
         }
 
+        # colorlog is imported with the first log instead of with every lib module
+        import colorlog
+
         fmt = "%(asctime)s [%(levelname)s] %(funcName)s %(filename)s:%(lineno)s %(message)s"
         console_fmt = f'%(log_color)s{fmt}'
 
+        self.log_file = log_file
         # 到这步会创建日志文件
-        file_handler = logging.handlers.RotatingFileHandler(
-            filename=Setting.LOG_PATH.joinpath(log_file),
-            mode='a',
-            maxBytes=10 * 1024 * 1024,
-            backupCount=5,
-            encoding='utf-8'
-        )
-        console_handler = logging.StreamHandler()
+        file_handler = rotating_file_handler(Setting.LOG_PATH.joinpath(log_file))
+        # the rate limit is set by enable_async, the default synchronous console prints every record
+        console_handler = RateLimitedStreamHandler()
 
         self.file_formatter = logging.Formatter(fmt)
         console_formatter = colorlog.ColoredFormatter(
@@ -50,8 +180,109 @@ class ColorLogTool:
 
         console_handler.setLevel(level)
 
-        self.logger.addHandler(file_handler)
-        self.logger.addHandler(console_handler)
+        self.file_handler = file_handler
+        self.console_handler = console_handler
+        self.handlers = [file_handler, console_handler]
+        self.router = CaseLogRouter(self.file_formatter)
+        self.queue = None
+        self.queue_handler = None
+        self.listener = None
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+        if Setting.log_async if async_mode is None else async_mode:
+            self.enable_async()
+
+    @property
+    def async_mode(self):
+        return self.listener is not None
+
+    def enable_async(self):
+        """
+        move handlers to a background listener, the logging calls only put records into a queue
+        Returns:
+
+        """
+        if self.async_mode:
+            return
+        self.queue = queue.SimpleQueue()
+        self.queue_handler = LogQueueHandler(self.queue)
+        self.queue_handler.addFilter(CaseContextFilter())
+        for handler in self.handlers:
+            self.logger.removeHandler(handler)
+        self.logger.addHandler(self.queue_handler)
+        self.console_handler.rate = Setting.log_console_rate
+        self.listener = LogListener(self.queue, self.router, *self.handlers, self.router)
+        self.listener.start()
+        atexit.register(self.disable_async)
+
+    def _restart_listener(self):
+        """
+        the listener thread does not survive fork, start a new one in the child process
+        Returns:
+
+        """
+        if not self.async_mode:
+            return
+        self.queue = queue.SimpleQueue()
+        self.queue_handler.queue = self.queue
+        self.listener = LogListener(self.queue, self.router, *self.handlers, self.router)
+        self.listener.start()
+
+    def disable_async(self):
+        """
+        write all queued records and move handlers back to the logger
+        Returns:
+
+        """
+        if not self.async_mode:
+            return
+        self.logger.removeHandler(self.queue_handler)
+        self.listener.stop()
+        self.router.close()
+        self.listener = None
+        self.console_handler.rate = None
+        for handler in self.handlers:
+            self.logger.addHandler(handler)
+        atexit.unregister(self.disable_async)
+
+    def flush(self, case_log=None, timeout=10):
+        """
+        wait until the queued records are written in async mode
+        Args:
+            case_log: also close the case log file
+            timeout:
+
+        Returns:
+
+        """
+        if not self.async_mode:
+            return
+        done = threading.Event()
+        self.queue.put(logging.makeLogRecord({"log_marker": done, "case_log": case_log}))
+        done.wait(timeout)
+
+    def replace_handler(self, old, new):
+        """
+        replace or remove (new is None) a handler of the log in both modes
+        Args:
+            old:
+            new:
+
+        Returns:
+
+        """
+        self.flush()
+        index = self.handlers.index(old)
+        if new is None:
+            self.handlers.pop(index)
+        else:
+            self.handlers[index] = new
+        if self.async_mode:
+            self.listener.handlers = (*self.handlers, self.router)
+        else:
+            self.logger.removeHandler(old)
+            if new is not None:
+                self.logger.addHandler(new)
 
     def __new__(cls, *args, **kwargs):
         log_file_value = str(args[0] if args != () else kwargs.get("log_file", "test.log"))
@@ -63,28 +294,126 @@ class ColorLogTool:
         return instance
 
 
-def add_handler_to_case(instance):
+class LazyColorLogTool:
     """
-    Adding separate logs for each case
+    the global log, the ColorLogTool with its log file and handlers is created on first use,
+    so importing the lib modules (eg: run_in_cmd.py -h or -l) has no side effect
+    """
+
+    def __init__(self, *args, **kwargs):
+        object.__setattr__(self, "_init_args", (args, kwargs))
+        object.__setattr__(self, "_tool", None)
+
+    @property
+    def created(self):
+        return self._tool is not None
+
+    def get(self):
+        """
+        the ColorLogTool, created on the first call
+        Returns:
+
+        """
+        if self._tool is None:
+            args, kwargs = self._init_args
+            object.__setattr__(self, "_tool", ColorLogTool(*args, **kwargs))
+        return self._tool
+
+    def after_fork(self):
+        if self._tool is not None:
+            self._tool._restart_listener()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.get(), name, value)
+
+
+def rotating_file_handler(filename):
+    """
+    rotating file handler shared by the global log and case logs
     Args:
-        instance:
+        filename:
 
     Returns:
 
     """
-    instance.log_dir.mkdir(parents=True, exist_ok=True)
-    log_file = instance.case_log
-    case_handler = logging.handlers.RotatingFileHandler(
-        filename=log_file,
+    return logging.handlers.RotatingFileHandler(
+        filename=filename,
         mode='a',
         maxBytes=10 * 1024 * 1024,
         backupCount=5,
         encoding='utf-8'
     )
+
+
+def redirect_log(log_dir, console=True):
+    """
+    Move the global log file of this process into log_dir, used by device worker processes
+    Args:
+        log_dir: new directory of the global log file
+        console: keep the console handler or not
+
+    Returns:
+
+    """
+    log_dir = Path(log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    file_handler = rotating_file_handler(log_dir.joinpath(log.log_file))
+    file_handler.setFormatter(log.file_formatter)
+    log.replace_handler(log.file_handler, file_handler)
+    log.file_handler.close()
+    log.file_handler = file_handler
+    # the console may be removed already, eg: in the benchmark suite
+    if not console and log.console_handler in log.handlers:
+        log.replace_handler(log.console_handler, None)
+
+
+@contextmanager
+def case_log_context(instance):
+    """
+    write the logs inside the context to the case log of instance too
+    Args:
+        instance:
+
+    Returns:
+
+    """
+    instance.log_dir.mkdir(parents=True, exist_ok=True)
+    log_file = instance.case_log
+    if log.async_mode:
+        # routed by context in the listener, no handler change on the shared logger
+        token = case_log_var.set(str(log_file))
+        active_case_logs.append(str(log_file))
+        try:
+            yield
+        finally:
+            case_log_var.reset(token)
+            active_case_logs.remove(str(log_file))
+            log.flush(str(log_file))
+        return
+    case_handler = rotating_file_handler(log_file)
     case_handler.setFormatter(log.file_formatter)
     log.logger.addHandler(case_handler)
-    instance.run()
-    log.logger.removeHandler(case_handler)
+    try:
+        yield
+    finally:
+        log.logger.removeHandler(case_handler)
+        case_handler.close()
+
+
+def add_handler_to_case(instance):
+    """
+    Adding separate logs for each case
+    Args:
+        instance:
+
+    Returns:
+
+    """
+    with case_log_context(instance):
+        instance.run()
 
 
 def rename_log_dir(instance):
@@ -99,13 +428,42 @@ def rename_log_dir(instance):
     log_dir_appendix = instance.log_dir_appendix
     log_dir = instance.log_dir
     if log_dir_appendix != "":
-        log_dir.rename(Path(f"{log_dir}{log_dir_appendix}"))
+        target = Path(f"{log_dir}{log_dir_appendix}")
+        log_dir.rename(target)
+        # results saved before the appendix was set, eg: earlier iterations sharing the dir in run_stress,
+        # link the old name
+        for recorded in getattr(instance, "recorded_log_dirs", ()):
+            if recorded != target and not os.path.lexists(recorded):
+                try:
+                    os.symlink(target.name, recorded, target_is_directory=True)
+                except OSError as e:
+                    log.logger.warning(f"link {recorded} to {target.name} fail: {e}")
 
 
-def save_test_result(result, sn):
+def save_test_result(result, sn, **fields):
     """
-    save test result to result file
+    save test result to the result store, the report if Setting.report,
+    and to the legacy result file if Setting.result_txt
+    Args:
+        result: result line, eg: "BasicTestcase pass"
+        sn:
+        **fields: case_name, status, iteration, params, duration, log_dir, see ResultStore.add
+
+    Returns:
+
     """
+    case_name, _, status = result.rpartition(" ")
+    fields.setdefault("case_name", case_name)
+    fields.setdefault("status", status)
+    ResultStore.get().add(sn=sn, result=result, **fields)
+    if Setting.report:
+        # html/urllib are only imported when a result is reported, see bench/import_time.py
+        from lib.report import ReportWriter
+
+        ReportWriter.get(sn).add(fields["case_name"], fields["status"], fields.get("iteration", 1),
+                                 fields.get("params"), fields.get("duration"), fields.get("log_dir"))
+    if not Setting.result_txt:
+        return
     result_file = Setting.PROJECT_ROOT.joinpath(f"result_{sn}.txt")
     if Setting.result_new is False:
         result_file.unlink(missing_ok=True)
@@ -115,7 +473,9 @@ def save_test_result(result, sn):
     Setting.result_new = True
 
 
-log = ColorLogTool()
+log = LazyColorLogTool()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=log.after_fork)
 
 if __name__ == '__main__':
     log.logger.critical('critical')
@@ -123,3 +483,15 @@ if __name__ == '__main__':
     log.logger.warning('warning')
     log.logger.info('info')
     log.logger.debug('debug')
+
+    # records per second of the hot path, the async console is limited to Setting.log_console_rate
+    records = 20000
+    for async_mode in (False, True):
+        log.enable_async() if async_mode else log.disable_async()
+        t0 = time.perf_counter()
+        for i in range(records):
+            log.logger.info(f"benchmark record {i}")
+        cost = time.perf_counter() - t0
+        log.flush()
+        print(f"async={async_mode}: {records / cost:.0f} records/s on the caller thread")
+    log.disable_async()
@@ -2,8 +2,6 @@ import json
 from pathlib import Path
 from typing import Union
 
-from PIL import Image
-
 
 class FileType:
     """
@@ -141,6 +139,9 @@ class Media:
         Returns:
 
         """
+        # PIL is slow to import and only needed here
+        from PIL import Image
+
         with Image.open(image_path) as img:
             width, height = img.size
         return width, height
@@ -0,0 +1,219 @@
+import logging
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from functools import partial
+
+from lib.basic_test_tools import BasicTestTools
+from lib.log_tools import log, redirect_log
+from lib.result_store import ResultStore
+from lib.settings import Setting
+from lib.watchdog import watchdog
+
+
+class ProgressHandler(logging.Handler):
+    """
+    forward log records of a device worker process to the parent process
+    """
+
+    def __init__(self, sn, progress_queue, level=logging.INFO):
+        super().__init__(level)
+        self.sn = sn
+        self.progress_queue = progress_queue
+
+    def emit(self, record):
+        try:
+            self.progress_queue.put((self.sn, "log", record.levelno, record.getMessage()))
+        except Exception:
+            self.handleError(record)
+
+
+def resolve_sn_list(sn_list):
+    """
+    expand "all" to the sn of every attached device
+    Args:
+        sn_list: sn list, or ["all"]
+
+    Returns:
+
+    """
+    if sn_list is None:
+        return [""]
+    if isinstance(sn_list, str):
+        sn_list = [sn_list]
+    if "all" in sn_list:
+        return BasicTestTools.list_devices()
+    return list(dict.fromkeys(sn_list))
+
+
+def _exit_hung(sn, progress_queue, deadline):
+    """
+    on_hang of the watchdog in a device worker: the hung case thread can not be stopped, the worker exits instead
+    and the parent records the device as failed
+    Args:
+        sn:
+        progress_queue:
+        deadline: expired Deadline of the hung case
+
+    Returns:
+
+    """
+    log.logger.error(f"{deadline.name} hung, exit worker {os.getpid()}")
+    store = ResultStore.get()
+    # the hung thread may hold the lock
+    if store.lock.acquire(timeout=5):
+        try:
+            store._flush()
+        except Exception:
+            log.logger.error(traceback.format_exc())
+        finally:
+            store.lock.release()
+    log.flush(timeout=5)
+    progress_queue.put((sn, "exit", logging.ERROR, False))
+    progress_queue.close()
+    progress_queue.join_thread()
+    os._exit(3)
+
+
+def case_passed(result):
+    """
+    Args:
+        result: of run_one, statuses of run_it or StressStats of run_stress
+
+    Returns: True if every run of the case passed, also the exit code of run_in_cmd.py
+
+    """
+    if result is None:
+        return True
+    if hasattr(result, "failures"):
+        return result.failures == 0
+    return all(status == "pass" for status in result)
+
+
+def device_worker(sn, case_file, case_name, times, setting_kwargs, case_kwargs, progress_queue):
+    """
+    run one case on one device in an isolated process,
+    with its own Api, Setting overlay, log directory and result_<sn>.txt
+    Args:
+        sn: device sn
+        case_file: case file path
+        case_name: case class name
+        times: run times
+        setting_kwargs: Setting overlay of this device
+        case_kwargs: parameters of the case
+        progress_queue: queue to stream progress to the parent process
+
+    Returns:
+
+    """
+    for k, v in setting_kwargs.items():
+        setattr(Setting, k, v)
+    Setting.LOG_PATH = Setting.LOG_PATH.joinpath(sn or "default")
+    Setting.case_log_dir = Setting.LOG_PATH
+    Setting.result_new = False
+    redirect_log(Setting.LOG_PATH, console=False)
+    log.logger.addHandler(ProgressHandler(sn, progress_queue))
+    # a case still running hang_grace seconds after its timeout ends the worker
+    watchdog.on_hang = partial(_exit_hung, sn, progress_queue)
+
+    from run import CaseRunner
+    ok = True
+    try:
+        ok = case_passed(CaseRunner(case_file).run_one(case_name, times=times, sn=sn, **case_kwargs))
+    except Exception:
+        log.logger.error(traceback.format_exc())
+        ok = False
+    # the worker exits without atexit handlers
+    ResultStore.get().flush()
+    if Setting.report:
+        from lib.report import ReportWriter
+
+        ReportWriter.get(sn).close()
+    progress_queue.put((sn, "exit", logging.INFO, ok))
+
+
+def run_on_devices(case_file, case_name, sn_list, times=1, jobs=None, **kwargs):
+    """
+    run one case on many devices in parallel, one worker process per device
+    Args:
+        case_file: case file path
+        case_name: case class name
+        sn_list: sn list, or ["all"] for every attached device
+        times: run times on each device
+        jobs: max worker processes at the same time, default one per device
+        **kwargs: Setting overlay and case parameters
+
+    Returns: {sn: True/False}
+
+    """
+    sn_list = resolve_sn_list(sn_list)
+    if not sn_list:
+        log.logger.error("no device to run")
+        return {}
+    setting_keys = Setting.__dict__.keys()
+    setting_kwargs = {k: v for k, v in kwargs.items() if k in setting_keys and v is not None}
+    case_kwargs = {k: v for k, v in kwargs.items() if k not in setting_keys}
+    if Setting.report:
+        from lib.report import run_dir
+
+        # every worker writes its device into the report dir of this run
+        setting_kwargs.setdefault("report_dir", run_dir())
+    jobs = jobs or len(sn_list)
+    log.logger.info(f"run {case_name} on {sn_list} with {jobs} workers")
+
+    progress_queue = multiprocessing.Queue()
+    pending = list(sn_list)
+    running = {}
+    exit_codes = {}
+    case_results = {}
+    t0 = time.time()
+    while pending or running:
+        while pending and len(running) < jobs:
+            sn = pending.pop(0)
+            worker = multiprocessing.Process(
+                target=device_worker, name=f"worker-{sn}",
+                args=(sn, case_file, case_name, times, setting_kwargs, case_kwargs, progress_queue))
+            worker.start()
+            running[sn] = (worker, time.time())
+            log.logger.info(f"[{sn}] worker {worker.pid} start")
+        _handle_progress(progress_queue, case_results, timeout=0.5)
+        for sn, (worker, start) in list(running.items()):
+            if worker.is_alive():
+                continue
+            worker.join()
+            exit_codes[sn] = worker.exitcode
+            log.logger.info(f"[{sn}] worker exit {worker.exitcode}, cost {time.time() - start:.1f}s")
+            running.pop(sn)
+    # records put right before the workers exit
+    while _handle_progress(progress_queue, case_results):
+        pass
+    results = {sn: exit_codes.get(sn) == 0 and case_results.get(sn, False) for sn in sn_list}
+    log.logger.info(f"all workers end, cost {time.time() - t0:.1f}s, results: {results}")
+    return results
+
+
+def _handle_progress(progress_queue, case_results, timeout=None):
+    """
+    print one progress record of workers
+    Args:
+        progress_queue:
+        case_results: {sn: result}, updated by exit records
+        timeout: seconds to wait for a record, None for no waiting
+
+    Returns: True if a record is handled
+
+    """
+    try:
+        if timeout is None:
+            sn, kind, level, payload = progress_queue.get_nowait()
+        else:
+            sn, kind, level, payload = progress_queue.get(timeout=timeout)
+    except queue.Empty:
+        return False
+    if kind == "log":
+        log.logger.log(level, f"[{sn}] {payload}")
+    elif kind == "exit":
+        case_results[sn] = payload
+    return True
@@ -3,11 +3,53 @@ class Platform:
     upper test tools above basic test tools
     """
 
-    def __init__(self):
-        pass
+    def __init__(self, transport=None, sn=""):
+        """
+        Args:
+            transport: Transport, default AdbTransport of sn created on first use
+            sn: device sn
+        """
+        self.sn = sn
+        self._transport = transport
 
-    def pull(self):
-        pass
+    @property
+    def transport(self):
+        if self._transport is None:
+            from lib.transport import AdbTransport
 
-    def push(self):
-        pass
+            self._transport = AdbTransport(self.sn)
+        return self._transport
+
+    def pull(self, remote, local, verify=True, jobs=4, **kwargs):
+        """
+        pull a file or dir, unchanged files are skipped, see FileTransfer
+        Args:
+            remote: file or dir on the device
+            local: local file or dir
+            verify: compare sha256 of the pulled files
+            jobs: parallel streams
+            **kwargs: FileTransfer options
+
+        Returns: TransferStats
+
+        """
+        from lib.transfer import FileTransfer
+
+        return FileTransfer(self.transport, jobs=jobs, **kwargs).pull(remote, local, verify)
+
+    def push(self, local, remote, verify=True, jobs=4, **kwargs):
+        """
+        push a file or dir, unchanged files are skipped, see FileTransfer
+        Args:
+            local: local file or dir
+            remote: file or dir on the device
+            verify: compare sha256 of the pushed files
+            jobs: parallel streams
+            **kwargs: FileTransfer options
+
+        Returns: TransferStats
+
+        """
+        from lib.transfer import FileTransfer
+
+        return FileTransfer(self.transport, jobs=jobs, **kwargs).push(local, remote, verify)
@@ -0,0 +1,177 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from lib.log_tools import log
+from lib.settings import Setting
+
+# commands after which the next boot may have started
+REBOOT_COMMAND = re.compile(r"(^|[\s;&|(])(reboot|reboot-bootloader|sideload|setprop\s+sys\.powerctl)\b")
+# fastboot commands changing the device, the read-only ones such as devices and getvar keep the cache
+FASTBOOT_WRITE_COMMAND = re.compile(r"(^|\s)(flash\S*|erase|format\S*|reboot\S*|set_active|--set-active\S*|oem|"
+                                    r"update|boot|continue|-w|wipe-super|\S+-logical-partition|snapshot-update)(\s|$)")
+# adb errors of a device that is gone, it may come back after a reboot
+ADB_DISCONNECTED = re.compile(r"device .*not found|no devices/emulators found|device offline|device unauthorized")
+
+
+class QueryCache:
+    """
+    results of idempotent adb shell queries of one device, eg: getprop ro.*, uname -r, partition layout.
+    entries expire after their ttl and the least recently used ones are evicted beyond max_entries.
+    everything is dropped when the boot_id of the device changes, a reboot command is sent,
+    or the device can not be reached, so no value is served across a reboot
+    """
+    __caches = {}
+    __caches_lock = threading.Lock()
+
+    def __init__(self, sn="", max_entries=256, boot_check_interval=10.0):
+        """
+        Args:
+            sn:
+            max_entries: LRU size
+            boot_check_interval: seconds, a hit re-reads boot_id when the last check is older than this
+        """
+        self.sn = sn
+        self.max_entries = max_entries
+        self.boot_check_interval = boot_check_interval
+        # {cmd: (expire time, output)}
+        self.entries = OrderedDict()
+        self.boot_id = None
+        self.boot_checked = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, sn=""):
+        """
+        get the cache of sn, shared by all BasicTestTools of the same device
+        """
+        with cls.__caches_lock:
+            cache = cls.__caches.get(sn)
+            if cache is None:
+                cache = cls.__caches[sn] = cls(sn, Setting.query_cache_size, Setting.query_cache_boot_check)
+            return cache
+
+    @classmethod
+    def clear_all(cls):
+        with cls.__caches_lock:
+            for cache in cls.__caches.values():
+                cache.invalidate()
+
+    @staticmethod
+    def ttl_of(cmd, cache=None):
+        """
+        Args:
+            cmd: adb shell command
+            cache: None: cached if cmd starts with one of Setting.cacheable_commands, True/False: force,
+                number: cached with this ttl
+
+        Returns: ttl seconds, 0 if not cached
+
+        """
+        if cache is None:
+            cache = cmd.lstrip().startswith(Setting.cacheable_commands)
+        if cache is True:
+            return Setting.query_cache_ttl
+        return cache or 0
+
+    def invalidate(self, reason=""):
+        with self.lock:
+            if not self.entries and self.boot_id is None:
+                return
+            self.invalidations += 1
+            self.entries.clear()
+            self.boot_id = None
+        if reason:
+            log.logger.info(f"query cache of {self.sn or 'device'} invalidated: {reason}")
+
+    def lookup(self, cmd, read_boot_id):
+        """
+        Args:
+            cmd:
+            read_boot_id: function returning the boot_id of the device, None if it can not be read
+
+        Returns: cached output, None on miss
+
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(cmd)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                return None
+            recheck = now - self.boot_checked > self.boot_check_interval
+        if recheck and not self.check_boot(read_boot_id):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            if cmd not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(cmd)
+            self.hits += 1
+            return entry[1]
+
+    def check_boot(self, read_boot_id):
+        """
+        read boot_id, drop everything when it changed or can not be read
+        Returns: True if the entries are still valid
+
+        """
+        boot_id = read_boot_id()
+        with self.lock:
+            self.boot_checked = time.monotonic()
+            if boot_id is not None and boot_id == self.boot_id:
+                return True
+        self.invalidate("boot_id changed" if boot_id else "device unreachable")
+        with self.lock:
+            self.boot_id = boot_id
+        return False
+
+    def store(self, cmd, output, ttl, read_boot_id):
+        """
+        cache output of cmd, the first entry of a boot reads boot_id
+        """
+        if self.boot_id is None:
+            self.check_boot(read_boot_id)
+            if self.boot_id is None:
+                # device unreachable, nothing is cached
+                return
+        with self.lock:
+            self.entries[cmd] = (time.monotonic() + ttl, output)
+            self.entries.move_to_end(cmd)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"sn": self.sn, "entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 4) if total else 0.0, "evictions": self.evictions,
+                    "invalidations": self.invalidations}
+
+
+if __name__ == '__main__':
+    from lib.basic_test_tools import BasicTestTools
+    from lib.fake_adb import FAKE_ADB
+    # the cache of the tools is lib.query_cache, not this __main__ module
+    from lib.query_cache import QueryCache
+
+    # no device needed: the fake adb runs the queries on the host
+    Setting.ADB = FAKE_ADB
+    tools = BasicTestTools()
+    for cache in (False, True):
+        t0 = time.perf_counter()
+        for _ in range(20):
+            tools.adb_shell("uname -r", verbosity=0, cache=cache)
+            tools.adb_shell("cat /proc/version", verbosity=0, cache=cache)
+        print(f"cache {cache}: {(time.perf_counter() - t0) / 40 * 1000:.2f}ms per query")
+    print(QueryCache.get().stats())
+    tools.adb_exec("reboot", verbosity=0)
+    print(QueryCache.get().stats())
@@ -0,0 +1,403 @@
+"""
+streaming test report in Setting.REPORT_PATH/<run time>/:
+    index.html, summary.json       all devices of the run, merged from the device summaries
+    <sn>/results.jsonl             one json line per case iteration, appended as the case finishes
+    <sn>/page_0001.html ...        the same rows as static html pages of Setting.report_page_size rows
+    <sn>/index.html, summary.json  pass/fail per case, recent failures and the page links of the device
+
+rows are only appended, the indexes hold aggregates per case and are rewritten at most every
+Setting.report_interval seconds, so memory and the cost of one result do not grow with the iterations
+"""
+import atexit
+import html
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pathlib import Path
+from urllib.parse import quote
+
+from lib.settings import Setting
+
+STYLE = ("body{font-family:sans-serif;font-size:13px}table{border-collapse:collapse}"
+         "td,th{border:1px solid #ccc;padding:2px 6px;text-align:left}th{background:#eee}"
+         ".pass{color:#080}.fail{color:#c00}.timeout{color:#c60}.none{color:#888}")
+ROW_HEADER = "<tr><th>#</th><th>time</th><th>case</th><th>iteration</th><th>status</th><th>duration</th>" \
+             "<th>params</th><th>log</th></tr>"
+
+
+def run_dir():
+    """
+    report dir of this run, created on first use and shared with the device worker processes by Setting.report_dir
+    """
+    if Setting.report_dir is None:
+        Setting.report_dir = Setting.REPORT_PATH.joinpath(datetime.now().strftime("%Y%m%d%H%M%S"))
+    return Path(Setting.report_dir)
+
+
+def _href(path, start):
+    """
+    link from a file in start to path, relative so the report dir can be copied together with the logs
+    """
+    try:
+        return quote(Path(os.path.relpath(path, start)).as_posix())
+    except ValueError:
+        # another drive on windows
+        return Path(path).as_uri()
+
+
+def _write_atomic(path, text):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def _page(title, body):
+    return f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{html.escape(title)}</title>' \
+           f'<style>{STYLE}</style></head><body>{body}</body></html>\n'
+
+
+def _status_cells(status_count, total):
+    passed = status_count.get("pass", 0)
+    others = " ".join(f'<span class="{html.escape(k)}">{html.escape(k)} {v}</span>'
+                      for k, v in sorted(status_count.items()) if k != "pass")
+    rate = f"{passed / total:.2%}" if total else "-"
+    return f'<td>{total}</td><td class="pass">{passed}</td><td>{others}</td><td>{rate}</td>'
+
+
+class ReportWriter:
+    """
+    streaming report of one device, add() appends the result to results.jsonl and the current html page
+    """
+    __writers = {}
+    __writers_lock = threading.Lock()
+    # failures kept for the indexes, older ones are still in the pages and results.jsonl
+    recent_failures = 100
+
+    def __init__(self, report_dir, sn="", page_size=500, interval=2.0):
+        """
+        Args:
+            report_dir: report dir of the run, the device writes into report_dir/<sn>
+            sn:
+            page_size: rows of one html page
+            interval: seconds, the indexes are rewritten with the next result after this
+        """
+        self.report_dir = Path(report_dir)
+        self.sn = sn
+        self.dir = self.report_dir.joinpath(sn or "default")
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.page_size = page_size
+        self.interval = interval
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.total = 0
+        self.status_count = {}
+        # {case_name: {"total", "status", "duration", "min", "max", "last_status", "last_log_dir"}}
+        self.cases = {}
+        self.failures = deque(maxlen=self.recent_failures)
+        self.first = None
+        self.last = None
+        self.pages = 0
+        self.page_rows = 0
+        self.page_file = None
+        # {log parent dir: link to it}, the log dirs of a run share a few parents
+        self.log_parents = {}
+        self.last_update = time.monotonic()
+        self.dirty = False
+        self._load()
+        self.jsonl = open(self.dir.joinpath("results.jsonl"), "a", encoding="utf-8", errors="replace")
+        atexit.register(self.close)
+
+    @classmethod
+    def get(cls, sn=""):
+        """
+        writer of sn in the report dir of this run, a forked process gets its own
+        """
+        key = (str(run_dir()), sn, os.getpid())
+        with cls.__writers_lock:
+            writer = cls.__writers.get(key)
+            if writer is None:
+                writer = cls.__writers[key] = cls(key[0], sn, Setting.report_page_size, Setting.report_interval)
+            return writer
+
+    @classmethod
+    def flush_all(cls):
+        with cls.__writers_lock:
+            writers = [w for w in cls.__writers.values() if w.pid == os.getpid()]
+        for writer in writers:
+            writer.flush()
+
+    @classmethod
+    def close_all(cls):
+        """
+        close the writers of this process, the next get() starts new ones
+        """
+        with cls.__writers_lock:
+            keys = [key for key, w in cls.__writers.items() if w.pid == os.getpid()]
+            writers = [cls.__writers.pop(key) for key in keys]
+        for writer in writers:
+            writer.close()
+
+    def _load(self):
+        """
+        continue the report of sn when report_dir is reused, the rows go to a new page
+        """
+        path = self.dir.joinpath("summary.json")
+        if not path.exists():
+            return
+        with open(path, encoding="utf-8") as f:
+            summary = json.load(f)
+        self.total = summary["total"]
+        self.status_count = summary["status"]
+        self.cases = summary["cases"]
+        self.failures.extend(summary["failures"])
+        self.first, self.last = summary["first"], summary["last"]
+        self.pages = summary["pages"]
+
+    def add(self, case_name, status, iteration=1, params=None, duration=None, log_dir=None):
+        """
+        append the result of one case iteration
+        Args:
+            case_name:
+            status: pass, fail, timeout...
+            iteration:
+            params: case parameters
+            duration: seconds
+            log_dir: case log dir, linked from the row
+
+        Returns:
+
+        """
+        now = time.time()
+        row = {"time": now, "case_name": case_name, "sn": self.sn, "iteration": iteration, "status": status,
+               "duration": duration, "params": params or {}, "log_dir": None if log_dir is None else str(log_dir)}
+        with self.lock:
+            self.jsonl.write(json.dumps(row, default=str, ensure_ascii=False) + "\n")
+            self.jsonl.flush()
+            self.total += 1
+            self.first = self.first or now
+            self.last = now
+            self.status_count[status] = self.status_count.get(status, 0) + 1
+            case = self.cases.get(case_name)
+            if case is None:
+                case = self.cases[case_name] = {"total": 0, "status": {}, "duration": 0.0, "min": None, "max": None}
+            case["total"] += 1
+            case["status"][status] = case["status"].get(status, 0) + 1
+            case["last_status"] = status
+            case["last_log_dir"] = row["log_dir"]
+            if duration is not None:
+                case["duration"] += duration
+                case["min"] = duration if case["min"] is None else min(case["min"], duration)
+                case["max"] = duration if case["max"] is None else max(case["max"], duration)
+            self._write_row(row)
+            if status != "pass":
+                self.failures.append(dict(time=now, sn=self.sn, case_name=case_name, iteration=iteration,
+                                          status=status, log_dir=row["log_dir"], page=self.pages))
+            self.dirty = True
+            if time.monotonic() - self.last_update >= self.interval:
+                self._update()
+
+    def _write_row(self, row):
+        if self.page_file is None:
+            self.pages += 1
+            self.page_rows = 0
+            self.page_file = open(self.dir.joinpath(f"page_{self.pages:04d}.html"), "w", encoding="utf-8",
+                                  errors="replace")
+            prev = f'<a href="page_{self.pages - 1:04d}.html">prev</a> ' if self.pages > 1 else ""
+            # the next page may not exist yet, it is created with the next row
+            self.page_file.write(
+                f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{html.escape(self.sn)} '
+                f'page {self.pages}</title><style>{STYLE}</style></head><body>'
+                f'<p><a href="index.html">{html.escape(self.sn or "default")}</a> page {self.pages} {prev}'
+                f'<a href="page_{self.pages + 1:04d}.html">next</a></p><table>{ROW_HEADER}\n')
+        self.page_rows += 1
+        number = (self.pages - 1) * self.page_size + self.page_rows
+        status = html.escape(row["status"])
+        duration = "" if row["duration"] is None else f"{row['duration']:.2f}s"
+        params = json.dumps(row["params"], default=str, ensure_ascii=False)
+        log_link = "" if row["log_dir"] is None else self._log_link(row["log_dir"])
+        self.page_file.write(
+            f'<tr><td>{number}</td><td>{datetime.fromtimestamp(row["time"]).strftime("%Y-%m-%d %H:%M:%S")}</td>'
+            f'<td>{html.escape(row["case_name"])}</td><td>{row["iteration"]}</td>'
+            f'<td class="{status}">{status}</td><td>{duration}</td><td>{html.escape(params[:200])}</td>'
+            f'<td>{log_link}</td></tr>\n')
+        # a browser shows the rows of an unfinished page
+        self.page_file.flush()
+        if self.page_rows >= self.page_size:
+            self._end_page()
+
+    def _log_link(self, log_dir):
+        parent, name = os.path.split(log_dir)
+        href = self.log_parents.get(parent)
+        if href is None:
+            if len(self.log_parents) > 1000:
+                self.log_parents.clear()
+            href = self.log_parents[parent] = _href(parent, self.dir)
+        return f'<a href="{href}/{quote(name)}">{html.escape(name)}</a>'
+
+    def _end_page(self):
+        if self.page_file is not None:
+            self.page_file.write("</table></body></html>\n")
+            self.page_file.close()
+            self.page_file = None
+
+    def summary(self):
+        return {"sn": self.sn, "updated": time.time(), "total": self.total, "status": self.status_count,
+                "first": self.first, "last": self.last, "pages": self.pages, "page_size": self.page_size,
+                "cases": self.cases, "failures": list(self.failures)}
+
+    def _update(self):
+        """
+        rewrite summary.json and index.html of the device and of the run
+        """
+        self.last_update = time.monotonic()
+        self.dirty = False
+        summary = self.summary()
+        _write_atomic(self.dir.joinpath("summary.json"), json.dumps(summary, default=str, ensure_ascii=False))
+        _write_atomic(self.dir.joinpath("index.html"), self._device_index(summary))
+        write_run_index(self.report_dir)
+
+    def _device_index(self, summary):
+        name = html.escape(self.sn or "default")
+        body = [f'<p><a href="../index.html">run</a></p><h3>{name}</h3>',
+                f'<table><tr><th>total</th><th>pass</th><th>other</th><th>pass rate</th></tr>'
+                f'<tr>{_status_cells(summary["status"], summary["total"])}</tr></table>',
+                _cases_table(summary["cases"], self.dir),
+                _failures_table(summary["failures"], self.dir, self.dir),
+                "<h4>pages</h4><p>" + " ".join(f'<a href="page_{i:04d}.html">{i}</a>'
+                                               for i in range(1, summary["pages"] + 1)) + "</p>"]
+        return _page(f"{self.sn} report", "".join(body))
+
+    def flush(self):
+        """
+        rewrite the indexes now if results were added since the last update
+        """
+        with self.lock:
+            if self.dirty:
+                self._update()
+
+    def close(self):
+        with self.lock:
+            if self.jsonl.closed:
+                return
+            self._end_page()
+            self._update()
+            self.jsonl.close()
+
+
+def _cases_table(cases, start):
+    rows = []
+    for case_name, case in sorted(cases.items()):
+        average = f"{case['duration'] / case['total']:.2f}s" if case["total"] else ""
+        last_log = case.get("last_log_dir")
+        last = html.escape(case.get("last_status", ""))
+        if last_log:
+            last = f'<a class="{last}" href="{_href(last_log, start)}">{last}</a>'
+        rows.append(f'<tr><td>{html.escape(case_name)}</td>{_status_cells(case["status"], case["total"])}'
+                    f'<td>{average}</td><td>{last}</td></tr>')
+    return '<h4>cases</h4><table><tr><th>case</th><th>total</th><th>pass</th><th>other</th><th>pass rate</th>' \
+           f'<th>avg duration</th><th>last</th></tr>{"".join(rows)}</table>'
+
+
+def _failures_table(failures, start, device_dir):
+    """
+    Args:
+        failures: failure dicts of summary.json
+        start: dir of the html file
+        device_dir: function sn -> device dir, or the device dir
+
+    Returns:
+
+    """
+    rows = []
+    for failure in reversed(failures):
+        base = device_dir(failure["sn"]) if callable(device_dir) else device_dir
+        status = html.escape(failure["status"])
+        page_file = base.joinpath("page_%04d.html" % failure["page"])
+        page = f'<a href="{_href(page_file, start)}">{failure["page"]}</a>'
+        log_link = "" if not failure["log_dir"] else \
+            f'<a href="{_href(failure["log_dir"], start)}">{html.escape(Path(failure["log_dir"]).name)}</a>'
+        rows.append(f'<tr><td>{datetime.fromtimestamp(failure["time"]).strftime("%Y-%m-%d %H:%M:%S")}</td>'
+                    f'<td>{html.escape(failure["sn"])}</td><td>{html.escape(failure["case_name"])}</td>'
+                    f'<td>{failure["iteration"]}</td><td class="{status}">{status}</td><td>{page}</td>'
+                    f'<td>{log_link}</td></tr>')
+    return '<h4>recent failures</h4><table><tr><th>time</th><th>sn</th><th>case</th><th>iteration</th>' \
+           f'<th>status</th><th>page</th><th>log</th></tr>{"".join(rows)}</table>'
+
+
+def write_run_index(report_dir):
+    """
+    merge the summary.json of every device into report_dir/summary.json and index.html.
+    every device worker calls it, the files are replaced atomically and the last one wins
+    Args:
+        report_dir:
+
+    Returns: merged summary
+
+    """
+    report_dir = Path(report_dir)
+    devices = {}
+    for path in sorted(report_dir.glob("*/summary.json")):
+        try:
+            with open(path, encoding="utf-8") as f:
+                devices[path.parent.name] = json.load(f)
+        except (OSError, ValueError):
+            # being replaced by its writer, it is merged by the next update
+            continue
+    status_count, cases, failures = {}, {}, []
+    for summary in devices.values():
+        for status, count in summary["status"].items():
+            status_count[status] = status_count.get(status, 0) + count
+        for case_name, case in summary["cases"].items():
+            merged = cases.setdefault(case_name, {"total": 0, "status": {}, "duration": 0.0})
+            merged["total"] += case["total"]
+            merged["duration"] += case["duration"]
+            for status, count in case["status"].items():
+                merged["status"][status] = merged["status"].get(status, 0) + count
+        failures.extend(summary["failures"])
+    failures = sorted(failures, key=lambda failure: failure["time"])[-ReportWriter.recent_failures:]
+    total = sum(summary["total"] for summary in devices.values())
+    merged = {"run": report_dir.name, "updated": time.time(), "total": total, "status": status_count,
+              "devices": {name: {k: summary[k] for k in ("sn", "total", "status", "first", "last", "pages")}
+                          for name, summary in devices.items()},
+              "cases": cases, "failures": failures}
+    _write_atomic(report_dir.joinpath("summary.json"), json.dumps(merged, default=str, ensure_ascii=False))
+
+    device_rows = "".join(
+        f'<tr><td><a href="{quote(name)}/index.html">{html.escape(name)}</a></td>'
+        f'{_status_cells(summary["status"], summary["total"])}<td>{summary["pages"]}</td></tr>'
+        for name, summary in devices.items())
+    body = [f"<h3>run {html.escape(report_dir.name)}</h3>",
+            f'<table><tr><th>total</th><th>pass</th><th>other</th><th>pass rate</th></tr>'
+            f'<tr>{_status_cells(status_count, total)}</tr></table>',
+            '<h4>devices</h4><table><tr><th>sn</th><th>total</th><th>pass</th><th>other</th><th>pass rate</th>'
+            f'<th>pages</th></tr>{device_rows}</table>',
+            _cases_table(cases, report_dir),
+            _failures_table(failures, report_dir, lambda sn: report_dir.joinpath(sn or "default"))]
+    _write_atomic(report_dir.joinpath("index.html"), _page(f"run {report_dir.name}", "".join(body)))
+    return merged
+
+
+if __name__ == '__main__':
+    import tempfile
+    import tracemalloc
+
+    # time and memory of a long stress run, the report is left in the temp dir
+    Setting.report_dir = Path(tempfile.mkdtemp(prefix="report_"))
+    writer = ReportWriter.get("demo")
+    iterations = 100000
+    t0 = time.perf_counter()
+    for i in range(1, iterations + 1):
+        if i == iterations // 2:
+            print(f"{i} results: {(time.perf_counter() - t0) / i * 1e6:.1f}us per result")
+            # memory held by the writer does not grow with the second half
+            tracemalloc.start()
+        writer.add(f"Case{i % 5}", "fail" if i % 97 == 0 else "pass", iteration=i, params={"loop": i},
+                   duration=0.01, log_dir=Setting.LOG_PATH.joinpath(f"Case{i % 5}_{i}"))
+    current, peak = tracemalloc.get_traced_memory()
+    print(f"{iterations} results: memory {current / 1024:.0f}KiB, peak {peak / 1024:.0f}KiB")
+    writer.close()
+    print(f"report: {run_dir().joinpath('index.html')}")
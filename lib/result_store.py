@@ -0,0 +1,182 @@
+import atexit
+import json
+import os
+import threading
+import time
+
+from lib.settings import Setting
+
+
+class ResultStore:
+    """
+    embedded test result store on sqlite in WAL mode, safe for several writer processes.
+    results are inserted in batches, the legacy result_<sn>.txt is an optional export
+    """
+    COLUMNS = ("run_time", "case_name", "sn", "product_name", "branch", "iteration", "params", "duration",
+               "status", "log_dir", "result")
+    __instances = {}
+
+    def __init__(self, db_path=None, batch_size=None, flush_interval=1.0):
+        """
+        Args:
+            db_path: sqlite file, default Setting.RESULT_DB
+            batch_size: results buffered before one insert transaction, default Setting.result_batch
+            flush_interval: buffered results older than this are inserted with the next result
+        """
+        self.db_path = str(db_path or Setting.RESULT_DB)
+        self.batch_size = batch_size or Setting.result_batch
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.pid = None
+        self._conn = None
+        atexit.register(self.flush)
+
+    @classmethod
+    def get(cls, db_path=None):
+        """
+        store of db_path shared in this process
+        Args:
+            db_path:
+
+        Returns:
+
+        """
+        key = str(db_path or Setting.RESULT_DB)
+        instance = cls.__instances.get(key)
+        if instance is None:
+            instance = cls.__instances[key] = cls(key)
+        return instance
+
+    @property
+    def conn(self):
+        # a sqlite connection must not cross fork, every process opens its own
+        if self._conn is None or self.pid != os.getpid():
+            import sqlite3
+
+            self.pid = os.getpid()
+            self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA busy_timeout=30000")
+            with self._conn:
+                self._conn.execute(
+                    "CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, run_time REAL, case_name TEXT, "
+                    "sn TEXT, product_name TEXT, branch TEXT, iteration INTEGER, params TEXT, duration REAL, "
+                    "status TEXT, log_dir TEXT, result TEXT)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS idx_case_branch ON results(case_name, branch)")
+                self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sn ON results(sn)")
+        return self._conn
+
+    def add(self, case_name, sn="", status="", iteration=1, params=None, duration=None, log_dir=None,
+            result=None, product_name=None, branch=None):
+        """
+        buffer one result, inserted with the batch
+        Args:
+            case_name:
+            sn:
+            status: pass, fail, timeout...
+            iteration: iteration of run_it
+            params: case parameters
+            duration: seconds
+            log_dir: case log dir
+            result: legacy result line, default "<case_name> <status>"
+            product_name: default Setting.product_name
+            branch: default Setting.branch
+
+        Returns:
+
+        """
+        row = (time.time(), case_name, sn, Setting.product_name if product_name is None else product_name,
+               Setting.branch if branch is None else branch, iteration,
+               json.dumps(params or {}, default=str, ensure_ascii=False), duration, status,
+               None if log_dir is None else str(log_dir), result or f"{case_name} {status}")
+        with self.lock:
+            self.pending.append(row)
+            if len(self.pending) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        rows, self.pending = self.pending, []
+        with self.conn:
+            self.conn.executemany(
+                f"INSERT INTO results ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                rows)
+
+    def query(self, sql, args=()):
+        self.flush()
+        cursor = self.conn.execute(sql, args)
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    @staticmethod
+    def _where(**conditions):
+        clauses = [f"{k} = ?" for k, v in conditions.items() if v is not None]
+        args = [v for v in conditions.values() if v is not None]
+        return (f" WHERE {' AND '.join(clauses)}" if clauses else ""), args
+
+    def pass_rate(self, case_name=None, branch=None, sn=None):
+        """
+        pass rate per case per branch
+        Args:
+            case_name:
+            branch:
+            sn:
+
+        Returns: list of {case_name, branch, total, passed, rate}
+
+        """
+        where, args = self._where(case_name=case_name, branch=branch, sn=sn)
+        return self.query(
+            "SELECT case_name, branch, COUNT(*) AS total, SUM(status = 'pass') AS passed, "
+            f"ROUND(1.0 * SUM(status = 'pass') / COUNT(*), 4) AS rate FROM results{where} "
+            "GROUP BY case_name, branch ORDER BY case_name, branch", args)
+
+    def failing_iterations(self, case_name=None, branch=None, sn=None):
+        """
+        results which are not pass
+        Args:
+            case_name:
+            branch:
+            sn:
+
+        Returns: list of result dict
+
+        """
+        where, args = self._where(case_name=case_name, branch=branch, sn=sn)
+        where = f"{where} AND status != 'pass'" if where else " WHERE status != 'pass'"
+        return self.query(f"SELECT * FROM results{where} ORDER BY id", args)
+
+    def export_text(self, sn, file_path=None, since=None):
+        """
+        export results of sn as the legacy result_<sn>.txt
+        Args:
+            sn:
+            file_path: default PROJECT_ROOT/result_<sn>.txt
+            since: only results after this time.time()
+
+        Returns: file path
+
+        """
+        file_path = file_path or Setting.PROJECT_ROOT.joinpath(f"result_{sn}.txt")
+        rows = self.query("SELECT result FROM results WHERE sn = ? AND run_time >= ? ORDER BY id", (sn, since or 0))
+        with open(file_path, "w", encoding="utf-8", errors="replace") as f:
+            for row in rows:
+                f.write(f"{row['result']}\n")
+        return file_path
+
+
+if __name__ == '__main__':
+    store = ResultStore.get()
+    for row in store.pass_rate():
+        print(f"{row['case_name']} [{row['branch']}] {row['passed']}/{row['total']} {row['rate']:.2%}")
+    for row in store.failing_iterations()[-20:]:
+        print(f"{row['case_name']} {row['sn']} iteration {row['iteration']} {row['status']} {row['log_dir']}")
@@ -0,0 +1,228 @@
+import threading
+
+
+class RingBuffer:
+    """
+    preallocated single-producer single-consumer byte ring buffer.
+    the producer fills it in place by readinto, the consumer reads memoryview slices without copying,
+    incoming data is dropped and counted instead of overwriting unread data when it is full.
+    """
+
+    def __init__(self, capacity=4 * 1024 * 1024, max_read=64 * 1024):
+        """
+        Args:
+            capacity: buffer size in bytes
+            max_read: max bytes of one fill
+        """
+        self.capacity = capacity
+        self.max_read = max_read
+        self.buffer = bytearray(capacity)
+        self.view = memoryview(self.buffer)
+        self.scratch = memoryview(bytearray(max_read))
+        # total bytes written and consumed, positions in buffer are the values modulo capacity
+        self.head = 0
+        self.tail = 0
+        # bytes dropped because the buffer is full, and how many times it happens
+        self.dropped = 0
+        self.overflows = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        # bytes the consumer waits for, the producer only wakes it when they are there
+        self.wanted = 1
+
+    def __len__(self):
+        return self.head - self.tail
+
+    @property
+    def free(self):
+        return self.capacity - (self.head - self.tail)
+
+    def _commit(self, size):
+        with self.cond:
+            self.head += size
+            if self.head - self.tail >= self.wanted:
+                self.cond.notify_all()
+
+    def fill_from(self, readinto, size=None):
+        """
+        read data into the buffer in place
+        Args:
+            readinto: readinto method of a file-like object, eg: serial.Serial().readinto
+            size: bytes wanted, eg: in_waiting of the port
+
+        Returns: bytes read, including the dropped ones
+
+        """
+        size = min(size or self.max_read, self.max_read)
+        free = self.free
+        if free == 0:
+            n = readinto(self.scratch[:size]) or 0
+            if n:
+                self.dropped += n
+                self.overflows += 1
+            return n
+        start = self.head % self.capacity
+        size = min(size, free, self.capacity - start)
+        n = readinto(self.view[start:start + size]) or 0
+        if n:
+            self._commit(n)
+        return n
+
+    def write(self, data):
+        """
+        copy data into the buffer, for producers without readinto
+        Args:
+            data: bytes-like
+
+        Returns: bytes written, the rest is dropped
+
+        """
+        data = memoryview(data)
+        size = min(len(data), self.free)
+        if size < len(data):
+            self.dropped += len(data) - size
+            self.overflows += 1
+        start = self.head % self.capacity
+        first = min(size, self.capacity - start)
+        self.view[start:start + first] = data[:first]
+        if size > first:
+            self.view[:size - first] = data[first:size]
+        if size:
+            self._commit(size)
+        return size
+
+    def peek(self, size=None):
+        """
+        readable data as at most two memoryviews, valid until advance
+        Args:
+            size: max bytes, default all readable data
+
+        Returns: list of memoryview
+
+        """
+        available = self.head - self.tail
+        size = available if size is None else min(size, available)
+        return self.views(self.tail, self.tail + size)
+
+    def views(self, start, end):
+        """
+        data between two stream positions as at most two memoryviews
+        Args:
+            start: total bytes position, not less than tail
+            end: total bytes position, not more than head
+
+        Returns: list of memoryview
+
+        """
+        size = end - start
+        if size <= 0:
+            return []
+        start = start % self.capacity
+        first = min(size, self.capacity - start)
+        views = [self.view[start:start + first]]
+        if size > first:
+            views.append(self.view[:size - first])
+        return views
+
+    def advance(self, size):
+        """
+        mark size bytes as consumed
+        Args:
+            size:
+
+        Returns:
+
+        """
+        self.tail += min(size, self.head - self.tail)
+
+    def read(self, size=None):
+        """
+        copy out and consume data
+        Args:
+            size:
+
+        Returns: bytes
+
+        """
+        data = b"".join(self.peek(size))
+        self.advance(len(data))
+        return data
+
+    def wait(self, timeout=None, min_bytes=1):
+        """
+        wait for readable data
+        Args:
+            timeout:
+            min_bytes: wait until this many bytes are readable, the timeout or close, so that a consumer
+                is not woken for every small fill
+
+        Returns: True if there is readable data
+
+        """
+        with self.cond:
+            if self.head - self.tail < min_bytes and not self.closed:
+                self.wanted = min(min_bytes, self.capacity // 2)
+                self.cond.wait(timeout)
+                self.wanted = 1
+            return self.head != self.tail
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats(self):
+        return {"written": self.head, "consumed": self.tail, "buffered": len(self),
+                "dropped": self.dropped, "overflows": self.overflows}
+
+
+if __name__ == '__main__':
+    import os
+    import pty
+    import time
+    from queue import Queue
+    from threading import Thread
+
+    import serial
+
+    total = 64 * 1024 * 1024
+    block = b"x" * 4096
+
+    def feed(fd):
+        for _ in range(total // len(block)):
+            os.write(fd, block)
+
+    def bench(name, consume):
+        # pty pair stands in for a uart, the feeder writes the master side
+        master, slave = pty.openpty()
+        port = serial.Serial(os.ttyname(slave), timeout=0.05)
+        feeder = Thread(target=feed, args=(master,))
+        t0, c0 = time.perf_counter(), time.process_time()
+        feeder.start()
+        received = consume(port)
+        feeder.join()
+        cost, cpu = time.perf_counter() - t0, time.process_time() - c0
+        print(f"{name}: {received / cost / 1024 / 1024:.1f} MB/s, cpu {cpu:.2f}s")
+        port.close()
+        os.close(master)
+        os.close(slave)
+
+    def legacy_queue(port):
+        buffer, received = Queue(), 0
+        while received < total:
+            data = port.read(1024)
+            buffer.put(data)
+            received += len(data)
+            buffer.get()
+        return received
+
+    def ring_buffer(port):
+        ring = RingBuffer()
+        while ring.head < total:
+            ring.fill_from(port.readinto, port.in_waiting or 1)
+            for view in ring.peek():
+                ring.advance(len(view))
+        return ring.head
+
+    bench("queue of 1KiB reads", legacy_queue)
+    bench("ring buffer readinto", ring_buffer)
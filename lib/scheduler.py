@@ -0,0 +1,470 @@
+import json
+import multiprocessing
+import os
+import subprocess
+import time
+import traceback
+from collections import deque
+
+from lib.basic_test_tools import BasicTestTools
+from lib.log_tools import log
+from lib.parallel import device_worker, _handle_progress
+from lib.settings import Setting
+
+
+class Job:
+    """
+    one case run in the queue of DeviceScheduler
+    """
+
+    def __init__(self, case_name, case_file=None, times=1, tags=(), sn=None, retries=2, **kwargs):
+        """
+        Args:
+            case_name: case class name
+            case_file: found from the case index if None
+            times: run times
+            tags: capabilities the device must have, eg: ("wifi", "sim")
+            sn: only run on this device, eg: a static job list
+            retries: times the job is requeued after its device is lost
+            **kwargs: Setting overlay and case parameters, as run_on_devices
+        """
+        self.case_name = case_name
+        self.case_file = case_file
+        self.times = times
+        self.tags = frozenset(tags)
+        self.sn = sn
+        self.retries = retries
+        self.kwargs = kwargs
+        self.id = None
+        self.attempts = 0
+        # queued, running, done, failed
+        self.state = "queued"
+        self.queued_at = None
+        # [(sn, outcome)] of every attempt
+        self.history = []
+
+    @property
+    def name(self):
+        return f"{self.case_name}#{self.id}"
+
+    def __repr__(self):
+        return f"Job({self.name}, {self.state})"
+
+
+class Device:
+    """
+    a device of the pool, its state and busy/online time
+    """
+
+    def __init__(self, sn, tags=()):
+        self.sn = sn
+        self.tags = frozenset(tags)
+        self.tools = BasicTestTools(sn=sn)
+        # idle, busy, offline
+        self.state = "offline"
+        self.since = time.monotonic()
+        self.job = None
+        self.worker = None
+        # start time of the last probe, and of the last one finding the device online
+        self.checked = 0.0
+        self.healthy_at = 0.0
+        # running probe, see start_probe
+        self.probe_proc = None
+        self.probe_deadline = None
+        # result of the exited worker of the job, None while it runs
+        self.exit_ok = None
+        self.exit_at = None
+        self.online_time = 0.0
+        self.busy_time = 0.0
+        self.jobs = 0
+        self.lost = 0
+
+    def start_probe(self, timeout=3.0):
+        """
+        start a health check by `adb get-state` without waiting for it, see poll_probe
+        Args:
+            timeout: seconds, a probe still running after it finds the device offline
+
+        Returns:
+
+        """
+        if self.probe_proc is not None:
+            return
+        self.checked = time.monotonic()
+        self.probe_deadline = self.checked + timeout
+        self.probe_proc = subprocess.Popen(f"{self.tools.add_sn_to_exec(Setting.ADB)} get-state", shell=True,
+                                           stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                           **BasicTestTools._new_group_kwargs())
+
+    def poll_probe(self):
+        """
+        Returns: True if the device is online, False if not, None while the probe runs or if there is none
+
+        """
+        proc = self.probe_proc
+        if proc is None:
+            return None
+        if proc.poll() is None:
+            if time.monotonic() < self.probe_deadline:
+                return None
+            BasicTestTools.kill_process_tree(proc.pid)
+        out, _ = BasicTestTools._reap(proc, timeout=1)
+        self.probe_proc = None
+        online = proc.returncode == 0 and out.decode("utf-8", errors="ignore").strip().endswith("device")
+        if online:
+            self.healthy_at = self.checked
+        return online
+
+    def stop_probe(self):
+        if self.probe_proc is not None:
+            BasicTestTools.kill_process_tree(self.probe_proc.pid)
+            BasicTestTools._reap(self.probe_proc, timeout=1)
+            self.probe_proc = None
+
+    def set_state(self, state):
+        now = time.monotonic()
+        if self.state != "offline":
+            self.online_time += now - self.since
+        if self.state == "busy":
+            self.busy_time += now - self.since
+        self.state = state
+        self.since = now
+
+    def can_run(self, job):
+        return self.state == "idle" and job.tags <= self.tags and job.sn in (None, self.sn)
+
+    def stats(self):
+        now = time.monotonic()
+        online = self.online_time + (now - self.since if self.state != "offline" else 0)
+        busy = self.busy_time + (now - self.since if self.state == "busy" else 0)
+        return {"state": self.state, "tags": sorted(self.tags), "jobs": self.jobs, "lost": self.lost,
+                "online": round(online, 1), "busy": round(busy, 1),
+                "utilization": round(busy / online, 4) if online else 0.0}
+
+
+def job_worker(sn, case_file, case_name, times, setting_kwargs, case_kwargs, progress_queue):
+    """
+    device_worker in its own session, so a lost device can be released by killing the whole tree
+    """
+    if hasattr(os, "setsid"):
+        os.setsid()
+    device_worker(sn, case_file, case_name, times, setting_kwargs, case_kwargs, progress_queue)
+
+
+class DeviceScheduler:
+    """
+    run a queue of jobs on a pool of devices: each job goes to the next idle healthy device having its tags,
+    one worker process per job as run_on_devices. devices are probed by `adb get-state` before a job and while
+    it runs, a job of a lost device is killed and requeued, the device is probed again until it is back.
+    the probes of all devices run at the same time as subprocesses polled by the loop, a hanging adb does not
+    stall the loop. a job is done when every iteration of its case passed, a failed job is probed first:
+    a device not answering is lost and the job is requeued.
+    with devices "all" the pool follows `adb devices`, devices coming later join the pool
+    """
+
+    def __init__(self, devices="all", tags=None, health_interval=5.0, discover_interval=10.0, wait_device=60.0,
+                 report_interval=30.0, probe_timeout=3.0):
+        """
+        Args:
+            devices: sn list, or "all" for every attached device
+            tags: {sn: capability tags}, eg: {"sn1": ["wifi", "sim"]}
+            health_interval: seconds between probes of a busy or offline device, and max age of the probe
+                of an idle device a job is started on
+            discover_interval: seconds between `adb devices` when devices is "all"
+            wait_device: seconds a job waits when no device of the pool has its tags, it fails after
+            report_interval: seconds between progress logs
+            probe_timeout: seconds, a device whose `adb get-state` takes longer is offline
+        """
+        self.discover = devices == "all" or devices == ["all"]
+        self.tags = tags or {}
+        self.health_interval = health_interval
+        self.discover_interval = discover_interval
+        self.wait_device = wait_device
+        self.report_interval = report_interval
+        self.probe_timeout = probe_timeout
+        self.devices = {}
+        if not self.discover:
+            for sn in ([devices] if isinstance(devices, str) else devices):
+                self.devices[sn] = Device(sn, self.tags.get(sn, ()))
+        self.queue = deque()
+        self.jobs = []
+        self.progress_queue = None
+        self.case_results = {}
+        self.discovered = 0.0
+        self.start = None
+        self.end = None
+        self.requeued = 0
+        # time weighted queue depth
+        self.depth_area = 0.0
+        self.depth_time = None
+        self.max_depth = 0
+
+    def add(self, case_name, **kwargs):
+        """
+        queue a job, see Job
+        Returns: Job
+
+        """
+        return self.add_job(Job(case_name, **kwargs))
+
+    def add_job(self, job):
+        job.id = len(self.jobs) + 1
+        if job.case_file is None:
+            from run import CaseRunner
+
+            job.case_file = CaseRunner.find_case_file(job.case_name)
+        self.jobs.append(job)
+        self._enqueue(job)
+        return job
+
+    def _enqueue(self, job, front=False):
+        self._sample_depth()
+        job.state = "queued"
+        job.queued_at = time.monotonic()
+        self.queue.appendleft(job) if front else self.queue.append(job)
+        self.max_depth = max(self.max_depth, len(self.queue))
+
+    def _sample_depth(self):
+        now = time.monotonic()
+        if self.depth_time is not None:
+            self.depth_area += len(self.queue) * (now - self.depth_time)
+        self.depth_time = now
+
+    def run(self):
+        """
+        run until every job is done or failed
+        Returns: {job name: True/False}
+
+        """
+        self.progress_queue = multiprocessing.Queue()
+        self.start = self.depth_time = time.monotonic()
+        last_report = self.start
+        log.logger.info(f"scheduler start, {len(self.queue)} jobs")
+        try:
+            while self.queue or self._running():
+                self._refresh()
+                self._dispatch()
+                _handle_progress(self.progress_queue, self.case_results, timeout=0.05)
+                self._reap()
+                self._expire()
+                if time.monotonic() - last_report >= self.report_interval:
+                    last_report = time.monotonic()
+                    log.logger.info(f"scheduler: {self.summary()}")
+        finally:
+            for device in self._running():
+                self._kill(device)
+            for device in self.devices.values():
+                device.stop_probe()
+            self._sample_depth()
+            self.end = time.monotonic()
+        log.logger.info(f"scheduler end: {self.summary()}")
+        for sn, device in self.devices.items():
+            log.logger.info(f"[{sn}] {device.stats()}")
+        return {job.name: job.state == "done" for job in self.jobs}
+
+    def _running(self):
+        return [device for device in self.devices.values() if device.state == "busy"]
+
+    def _refresh(self):
+        """
+        discover devices, act on the finished probes and probe the busy and offline devices
+        whose last probe is older than health_interval
+        """
+        now = time.monotonic()
+        if self.discover and now - self.discovered >= self.discover_interval:
+            self.discovered = now
+            for sn in BasicTestTools.list_devices():
+                if sn not in self.devices:
+                    self.devices[sn] = Device(sn, self.tags.get(sn, ()))
+                    log.logger.info(f"[{sn}] joins the pool, tags {sorted(self.devices[sn].tags)}")
+        for device in self.devices.values():
+            online = device.poll_probe()
+            if online is not None:
+                self._probed(device, online)
+            if device.state != "idle" and now - device.checked >= self.health_interval:
+                device.start_probe(self.probe_timeout)
+
+    def _probed(self, device, online):
+        """
+        act on the finished probe of device
+        """
+        if device.state == "offline":
+            if online:
+                device.set_state("idle")
+                log.logger.info(f"[{device.sn}] online")
+        elif device.state == "idle":
+            if not online:
+                device.set_state("offline")
+                log.logger.warning(f"[{device.sn}] offline")
+        elif device.exit_ok is False:
+            # the job failed, the device decides between a failed job and a lost device
+            if device.checked < device.exit_at:
+                device.start_probe(self.probe_timeout)
+            elif online:
+                self._finish(device, "failed")
+            else:
+                self._lost(device)
+        elif not online:
+            self._lost(device)
+
+    def _dispatch(self):
+        if not any(device.state == "idle" for device in self.devices.values()):
+            return
+        now = time.monotonic()
+        for job in list(self.queue):
+            candidates = [device for device in self.devices.values() if device.can_run(job)]
+            if not candidates:
+                continue
+            healthy = [device for device in candidates
+                       if device.probe_proc is None and now - device.healthy_at < self.health_interval]
+            for device in candidates:
+                if device not in healthy:
+                    # started on the next loop once its probe finds it online
+                    device.start_probe(self.probe_timeout)
+            if not healthy:
+                continue
+            # the device idle for the longest time, devices share the load
+            device = min(healthy, key=lambda d: d.since)
+            self._sample_depth()
+            self.queue.remove(job)
+            self._launch(job, device)
+
+    def _launch(self, job, device):
+        setting_keys = Setting.__dict__.keys()
+        setting_kwargs = {k: v for k, v in job.kwargs.items() if k in setting_keys and v is not None}
+        case_kwargs = {k: v for k, v in job.kwargs.items() if k not in setting_keys}
+        if Setting.report:
+            from lib.report import run_dir
+
+            setting_kwargs.setdefault("report_dir", run_dir())
+        job.attempts += 1
+        job.state = "running"
+        device.job = job
+        device.set_state("busy")
+        self.case_results.pop(device.sn, None)
+        device.worker = multiprocessing.Process(
+            target=job_worker, name=f"worker-{device.sn}",
+            args=(device.sn, job.case_file, job.case_name, job.times, setting_kwargs, case_kwargs,
+                  self.progress_queue))
+        device.worker.start()
+        log.logger.info(f"[{device.sn}] {job.name} start, attempt {job.attempts}, "
+                        f"waited {time.monotonic() - job.queued_at:.1f}s, queue {len(self.queue)}")
+
+    def _reap(self):
+        for device in self._running():
+            if device.exit_ok is not None or device.worker.is_alive():
+                continue
+            device.worker.join()
+            # the exit record is put right before the worker exits
+            while _handle_progress(self.progress_queue, self.case_results):
+                pass
+            # False if the worker failed or a case iteration did not pass, see device_worker
+            device.exit_ok = device.worker.exitcode == 0 and self.case_results.pop(device.sn, False)
+            device.exit_at = time.monotonic()
+            if device.exit_ok:
+                self._finish(device, "done")
+            else:
+                # decided by a probe started after the exit, see _probed
+                device.start_probe(self.probe_timeout)
+
+    def _finish(self, device, state):
+        job = device.job
+        job.state = state
+        job.history.append((device.sn, state))
+        device.jobs += 1
+        device.job = device.worker = None
+        device.exit_ok = device.exit_at = None
+        device.set_state("idle")
+        log.logger.info(f"[{device.sn}] {job.name} {state}")
+
+    def _lost(self, device):
+        """
+        kill the job of a lost device and requeue it at the front
+        """
+        job = device.job
+        self._kill(device)
+        device.lost += 1
+        device.job = device.worker = None
+        device.exit_ok = device.exit_at = None
+        device.set_state("offline")
+        job.history.append((device.sn, "lost"))
+        if job.attempts <= job.retries:
+            self.requeued += 1
+            self._enqueue(job, front=True)
+            log.logger.warning(f"[{device.sn}] lost, {job.name} requeued")
+        else:
+            job.state = "failed"
+            log.logger.error(f"[{device.sn}] lost, {job.name} failed after {job.attempts} attempts")
+
+    @staticmethod
+    def _kill(device):
+        worker = device.worker
+        if worker is not None and worker.is_alive():
+            try:
+                BasicTestTools.kill_process_tree(worker.pid)
+            except Exception:
+                log.logger.error(traceback.format_exc())
+            worker.kill()
+        if worker is not None:
+            worker.join()
+
+    def _expire(self):
+        """
+        fail the jobs no online device can run after wait_device seconds
+        """
+        now = time.monotonic()
+        for job in list(self.queue):
+            if now - job.queued_at < self.wait_device:
+                continue
+            if any(job.tags <= device.tags and job.sn in (None, device.sn) and device.state != "offline"
+                   for device in self.devices.values()):
+                continue
+            self._sample_depth()
+            self.queue.remove(job)
+            job.state = "failed"
+            job.history.append((None, "no device"))
+            log.logger.error(f"{job.name} failed: no online device with tags {sorted(job.tags)} "
+                             f"after {self.wait_device}s")
+
+    def summary(self):
+        """
+        Returns: queue depth, job counts, makespan and utilization of every device
+
+        """
+        end = self.end or time.monotonic()
+        elapsed = end - self.start if self.start else 0.0
+        states = {}
+        for job in self.jobs:
+            states[job.state] = states.get(job.state, 0) + 1
+        return {"queue": len(self.queue), "max_queue": self.max_depth,
+                "avg_queue": round(self.depth_area / elapsed, 2) if elapsed else 0.0,
+                "jobs": states, "requeued": self.requeued, "makespan": round(elapsed, 2),
+                "devices": {sn: device.stats()["utilization"] for sn, device in self.devices.items()}}
+
+
+def load_jobs(path):
+    """
+    jobs of a json file: a list of Job kwargs, eg:
+        [{"case_name": "Reboot", "times": 10, "tags": ["sim"]}, {"case_name": "Wifi", "product_name": "p1"}]
+    """
+    with open(path, encoding="utf-8") as f:
+        return [Job(**entry) for entry in json.load(f)]
+
+
+if __name__ == '__main__':
+    import threading
+
+    from lib.fake_adb import FAKE_ADB
+    from lib.scheduler import DeviceScheduler
+
+    # no device needed: three fake devices, fake2 is unplugged from 1s to 4s, its job runs again on another one
+    Setting.ADB = FAKE_ADB
+    os.environ["FAKE_ADB_DEVICES"] = "fake0,fake1,fake2"
+    threading.Timer(1, os.environ.__setitem__, ("FAKE_ADB_DEVICES", "fake0,fake1")).start()
+    threading.Timer(4, os.environ.__setitem__, ("FAKE_ADB_DEVICES", "fake0,fake1,fake2")).start()
+    scheduler = DeviceScheduler("all", tags={"fake0": ["sim"]}, health_interval=0.5, discover_interval=1)
+    for i in range(12):
+        scheduler.add("SleepCase", case_file="bench/cases.py", seconds=(0.5, 2)[i % 2], tags=["sim"] if i < 2 else [])
+    print(scheduler.run())
+    print(scheduler.summary())
+    print([(job.name, job.history) for job in scheduler.jobs if len(job.history) > 1])
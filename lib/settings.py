@@ -4,6 +4,8 @@ from pathlib import Path
 class Setting:
     PROJECT_ROOT = Path(__file__).parent.parent
     CASE_PATH = PROJECT_ROOT.joinpath('case')
+    # cache of the cases found in CASE_PATH, see CaseIndex
+    CASE_INDEX = PROJECT_ROOT.joinpath('.case_index.json')
     SOURCE_PATH = PROJECT_ROOT.joinpath('source')
     LIB_PATH = PROJECT_ROOT.joinpath('lib')
 
@@ -12,10 +14,47 @@ class Setting:
     case_log_dir = LOG_PATH
 
     result_new = False
+    # sqlite result store, the legacy result_<sn>.txt is still written if result_txt
+    RESULT_DB = PROJECT_ROOT.joinpath('result.db')
+    result_txt = True
+    result_batch = 50
+    # streaming html/json report in REPORT_PATH/<run time>, see lib/report.py, opt-in like trace.
+    # report_dir is set on first use, or set it to continue a report
+    report = False
+    report_dir = None
+    report_page_size = 500
+    report_interval = 2.0
+
+    # log by a background listener, its console prints at most log_console_rate records per second
+    log_async = False
+    log_console_rate = 200
 
     product_name = ""
     branch = ""
 
+    # seconds, None for no limit. cmd_timeout is the default timeout of BasicTestTools commands,
+    # case_timeout of set_up + test_step of a case, see BasicTestcase.timeout
+    cmd_timeout = None
+    case_timeout = None
+    # write chrome trace json of phases, commands and user spans to the case log dir, see lib/trace.py
+    trace = False
+
+    # adb/fastboot executable, may be replaced by a stand-in such as lib/fake_adb.py
+    ADB = "adb"
+    FASTBOOT = "fastboot"
+    # keep long-lived adb shell sessions for BasicTestTools.adb_shell
+    adb_session = False
+    adb_session_size = 2
+    # seconds a session command may run when no timeout is given, a session never waits forever
+    adb_session_timeout = 600
+    # adb_shell results of commands starting with these are cached per device until ttl seconds pass
+    # or the device reboots, see QueryCache. () turns the cache off, adb_shell(cache=...) overrides per call
+    cacheable_commands = ("getprop ro.", "uname", "cat /proc/version", "cat /proc/partitions")
+    query_cache_ttl = 600
+    query_cache_size = 256
+    # seconds, a cache hit re-reads boot_id when the last check is older than this
+    query_cache_boot_check = 10
+
 
 if __name__ == '__main__':
     print(Setting.LOG_PATH)
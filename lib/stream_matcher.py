@@ -0,0 +1,120 @@
+import re
+from collections import namedtuple
+
+# index: index of the pattern in the pattern list, pattern: the pattern itself,
+# data: matched bytes (the whole line for regex), offset: stream offset where data starts
+StreamMatch = namedtuple("StreamMatch", ["index", "pattern", "data", "offset"])
+
+
+class StreamMatcher:
+    """
+    incremental multi-pattern matcher over a byte stream fed chunk by chunk.
+    literal patterns (str/bytes) are matched anywhere in the stream by one combined regex,
+    only the last (longest literal - 1) bytes are kept so matches spanning chunks are found without rescanning;
+    compiled regex patterns are matched once per complete line, and against the pending partial line
+    after every chunk so that a line without a trailing newline, eg: a shell prompt, is found too.
+    a regex is reported at most once per line, on the partial line or on the complete one;
+    note that "$" also matches at the end of the partial line.
+    """
+
+    def __init__(self, patterns, max_line=64 * 1024, max_partial=4096):
+        """
+        Args:
+            patterns: list of str/bytes literal or compiled re.Pattern, a single pattern is accepted too
+            max_line: a partial line longer than max_line is matched and dropped to bound the memory
+            max_partial: partial lines longer than this are only matched once complete,
+                bounds the rescanning of a long line fed in small chunks
+        """
+        if isinstance(patterns, (str, bytes, re.Pattern)):
+            patterns = [patterns]
+        self.patterns = list(patterns)
+        self.max_line = max_line
+        self.max_partial = max_partial
+        self.literals = {}
+        self.regexes = []
+        for index, pattern in enumerate(self.patterns):
+            if isinstance(pattern, re.Pattern):
+                if isinstance(pattern.pattern, str):
+                    pattern = re.compile(pattern.pattern.encode("utf-8"), pattern.flags & ~re.UNICODE)
+                self.regexes.append((index, pattern))
+            else:
+                literal = pattern.encode("utf-8") if isinstance(pattern, str) else bytes(pattern)
+                self.literals.setdefault(literal, index)
+        self.literal_re = None
+        self.keep = 0
+        if self.literals:
+            alternation = b"|".join(re.escape(l) for l in sorted(self.literals, key=len, reverse=True))
+            self.literal_re = re.compile(alternation)
+            self.keep = max(len(l) for l in self.literals) - 1
+        self.tail = b""
+        self.line = bytearray()
+        # indexes of the regexes already reported on the partial line
+        self.line_matched = set()
+        # stream offset of the first byte of the next chunk
+        self.offset = 0
+
+    def feed(self, chunk):
+        """
+        match a new chunk of the stream
+        Args:
+            chunk: bytes-like
+
+        Returns: list of StreamMatch in the chunk
+
+        """
+        chunk = bytes(chunk)
+        matches = []
+        if self.literal_re is not None:
+            window = self.tail + chunk
+            base = self.offset - len(self.tail)
+            for m in self.literal_re.finditer(window):
+                # matches ending inside the tail were reported with the previous chunk
+                if m.end() > len(self.tail):
+                    index = self.literals[m.group(0)]
+                    matches.append(StreamMatch(index, self.patterns[index], m.group(0), base + m.start()))
+            self.tail = window[-self.keep:] if self.keep else b""
+        if self.regexes:
+            matches.extend(self._feed_lines(chunk))
+        self.offset += len(chunk)
+        return matches
+
+    def _feed_lines(self, chunk):
+        matches = []
+        line_offset = self.offset - len(self.line)
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                break
+            self.line += chunk[start:end]
+            matches.extend(self._match_line(line_offset))
+            line_offset = self.offset + end + 1
+            start = end + 1
+        self.line += chunk[start:]
+        if len(self.line) > self.max_line:
+            matches.extend(self._match_line(line_offset))
+        elif start < len(chunk) and len(self.line) <= self.max_partial:
+            matches.extend(self._match_partial(line_offset))
+        return matches
+
+    def _match_partial(self, line_offset):
+        line = bytes(self.line).rstrip(b"\r")
+        matches = []
+        for index, regex in self.regexes:
+            if index not in self.line_matched and regex.search(line):
+                self.line_matched.add(index)
+                matches.append(StreamMatch(index, self.patterns[index], line, line_offset))
+        return matches
+
+    def _match_line(self, line_offset):
+        line = bytes(self.line).rstrip(b"\r")
+        self.line.clear()
+        matched, self.line_matched = self.line_matched, set()
+        return [StreamMatch(index, self.patterns[index], line, line_offset)
+                for index, regex in self.regexes if index not in matched and regex.search(line)]
+
+    def reset(self):
+        self.tail = b""
+        self.line.clear()
+        self.line_matched.clear()
+        self.offset = 0
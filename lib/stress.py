@@ -0,0 +1,180 @@
+import time
+from array import array
+from contextlib import nullcontext
+
+from lib.log_tools import log, case_log_context, rename_log_dir
+from lib.result_store import ResultStore
+from lib.settings import Setting
+
+# live statistics are printed even when the console is rate limited
+FORCE_CONSOLE = {"force_console": True}
+
+
+class StressStats:
+    """
+    live statistics of a stress run: iterations per second, failure rate and duration histogram
+    """
+    # histogram buckets are powers of two in milliseconds: <1ms, <2ms, <4ms ... <2^31ms
+    BUCKETS = 32
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.count = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.status_count = {}
+        self.histogram = array("Q", [0] * self.BUCKETS)
+        self.total_duration = 0.0
+        self.min_duration = None
+        self.max_duration = 0.0
+
+    def add(self, status, duration):
+        """
+        record one iteration
+        Args:
+            status: pass/fail/...
+            duration: seconds
+
+        Returns:
+
+        """
+        self.count += 1
+        self.status_count[status] = self.status_count.get(status, 0) + 1
+        if status == "pass":
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+        self.total_duration += duration
+        self.min_duration = duration if self.min_duration is None else min(self.min_duration, duration)
+        self.max_duration = max(self.max_duration, duration)
+        self.histogram[min(int(duration * 1000).bit_length(), self.BUCKETS - 1)] += 1
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.start
+
+    @property
+    def rate(self):
+        return self.count / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def fail_rate(self):
+        return self.failures / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        """
+        upper bound of the histogram bucket holding the q percentile
+        Args:
+            q: 0-100
+
+        Returns: seconds
+
+        """
+        if not self.count:
+            return 0.0
+        target = self.count * q / 100
+        seen = 0
+        for bucket, n in enumerate(self.histogram):
+            seen += n
+            if seen >= target:
+                return min((1 << bucket) / 1000, self.max_duration)
+        return self.max_duration
+
+    def summary(self):
+        return (f"{self.count} iterations in {self.elapsed:.1f}s, {self.rate:.2f} it/s, "
+                f"fail {self.failures} ({self.fail_rate:.2%}), {self.status_count}, "
+                f"duration min {self.min_duration or 0:.3f}s p50 {self.percentile(50):.3f}s "
+                f"p95 {self.percentile(95):.3f}s max {self.max_duration:.3f}s")
+
+    def histogram_lines(self):
+        for bucket, n in enumerate(self.histogram):
+            if n:
+                low = 0 if bucket == 0 else 1 << (bucket - 1)
+                yield f"{low:>10}ms - {1 << bucket:>10}ms: {n}"
+
+
+def should_stop(stats, max_failures=None, max_consecutive_failures=None, max_fail_rate=None, min_iterations=20):
+    """
+    failure thresholds of a stress run
+    Args:
+        stats: StressStats
+        max_failures: stop after this many failures
+        max_consecutive_failures: stop after this many failures in a row
+        max_fail_rate: stop when the failure rate is above it, checked after min_iterations
+        min_iterations:
+
+    Returns: reason or ""
+
+    """
+    if max_failures is not None and stats.failures >= max_failures:
+        return f"failures {stats.failures} >= {max_failures}"
+    if max_consecutive_failures is not None and stats.consecutive_failures >= max_consecutive_failures:
+        return f"consecutive failures {stats.consecutive_failures} >= {max_consecutive_failures}"
+    if max_fail_rate is not None and stats.count >= min_iterations and stats.fail_rate > max_fail_rate:
+        return f"fail rate {stats.fail_rate:.2%} > {max_fail_rate:.2%}"
+    return ""
+
+
+def run_stress(case, times=1, per_iteration_log=False, max_failures=None, max_consecutive_failures=None,
+               max_fail_rate=None, min_iterations=20, report_interval=10.0, **kwargs):
+    """
+    run a case many times with minimal per-iteration overhead.
+    by default one case instance and one case log with iteration markers are used for the whole run,
+    per_iteration_log gives every iteration its own instance and log dir like run_it
+    Args:
+        case: case class
+        times: iterations
+        per_iteration_log: one log dir per iteration
+        max_failures: stop after this many failures
+        max_consecutive_failures: stop after this many failures in a row
+        max_fail_rate: stop when the failure rate is above it, checked after min_iterations
+        min_iterations:
+        report_interval: seconds between live statistics logs
+        **kwargs: case parameters
+
+    Returns: StressStats
+
+    """
+    stats = StressStats()
+    last_report = time.monotonic()
+    log.logger.info(f"{case} stress {times} times")
+    shared = None
+    if not per_iteration_log:
+        shared = case(**kwargs)
+        shared.params = kwargs
+    with nullcontext() if shared is None else case_log_context(shared):
+        try:
+            for i in range(1, times + 1):
+                t0 = time.monotonic()
+                if shared is None:
+                    instance = case(**kwargs)
+                    instance.params = kwargs
+                    instance.iteration = i
+                    with case_log_context(instance):
+                        status = instance.run()
+                    rename_log_dir(instance)
+                else:
+                    shared.iteration = i
+                    log.logger.info(f"{'=' * 20} iteration {i}/{times} {'=' * 20}")
+                    status = shared.run()
+                stats.add(status, time.monotonic() - t0)
+                reason = should_stop(stats, max_failures, max_consecutive_failures, max_fail_rate, min_iterations)
+                if reason:
+                    log.logger.error(f"{case} stress stop at iteration {i}: {reason}")
+                    break
+                if time.monotonic() - last_report >= report_interval:
+                    last_report = time.monotonic()
+                    log.logger.info(f"{case} stress {i}/{times}: {stats.summary()}", extra=FORCE_CONSOLE)
+        finally:
+            ResultStore.get().flush()
+            if Setting.report:
+                from lib.report import ReportWriter
+
+                ReportWriter.flush_all()
+    if shared is not None:
+        rename_log_dir(shared)
+    log.logger.info(f"{case} stress end: {stats.summary()}", extra=FORCE_CONSOLE)
+    for line in stats.histogram_lines():
+        log.logger.info(line, extra=FORCE_CONSOLE)
+    return stats
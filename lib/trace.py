@@ -0,0 +1,223 @@
+"""
+opt-in tracing of a case: set_up/test_step/tear_down, every command of BasicTestTools and user spans,
+exported as chrome trace event json (open in chrome://tracing or https://ui.perfetto.dev).
+
+enable by Setting.trace or the case class attribute trace, the trace is written to <case log dir>/trace.json.
+when disabled a span costs one ContextVar lookup
+"""
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from lib.log_tools import log
+
+# Tracer of the running case, None when tracing is off
+tracer_var = contextvars.ContextVar("tracer", default=None)
+
+
+class Tracer:
+    """
+    collects complete events ("ph": "X") of one case, timestamps are microseconds since the tracer was created
+    """
+
+    def __init__(self, name, max_events=200000):
+        """
+        Args:
+            name: process name shown in the trace, eg: the case name
+            max_events: later events are dropped and counted, bounds the memory of a long case
+        """
+        self.name = name
+        self.max_events = max_events
+        self.events = []
+        self.dropped = 0
+        self.t0 = time.perf_counter_ns()
+        self.pid = os.getpid()
+        self.threads = {}
+        self.local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+            thread = threading.current_thread()
+            self.threads[thread.ident] = thread.name
+        return stack
+
+    @contextmanager
+    def span(self, name, cat="user", **args):
+        """
+        record the wall and thread cpu time of the block
+        Args:
+            name:
+            cat: category, phase/cmd/user
+            **args: shown in the event, more can be added inside the block by annotate
+
+        Returns: the args dict of the event
+
+        """
+        stack = self._stack()
+        stack.append(args)
+        start, cpu = time.perf_counter_ns(), time.thread_time_ns()
+        try:
+            yield args
+        except BaseException as e:
+            args["error"] = type(e).__name__
+            raise
+        finally:
+            end = time.perf_counter_ns()
+            args["cpu_ms"] = round((time.thread_time_ns() - cpu) / 1e6, 3)
+            stack.pop()
+            self.add(name, cat, start, end - start, args)
+
+    def add(self, name, cat, start_ns, duration_ns, args=None):
+        """
+        add a complete event of the calling thread
+        Args:
+            name:
+            cat:
+            start_ns: time.perf_counter_ns() at the start
+            duration_ns:
+            args:
+
+        Returns:
+
+        """
+        if len(self.events) >= self.max_events:
+            self.dropped += 1
+            return
+        self._stack()
+        self.events.append({"name": name, "cat": cat, "ph": "X", "ts": (start_ns - self.t0) / 1000,
+                            "dur": duration_ns / 1000, "pid": self.pid, "tid": threading.get_ident(),
+                            "args": args or {}})
+
+    def annotate(self, **args):
+        """
+        add args to the innermost open span of the calling thread
+        """
+        stack = getattr(self.local, "stack", None)
+        if stack:
+            stack[-1].update(args)
+
+    def to_dict(self):
+        meta = [{"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0, "args": {"name": self.name}}]
+        meta += [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                 for tid, name in list(self.threads.items())]
+        return {"traceEvents": meta + self.events, "displayTimeUnit": "ms",
+                "otherData": {"dropped_events": self.dropped}}
+
+    def save(self, path):
+        """
+        write chrome trace json
+        Args:
+            path:
+
+        Returns: path
+
+        """
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, separators=(",", ":"))
+        if self.dropped:
+            log.logger.warning(f"trace {path} dropped {self.dropped} events over max_events {self.max_events}")
+        return path
+
+    def summary(self, cat=None):
+        """
+        Returns: {name: (count, total ms)} of the events of cat, slowest first
+
+        """
+        totals = {}
+        for event in self.events:
+            if cat is None or event["cat"] == cat:
+                count, total = totals.get(event["name"], (0, 0.0))
+                totals[event["name"]] = (count + 1, total + event["dur"] / 1000)
+        return dict(sorted(totals.items(), key=lambda item: -item[1][1]))
+
+
+@contextmanager
+def tracing(name, path=None, max_events=200000):
+    """
+    trace the block, spans inside it (same thread or context) are recorded
+    Args:
+        name: process name in the trace
+        path: trace json written at exit, None to keep it in memory only
+        max_events:
+
+    Returns: Tracer
+
+    """
+    tracer = Tracer(name, max_events)
+    token = tracer_var.set(tracer)
+    try:
+        yield tracer
+    finally:
+        tracer_var.reset(token)
+        if path is not None:
+            tracer.save(path)
+
+
+class _NoSpan:
+    """
+    span of tracing off, reused by every call
+    """
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+def span(name, cat="user", **args):
+    """
+    user span, a no-op if tracing is off
+    eg:
+        with span("flash", image=path):
+            ...
+    """
+    tracer = tracer_var.get()
+    if tracer is None:
+        return NO_SPAN
+    return tracer.span(name, cat, **args)
+
+
+def annotate(**args):
+    """
+    add args to the innermost open span, a no-op if tracing is off
+    """
+    tracer = tracer_var.get()
+    if tracer is not None:
+        tracer.annotate(**args)
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    from lib.basic_test_tools import BasicTestTools
+    # the instrumented modules use lib.trace, not this __main__ module
+    from lib.trace import span, tracing
+
+    tools = BasicTestTools()
+    times = 2000
+    for enabled in (False, True):
+        t0 = time.perf_counter()
+        if enabled:
+            with tracing("bench") as t:
+                for _ in range(times):
+                    with span("noop"):
+                        pass
+        else:
+            for _ in range(times):
+                with span("noop"):
+                    pass
+        print(f"span {'on' if enabled else 'off'}: {(time.perf_counter() - t0) / times * 1e6:.2f}us")
+    with tracing("demo", os.path.join(tempfile.gettempdir(), "trace_demo.json")) as t:
+        with span("demo step", cat="phase"):
+            tools._process_cmd("sleep 0.1 && echo done", 0)
+            tools._process_cmd("exit 3", 0)
+    print(t.summary())
@@ -0,0 +1,465 @@
+import hashlib
+import json
+import os
+import posixpath
+import shlex
+import tarfile
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+from lib.basic_test_tools import BasicTestTools
+from lib.log_tools import log
+from lib.watchdog import running_commands
+
+MiB = 1024 * 1024
+# verified: True/False if the transferred files were checked by sha256, None if nothing was checked,
+# eg: verify=False or every file was unchanged
+TransferStats = namedtuple("TransferStats", ["direction", "files", "bytes", "skipped", "seconds", "mb_per_s",
+                                             "files_per_s", "verified", "failed"])
+
+
+class _HashReader:
+    """
+    file wrapper hashing the data read through it, so a file is read once for sending and hashing
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha.update(data)
+        return data
+
+
+def sha256_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for data in iter(partial(f.read, MiB), b""):
+            sha.update(data)
+    return sha.hexdigest()
+
+
+def _q(path):
+    return shlex.quote(str(path))
+
+
+class FileTransfer:
+    """
+    bulk push/pull between the host and a Transport.
+    small files are bundled into a few parallel tar streams, large files are sent as parallel dd chunks,
+    unchanged files are skipped by size/mtime (and sha256 when only the mtime differs) manifests,
+    transferred files are verified by sha256 on both sides
+    """
+
+    def __init__(self, transport, jobs=4, large_file=16 * MiB, chunk_size=16 * MiB, verbosity=1):
+        """
+        Args:
+            transport: Transport
+            jobs: parallel streams
+            large_file: files from this size are sent in chunks instead of tar
+            chunk_size: min chunk of a large file, MiB aligned
+            verbosity: log the transfer summary
+        """
+        self.transport = transport
+        self.jobs = max(1, jobs)
+        self.large_file = large_file
+        self.chunk_size = max(MiB, chunk_size // MiB * MiB)
+        self.verbosity = verbosity
+        self.commands = None
+
+    def _popen(self, script, stdin=False):
+        proc = self.transport.popen(script, stdin)
+        # the workers' streams are killed with the commands of the calling case thread on a case timeout
+        proc.kill_tree = partial(BasicTestTools.kill_process_tree, proc.pid)
+        self.commands.append(proc.kill_tree)
+        return proc
+
+    def _finish(self, proc, what):
+        if proc.stdin is not None and not proc.stdin.closed:
+            proc.stdin.close()
+        proc.stdout.read()
+        proc.stdout.close()
+        code = proc.wait()
+        if proc.kill_tree in self.commands:
+            self.commands.remove(proc.kill_tree)
+        if code != 0:
+            raise RuntimeError(f"{what} fail, exit code {code}")
+
+    def _script(self, script, data=None):
+        code, out = self.transport.run_script(script, data)
+        return out.decode("utf-8", errors="replace") if code == 0 else None
+
+    @staticmethod
+    def _manifest_path(transport, remote_root):
+        return f"{transport.tmp_dir}/.swift_manifest_{hashlib.sha1(remote_root.encode()).hexdigest()[:16]}.json"
+
+    def _remote_files(self, remote_root, names=None):
+        """
+        Args:
+            remote_root:
+            names: only these relative names, default all the files under remote_root
+
+        Returns: {relative name: (size, mtime seconds)}
+
+        """
+        if names is None:
+            script = f"cd {_q(remote_root)} 2>/dev/null && find . -type f -exec stat -c '%s %Y %n' {{}} +"
+        else:
+            script = (f"cd {_q(remote_root)} 2>/dev/null && find {' '.join(_q(n) for n in names)} -maxdepth 0 -type f "
+                      f"-exec stat -c '%s %Y %n' {{}} +")
+        files = {}
+        for line in (self._script(f"{script} 2>/dev/null; true") or "").splitlines():
+            parts = line.split(" ", 2)
+            if len(parts) == 3 and parts[0].isdigit():
+                files[posixpath.normpath(parts[2])] = (int(parts[0]), int(parts[1]))
+        return files
+
+    def _remote_sha256(self, remote_root, names):
+        """
+        Returns: {relative name: sha256} of names, by one sha256sum run with the names in a list file
+
+        """
+        if not names:
+            return {}
+        list_file = f"{self.transport.tmp_dir}/.swift_list_{os.getpid()}_{threading.get_ident()}"
+        data = b"".join(f"./{name}".encode() + b"\0" for name in names)
+        self.transport.run_script(f"cat > {_q(list_file)}", data)
+        out = self._script(f"cd {_q(remote_root)} && xargs -0 sha256sum < {_q(list_file)}; rm -f {_q(list_file)}")
+        hashes = {}
+        for line in (out or "").splitlines():
+            digest, _, name = line.partition("  ")
+            hashes[posixpath.normpath(name)] = digest
+        return hashes
+
+    @staticmethod
+    def _local_files(local):
+        """
+        Returns: [(path, relative posix name, size, mtime_ns)] of a file or the files under a dir
+
+        """
+        local = Path(local)
+        if local.is_file():
+            stat = local.stat()
+            return [(local, local.name, stat.st_size, stat.st_mtime_ns)]
+        files = []
+        stack = [local]
+        while stack:
+            for entry in os.scandir(stack.pop()):
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat()
+                    files.append((Path(entry.path), Path(entry.path).relative_to(local).as_posix(), stat.st_size,
+                                  stat.st_mtime_ns))
+        return files
+
+    def _groups(self, files, size_index):
+        """
+        split files into jobs groups of about the same bytes
+        """
+        groups = [[] for _ in range(self.jobs)]
+        loads = [0] * self.jobs
+        for item in sorted(files, key=lambda f: f[size_index], reverse=True):
+            i = loads.index(min(loads))
+            groups[i].append(item)
+            loads[i] += item[size_index]
+        return [group for group in groups if group]
+
+    def _chunks(self, size):
+        count = min(self.jobs, max(1, -(-size // self.chunk_size)))
+        chunk = -(-size // count // MiB) * MiB
+        return [(offset, min(chunk, size - offset)) for offset in range(0, size, chunk)]
+
+    def _run_parallel(self, tasks):
+        self.commands = running_commands()
+        with ThreadPoolExecutor(self.jobs) as executor:
+            futures = [executor.submit(*task) for task in tasks]
+            return [future.result() for future in futures]
+
+    def _report(self, direction, files, total, skipped, t0, verified, failed):
+        seconds = time.monotonic() - t0
+        stats = TransferStats(direction, files, total, skipped, round(seconds, 3),
+                              round(total / MiB / seconds, 2) if seconds else 0.0,
+                              round(files / seconds, 1) if seconds else 0.0, verified, failed)
+        if failed:
+            log.logger.error(f"{direction} verify fail: {failed[:20]}")
+        if self.verbosity >= 1:
+            log.logger.info(f"{direction} {files} files {total / MiB:.1f} MiB in {seconds:.2f}s, "
+                            f"{stats.mb_per_s} MB/s, {stats.files_per_s} files/s, {skipped} unchanged skipped")
+        return stats
+
+    # ---------------- push ----------------
+
+    def _push_tar(self, remote_root, group):
+        """
+        Returns: {name: sha256}
+        """
+        proc = self._popen(f"mkdir -p {_q(remote_root)} && tar -xf - -C {_q(remote_root)}", stdin=True)
+        hashes = {}
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode="w|") as tar:
+                for path, name, size, mtime_ns in group:
+                    info = tar.gettarinfo(str(path), arcname=name)
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ""
+                    with open(path, "rb") as f:
+                        reader = _HashReader(f)
+                        tar.addfile(info, reader)
+                    hashes[name] = reader.sha.hexdigest()
+        finally:
+            self._finish(proc, f"push tar of {len(group)} files")
+        return hashes
+
+    def _push_chunk(self, path, remote_path, offset, length):
+        proc = self._popen(f"dd of={_q(remote_path)} bs={MiB} seek={offset // MiB} conv=notrunc 2>/dev/null",
+                           stdin=True)
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                remaining = length
+                while remaining:
+                    data = f.read(min(MiB, remaining))
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+                    remaining -= len(data)
+        finally:
+            self._finish(proc, f"push {path} chunk at {offset}")
+
+    def _push_files(self, remote_root, files):
+        """
+        Returns: {name: local sha256}
+        """
+        small = [f for f in files if f[2] < self.large_file]
+        large = [f for f in files if f[2] >= self.large_file]
+        if large:
+            dirs = {posixpath.dirname(posixpath.join(remote_root, name)) for _, name, _, _ in large}
+            self._script(f"mkdir -p {' '.join(_q(d) for d in dirs)} && "
+                         f"rm -f {' '.join(_q(posixpath.join(remote_root, name)) for _, name, _, _ in large)}")
+        tasks = [(self._push_tar, remote_root, group) for group in self._groups(small, 2)]
+        tasks += [(self._push_chunk, path, posixpath.join(remote_root, name), offset, length)
+                  for path, name, size, _ in large for offset, length in self._chunks(size)]
+        hashes = {}
+        for result in self._run_parallel(tasks):
+            if result:
+                hashes.update(result)
+        for path, name, _, _ in large:
+            hashes[name] = sha256_file(path)
+        return hashes
+
+    def _verify(self, remote_root, hashes):
+        """
+        Returns: names whose remote sha256 is not the local one
+        """
+        remote_hashes = self._remote_sha256(remote_root, list(hashes))
+        return [name for name, digest in hashes.items() if remote_hashes.get(name) != digest]
+
+    def push(self, local, remote, verify=True):
+        """
+        push a file or the files under a dir
+        Args:
+            local: file or dir
+            remote: target file path for a file, target dir for a dir
+            verify: compare sha256 of the pushed files on both sides
+
+        Returns: TransferStats
+
+        """
+        t0 = time.monotonic()
+        files = self._local_files(local)
+        if Path(local).is_file():
+            remote_root, remote_name = posixpath.split(remote.rstrip("/"))
+            files = [(path, remote_name, size, mtime_ns) for path, _, size, mtime_ns in files]
+            remote_files = self._remote_files(remote_root, [remote_name])
+        else:
+            remote_root = remote.rstrip("/") or "/"
+            remote_files = self._remote_files(remote_root)
+        manifest_path = self._manifest_path(self.transport, remote_root)
+        try:
+            manifest = json.loads(self._script(f"cat {_q(manifest_path)} 2>/dev/null; true") or "{}")
+        except ValueError:
+            manifest = {}
+
+        todo = []
+        for path, name, size, mtime_ns in files:
+            known = manifest.get(name)
+            if remote_files.get(name, (None,))[0] == size and known and known[0] == size:
+                if known[1] == mtime_ns:
+                    continue
+                # touched but maybe not changed
+                digest = sha256_file(path)
+                if digest == known[2]:
+                    manifest[name] = [size, mtime_ns, digest]
+                    continue
+            todo.append((path, name, size, mtime_ns))
+        hashes = self._push_files(remote_root, todo)
+        failed = []
+        if verify and todo:
+            failed = self._verify(remote_root, hashes)
+            if failed:
+                log.logger.warning(f"push verify fail, retry {len(failed)} files")
+                hashes.update(self._push_files(remote_root, [f for f in todo if f[1] in failed]))
+                failed = self._verify(remote_root, {name: hashes[name] for name in failed})
+        for path, name, size, mtime_ns in todo:
+            if name not in failed:
+                manifest[name] = [size, mtime_ns, hashes[name]]
+        self.transport.run_script(f"cat > {_q(manifest_path)}", json.dumps(manifest).encode())
+        return self._report("push", len(todo), sum(f[2] for f in todo), len(files) - len(todo), t0,
+                            not failed if verify and todo else None, failed)
+
+    # ---------------- pull ----------------
+
+    @staticmethod
+    def _safe_path(local_root, name):
+        path = (local_root / name).resolve()
+        if local_root.resolve() not in path.parents:
+            raise RuntimeError(f"unsafe path {name} in tar stream")
+        return path
+
+    def _pull_tar(self, remote_root, local_root, names, group):
+        list_file = f"{self.transport.tmp_dir}/.swift_list_{os.getpid()}_{threading.get_ident()}"
+        self.transport.run_script(f"cat > {_q(list_file)}",
+                                  "".join(f"./{name}\n" for name, _, _ in group).encode())
+        proc = self._popen(f"cd {_q(remote_root)} && tar -cf - -T {_q(list_file)}; rm -f {_q(list_file)}")
+        hashes = {}
+        try:
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+                for member in tar:
+                    if not member.isfile():
+                        continue
+                    name = posixpath.normpath(member.name)
+                    path = self._safe_path(local_root, names.get(name, name))
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    sha = hashlib.sha256()
+                    src = tar.extractfile(member)
+                    with open(path, "wb") as f:
+                        while True:
+                            data = src.read(MiB)
+                            if not data:
+                                break
+                            sha.update(data)
+                            f.write(data)
+                    os.utime(path, (member.mtime, member.mtime))
+                    hashes[name] = sha.hexdigest()
+        finally:
+            self._finish(proc, f"pull tar of {len(group)} files")
+        return hashes
+
+    def _pull_chunk(self, remote_path, path, offset, length):
+        proc = self._popen(f"dd if={_q(remote_path)} bs={MiB} skip={offset // MiB} count={-(-length // MiB)} "
+                           f"2>/dev/null")
+        try:
+            with open(path, "r+b") as f:
+                f.seek(offset)
+                while True:
+                    data = proc.stdout.read(MiB)
+                    if not data:
+                        break
+                    f.write(data)
+        finally:
+            self._finish(proc, f"pull {remote_path} chunk at {offset}")
+
+    def _pull_files(self, remote_root, local_root, names, files):
+        """
+        Returns: {remote name: local sha256}
+        """
+        small = [f for f in files if f[1] < self.large_file]
+        large = [f for f in files if f[1] >= self.large_file]
+        for name, size, _ in large:
+            path = self._safe_path(local_root, names[name])
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "wb") as f:
+                f.truncate(size)
+        tasks = [(self._pull_tar, remote_root, local_root, names, group) for group in self._groups(small, 1)]
+        tasks += [(self._pull_chunk, posixpath.join(remote_root, name), local_root / names[name], offset, length)
+                  for name, size, _ in large for offset, length in self._chunks(size)]
+        hashes = {}
+        for result in self._run_parallel(tasks):
+            if result:
+                hashes.update(result)
+        for name, _, mtime in large:
+            path = local_root / names[name]
+            os.utime(path, (mtime, mtime))
+            hashes[name] = sha256_file(path)
+        return hashes
+
+    def pull(self, remote, local, verify=True):
+        """
+        pull a file or the files under a dir
+        Args:
+            remote: file or dir on the target
+            local: local file path for a file, local dir for a dir
+            verify: compare sha256 of the pulled files on both sides
+
+        Returns: TransferStats
+
+        """
+        t0 = time.monotonic()
+        remote = remote.rstrip("/") or "/"
+        remote_files = self._remote_files(remote)
+        if remote_files:
+            remote_root, local_root = remote, Path(local)
+            names = {name: name for name in remote_files}
+        else:
+            # a single file
+            remote_root, remote_name = posixpath.split(remote)
+            remote_files = self._remote_files(remote_root, [remote_name])
+            if not remote_files:
+                raise FileNotFoundError(f"{remote} not found on the {self.transport.name} target")
+            local_root, local_name = Path(local).parent, Path(local).name
+            names = {remote_name: local_name}
+
+        todo = []
+        for name, (size, mtime) in remote_files.items():
+            path = local_root / names[name]
+            stat = path.stat() if path.is_file() else None
+            if stat is not None and stat.st_size == size and int(stat.st_mtime) == mtime:
+                continue
+            todo.append((name, size, mtime))
+        local_root.mkdir(parents=True, exist_ok=True)
+        hashes = self._pull_files(remote_root, local_root, names, todo)
+        failed = []
+        if verify and todo:
+            failed = self._verify(remote_root, hashes)
+            if failed:
+                log.logger.warning(f"pull verify fail, retry {len(failed)} files")
+                hashes.update(self._pull_files(remote_root, local_root, names, [f for f in todo if f[0] in failed]))
+                failed = self._verify(remote_root, {name: hashes[name] for name in failed})
+        return self._report("pull", len(todo), sum(f[1] for f in todo), len(remote_files) - len(todo), t0,
+                            not failed if verify and todo else None, failed)
+
+
+if __name__ == '__main__':
+    import shutil
+    import sys
+    import tempfile
+
+    from lib.transport import AdbTransport, LocalTransport
+
+    # no device needed: 2000 small files and a 64MiB file pushed to and pulled back from a local dir
+    root = Path(tempfile.mkdtemp(prefix="transfer_"))
+    src = root / "src"
+    for i in range(2000):
+        path = src / f"d{i % 20}" / f"f{i}.txt"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(os.urandom(512 + i))
+    (src / "big.bin").write_bytes(os.urandom(64 * MiB))
+    transport = AdbTransport() if "--adb" in sys.argv else LocalTransport()
+    transfer = FileTransfer(transport, jobs=4)
+    try:
+        print(transfer.push(src, str(root / "remote")))
+        # nothing changed, everything skipped
+        print(transfer.push(src, str(root / "remote")))
+        print(transfer.pull(str(root / "remote"), root / "back"))
+        print(transfer.pull(str(root / "remote" / "big.bin"), root / "big_copy.bin"))
+        t0 = time.monotonic()
+        transport.shell(f"cp -r {src} {root / 'cp'}", verbosity=0)
+        print(f"cp -r: {time.monotonic() - t0:.2f}s")
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
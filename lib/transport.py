@@ -0,0 +1,139 @@
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+from lib.basic_test_tools import BasicTestTools
+from lib.settings import Setting
+
+
+class Transport:
+    """
+    where feature modules run their commands: a device by adb, or the local host for testing without device.
+    shell returns (state, output) like BasicTestTools.adb_shell, commands should not contain double quotes or $
+    because adb_shell passes them to the host shell in double quotes
+    """
+    name = "transport"
+    # dir for temporary files on the target
+    tmp_dir = "/data/local/tmp"
+
+    def shell(self, cmd, timeout=None, verbosity=1):
+        raise NotImplementedError
+
+    def shell_stream(self, cmd, verbosity=1, **kwargs):
+        """
+        run a long command and iterate its output, see CommandStream
+        """
+        raise NotImplementedError
+
+    def popen(self, script, stdin=False):
+        """
+        run a shell script on the target with binary pipes and no host shell in between, for streaming data
+        Args:
+            script: target shell script, quoted for the target shell only
+            stdin: write stdin (adb exec-in) instead of reading stdout (adb exec-out)
+
+        Returns: Popen in its own process group, stdout is a pipe, stdin is a pipe if stdin
+
+        """
+        raise NotImplementedError
+
+    def run_script(self, script, data=None, timeout=None):
+        """
+        run a shell script by popen
+        Args:
+            script:
+            data: bytes written to the stdin of the script
+            timeout: seconds, the script is killed after it
+
+        Returns: exit code, stdout bytes
+
+        """
+        proc = self.popen(script, stdin=data is not None)
+        try:
+            out, _ = proc.communicate(data, timeout)
+        except BaseException:
+            BasicTestTools.kill_process_tree(proc.pid)
+            proc.communicate()
+            raise
+        return proc.returncode, out
+
+    def push(self, local, remote, verbosity=1):
+        raise NotImplementedError
+
+    def pull(self, remote, local, verbosity=1):
+        raise NotImplementedError
+
+
+class AdbTransport(Transport):
+    """
+    commands run by adb shell on the device of sn
+    """
+    name = "adb"
+
+    def __init__(self, sn="", tools=None):
+        self.sn = sn
+        self.tools = tools or BasicTestTools(sn=sn)
+
+    def shell(self, cmd, timeout=None, verbosity=1):
+        return self.tools.adb_shell(cmd, verbosity=verbosity, timeout=timeout)
+
+    def shell_stream(self, cmd, verbosity=1, **kwargs):
+        return self.tools.adb_shell_stream(cmd, verbosity=verbosity, **kwargs)
+
+    def popen(self, script, stdin=False):
+        adb = shlex.split(self.tools.add_sn_to_exec(Setting.ADB), posix=os.name != "nt")
+        return subprocess.Popen(adb + ["exec-in" if stdin else "exec-out", script],
+                                stdin=subprocess.PIPE if stdin else subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                **BasicTestTools._new_group_kwargs())
+
+    def push(self, local, remote, verbosity=1):
+        return self.tools.adb_exec(f'push "{local}" "{remote}"', verbosity=verbosity)
+
+    def pull(self, remote, local, verbosity=1):
+        return self.tools.adb_exec(f'pull "{remote}" "{local}"', verbosity=verbosity)
+
+
+class LocalTransport(Transport):
+    """
+    commands run by the local shell, eg: against a tmpfs directory to test a feature module without device
+    """
+    name = "local"
+    tmp_dir = tempfile.gettempdir()
+
+    def __init__(self, tools=None):
+        self.tools = tools or BasicTestTools()
+
+    def shell(self, cmd, timeout=None, verbosity=1):
+        return self.tools._process_cmd(cmd, verbosity, timeout=timeout)
+
+    def shell_stream(self, cmd, verbosity=1, **kwargs):
+        if verbosity >= 1:
+            self.tools.logger.info(cmd)
+        return self.tools.cmder_stream(cmd, **kwargs)
+
+    def popen(self, script, stdin=False):
+        return subprocess.Popen(BasicTestTools._shell_argv(script),
+                                stdin=subprocess.PIPE if stdin else subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                **BasicTestTools._new_group_kwargs())
+
+    def push(self, local, remote, verbosity=1):
+        return self._copy(local, remote, verbosity)
+
+    def pull(self, remote, local, verbosity=1):
+        return self._copy(remote, local, verbosity)
+
+    def _copy(self, src, dst, verbosity):
+        if verbosity >= 1:
+            self.tools.logger.info(f"copy {src} {dst}")
+        try:
+            if Path(src).is_dir():
+                shutil.copytree(src, dst, dirs_exist_ok=True)
+            else:
+                shutil.copy2(src, dst)
+        except OSError as e:
+            self.tools.logger.error(f"copy {src} {dst} fail: {e}")
+            return False, str(e)
+        return True, ""
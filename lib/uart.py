@@ -1,22 +1,49 @@
+import os
+import queue
+import select
 import time
 import traceback
+from collections import deque
 from functools import wraps
-from queue import Queue
 from threading import Thread
 
-import serial
-from serial.tools import list_ports
-
+from lib.capture_writer import CaptureWriter
 from lib.log_tools import log
+from lib.ring_buffer import RingBuffer
+from lib.stream_matcher import StreamMatcher
+from lib.watchdog import check_deadline
 
 
 class Serial:
+    # size of the capture ring buffer, large enough for seconds of data at 3Mbaud
+    ring_capacity = 8 * 1024 * 1024
+    # bytes the file writer waits for in the ring buffer before it is woken
+    ring_batch = 256 * 1024
+    # capture file options, see CaptureWriter
+    log_max_bytes = 512 * 1024 * 1024
+    log_max_seconds = None
+    log_fsync = "rotate"
+    log_compress = None
+    # host time of the received chunks in a sidecar next to the capture, see CaptureWriter.stamp
+    log_timestamps = False
+
     def __init__(self, use_uart):
         self.use_uart = use_uart
-        self.ser = serial.Serial() if self.use_uart else ""
+        if self.use_uart:
+            # pyserial is only imported when a uart is really used
+            import serial
+
+            self.ser = serial.Serial()
+        else:
+            self.ser = ""
         self.uart_thread = None
         self.running = True
-        self.buffer_queue = Queue()
+        self.ring = None
+        # (ring position, monotonic ns, wall ns) of the chunks read into the ring
+        self.ring_stamps = deque()
+        # callables receiving every chunk read by the capture loops, see on_match
+        self.listeners = []
+        self.capturing = False
 
     @staticmethod
     def get_uart_device(port_desc):
@@ -28,6 +55,8 @@ class Serial:
         Returns:
 
         """
+        from serial.tools import list_ports
+
         for port_into in list_ports.comports():
             if port_desc in port_into.description:
                 return port_into.device
@@ -45,17 +74,38 @@ class Serial:
         """
         when log file oversize, write to a new file, old log file will be renamed
         Args:
-            fd:
-            size:
+            fd: CaptureWriter of the log file
+            size: data size of the log file
+
+        Returns: True if rotated
+
+        """
+        if fd.oversize(size):
+            fd.rotate()
+            return True
+        return False
+
+    def open_capture_writer(self, file_path):
+        """
+        batched, rotating capture writer of file_path
+        Args:
+            file_path:
 
         Returns:
 
         """
-        pass
+        return CaptureWriter(file_path, max_bytes=self.log_max_bytes, max_seconds=self.log_max_seconds,
+                             fsync=self.log_fsync, compress=self.log_compress,
+                             oversize_helper=self.log_oversize_helper, timestamps=self.log_timestamps)
 
     @use_uart_wrapper
     def open_serial(self, port, baudrate="38400", timeout=2):
-        self.ser.port = self.get_uart_device(port) if isinstance(port, str) else port
+        if isinstance(port, str) and "://" in port:
+            # url such as loop:// or socket://host:port
+            import serial
+
+            self.ser = serial.serial_for_url(port, do_not_open=True)
+        self.ser.port = (self.get_uart_device(port) or port) if isinstance(port, str) else port
         self.ser.baudrate = int(baudrate)
         self.ser.timeout = timeout
         self.ser.open()
@@ -118,12 +168,12 @@ class Serial:
         """
         if duration <= 0:
             return self.read_by_size(1024)
-        buffer = b""
+        buffer = bytearray()
         duration = max(1, duration)
         t0 = time.time()
         while time.time() - t0 < duration:
-            buffer += self.ser.read(4)
-        return buffer
+            buffer += self.ser.read(self.ser.in_waiting or 1)
+        return bytes(buffer)
 
     def save_data_by_time(self, timeout=30, file_path="data.txt"):
         """
@@ -136,9 +186,18 @@ class Serial:
 
         """
         t0 = time.time()
-        with open(file_path, "ab+", encoding="utf-8", errors="replace") as f:
-            while time.time() - t0 < timeout:
-                f.write(self.ser.read(1024))
+        self.capturing = True
+        try:
+            with self.open_capture_writer(file_path) as f:
+                while time.time() - t0 < timeout:
+                    data = self.ser.read(self.ser.in_waiting or 1)
+                    if data:
+                        f.stamp()
+                    f.write(data)
+                    if self.listeners and data:
+                        self._notify(data)
+        finally:
+            self.capturing = False
 
     def save_data_until_false(self, file_path="data.txt"):
         """
@@ -149,35 +208,174 @@ class Serial:
         Returns:
 
         """
-        with open(file_path, "ab+", encoding="utf-8", errors="replace") as f:
-            while self.running:
-                f.write(self.ser.read(1024))
+        self.capturing = True
+        try:
+            with self.open_capture_writer(file_path) as f:
+                while self.running:
+                    data = self.ser.read(self.ser.in_waiting or 1)
+                    if data:
+                        f.stamp()
+                    f.write(data)
+                    if self.listeners and data:
+                        self._notify(data)
+        finally:
+            self.capturing = False
 
     def recieve_data_to_buffer(self):
         """
-        receive data from serial
+        receive data from serial into the ring buffer in place, posix ports read the fd directly,
+        the others read size follows in_waiting
         Returns:
 
         """
-        buffer = self.buffer_queue
-        read = self.ser.read
-        while self.running:
-            buffer.put(read(1024))
+        ring = self.ring
+        ser = self.ser
+        stamps = self.ring_stamps if self.log_timestamps else None
+        self.capturing = True
+        try:
+            readinto = self._fd_readinto()
+            while self.running:
+                start = ring.head
+                if readinto is None:
+                    ring.fill_from(ser.readinto, ser.in_waiting or 1)
+                else:
+                    ring.fill_from(readinto)
+                if stamps is not None and ring.head > start:
+                    stamps.append((start, time.monotonic_ns(), time.time_ns()))
+                if self.listeners and ring.head > start:
+                    self._notify(b"".join(ring.views(start, ring.head)))
+        finally:
+            # the writer drains the ring and stops once it is closed, also when the port fails
+            self.capturing = False
+            ring.close()
+        if ring.dropped:
+            log.logger.warning(f"uart ring buffer overflow {ring.overflows} times, {ring.dropped} bytes dropped")
+
+    def _fd_readinto(self):
+        """
+        readinto reading the port fd straight into the ring buffer, without the in_waiting ioctl and the copy
+        of pyserial readinto. posix ports only, None for the others, eg: windows com ports and url ports
+        """
+        fd = getattr(self.ser, "fd", None)
+        if os.name == "nt" or not isinstance(fd, int):
+            return None
+        timeout = self.ser.timeout
+
+        def readinto(view):
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                return 0
+            try:
+                n = os.readv(fd, [view])
+            except BlockingIOError:
+                return 0
+            if not n:
+                # readable without data, as pyserial read
+                raise OSError(f"serial {self.ser.port} disconnected")
+            return n
+
+        return readinto
 
     def write_data_from_buffer(self, filename="data.txt"):
         """
-        write data from buffer queue to file
+        write data from ring buffer to file
         Args:
             filename:
 
         Returns:
 
         """
-        with open(filename, "ab+", encoding="utf-8", errors="replace") as f:
-            while self.running or not self.buffer_queue.empty():
-                f.write(self.buffer_queue.get())
+        ring = self.ring
+        with self.open_capture_writer(filename) as f:
+            # the reader closes the ring when it stops, nothing is left behind after that
+            while not ring.closed or len(ring):
+                # wake up for a batch of data, or what has come within 50ms
+                if not ring.wait(0.05, self.ring_batch):
+                    continue
+                for view in ring.peek():
+                    # ring positions are capture offsets, the ring and the writer both start at 0
+                    end = ring.tail + len(view)
+                    while self.ring_stamps and self.ring_stamps[0][0] < end:
+                        f.stamp(*self.ring_stamps.popleft())
+                    f.write(view)
+                    ring.advance(len(view))
+
+    def _notify(self, data):
+        for listener in tuple(self.listeners):
+            try:
+                listener(data)
+            except Exception:
+                log.logger.error(traceback.format_exc())
+
+    @use_uart_wrapper
+    def on_match(self, patterns, callback):
+        """
+        call callback(StreamMatch) from the capture thread whenever one of patterns appears,
+        eg: abort a stress loop when a panic signature appears. callback should return quickly
+        Args:
+            patterns: literal str/bytes or compiled regex, see StreamMatcher
+            callback:
+
+        Returns: listener, pass it to remove_listener to stop matching
+
+        """
+        matcher = StreamMatcher(patterns)
+
+        def listener(data):
+            for match in matcher.feed(data):
+                callback(match)
+
+        self.listeners.append(listener)
+        return listener
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    @use_uart_wrapper
+    def expect(self, patterns, timeout=30):
+        """
+        wait until one of patterns appears in the uart data, eg: boot banner, shell prompt.
+        uses the data of the running capture thread, or reads the port itself when no capture is running
+        Args:
+            patterns: literal str/bytes or compiled regex, see StreamMatcher
+            timeout: seconds
+
+        Returns: the first StreamMatch, None if timeout
+
+        Raises: CaseTimeout if the case deadline of this thread expires while waiting
+
+        """
+        deadline = time.monotonic() + timeout
+        if self.capturing:
+            found = queue.Queue()
+            listener = self.on_match(patterns, found.put)
+            try:
+                while True:
+                    check_deadline()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    try:
+                        # short waits so that an expired case deadline is seen
+                        return found.get(timeout=min(remaining, 0.5))
+                    except queue.Empty:
+                        pass
+            finally:
+                self.remove_listener(listener)
+        matcher = StreamMatcher(patterns)
+        while time.monotonic() < deadline:
+            check_deadline()
+            data = self.ser.read(self.ser.in_waiting or 1)
+            if data:
+                matches = matcher.feed(data)
+                if matches:
+                    return matches[0]
+        return None
 
     def receive_data_thread(self):
+        # set before the thread runs, so expect() right after the start uses the capture, not the port
+        self.capturing = True
         Thread(target=self.recieve_data_to_buffer).start()
         log.logger.info("receive data to buffer thread start")
 
@@ -186,13 +384,27 @@ class Serial:
         log.logger.info("write data to file thread start")
 
     def save_data_buffered(self, filename):
+        """
+        a reader thread fills the ring buffer, this thread writes it to filename until the reader stops,
+        so joining the caller thread waits for both and the port can be closed safely.
+        opt-in with func_opt=1/save_opt=1: on a pty it is about as fast as save_data_until_false, its use is
+        that a slow disk or a rotation does not stall the port reads (the ring holds seconds of data)
+        Args:
+            filename:
+
+        Returns:
+
+        """
+        self.ring = RingBuffer(self.ring_capacity)
+        self.ring_stamps.clear()
         self.receive_data_thread()
-        self.write_data_thread(filename)
+        self.write_data_from_buffer(filename)
 
     def save_uart_data(self, func, args=(), filename="data.txt", save_opt=0):
         if self.use_uart:
             save_func = (self.save_data_until_false, self.save_data_buffered)[save_opt]
             self.running = True
+            self.capturing = True
             t = Thread(target=save_func, args=(filename,))
             t.start()
         try:
@@ -208,6 +420,7 @@ class Serial:
     def start_uart_thread(self, filename, func_opt=0):
         func = (self.save_data_until_false, self.save_data_buffered)[func_opt]
         self.running = True
+        self.capturing = True
         self.uart_thread = Thread(target=func, args=(filename,))
         self.uart_thread.start()
         log.logger.info("uart thread start")
@@ -0,0 +1,293 @@
+import os
+import selectors
+import threading
+import time
+import traceback
+
+from lib.capture_writer import CaptureWriter
+from lib.log_tools import log
+from lib.stream_matcher import StreamMatcher
+
+
+class MuxPort:
+    """
+    one port of UartMux: its capture writer, data waiting for the writer and counters
+    """
+
+    def __init__(self, name, ser, fd, writer):
+        self.name = name
+        self.ser = ser
+        self.fd = fd
+        self.writer = writer
+        # data read but not taken by the writer yet, the writer queue is full
+        self.pending = bytearray()
+        self.listeners = []
+        self.bytes = 0
+        self.reads = 0
+        # times data was dropped because pending reached buffer_limit, and the dropped bytes
+        self.overruns = 0
+        self.dropped = 0
+        self.errors = 0
+        self.closed = False
+
+    def stats(self):
+        return {"bytes": self.bytes, "reads": self.reads, "overruns": self.overruns, "dropped": self.dropped,
+                "errors": self.errors, "pending": len(self.pending), "closed": self.closed}
+
+
+class UartMux:
+    """
+    capture many serial ports by one thread: the port fds are non-blocking and registered with a selector,
+    every wakeup reads the ready ports in rotating order, at most max_read_per_turn bytes each, so a busy port
+    can not starve the others. every port has its own CaptureWriter (batched, rotating file like Serial)
+    and a bounded pending buffer, data beyond buffer_limit is dropped and counted instead of blocking the loop.
+    posix only: windows com ports can not be selected, use Serial.start_uart_thread there
+    """
+
+    def __init__(self, read_size=64 * 1024, max_read_per_turn=256 * 1024, buffer_limit=8 * 1024 * 1024,
+                 writer_options=None):
+        """
+        Args:
+            read_size: bytes of one read
+            max_read_per_turn: bytes read from one port before the next ready port is served
+            buffer_limit: max bytes of a port waiting for its writer
+            writer_options: CaptureWriter kwargs of every port, eg: {"max_bytes": 512 * 1024 * 1024}
+        """
+        if os.name == "nt":
+            raise NotImplementedError("UartMux needs selectable port fds, use Serial.start_uart_thread on windows")
+        self.read_size = read_size
+        self.max_read_per_turn = max_read_per_turn
+        self.buffer_limit = buffer_limit
+        self.writer_options = writer_options or {}
+        self.selector = selectors.DefaultSelector()
+        self.ports = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.wakeups = 0
+        self.cpu = 0.0
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+
+    def add(self, ser, filename, name=None, **writer_options):
+        """
+        capture an open port into filename
+        Args:
+            ser: open lib.uart.Serial, pyserial Serial or anything with fileno()
+            filename: capture file
+            name: port name in stats, default the port
+            **writer_options: CaptureWriter kwargs of this port
+
+        Returns: name
+
+        """
+        ser = getattr(ser, "ser", ser)
+        fd = ser.fileno()
+        name = name or getattr(ser, "port", None) or str(fd)
+        os.set_blocking(fd, False)
+        writer = CaptureWriter(filename, **{**self.writer_options, **writer_options})
+        port = MuxPort(name, ser, fd, writer)
+        with self.lock:
+            if name in self.ports:
+                raise ValueError(f"port {name} is already captured")
+            self.ports[name] = port
+            self.selector.register(fd, selectors.EVENT_READ, port)
+        self._wake()
+        log.logger.info(f"uart mux capture {name} to {filename}")
+        return name
+
+    def remove(self, name):
+        """
+        stop capturing a port, its captured data is written and the writer closed
+        """
+        with self.lock:
+            port = self.ports.pop(name)
+            if not port.closed:
+                self.selector.unregister(port.fd)
+        self._wake()
+        self._close_port(port)
+
+    def on_match(self, name, patterns, callback):
+        """
+        call callback(StreamMatch) from the capture thread when one of patterns appears on port name,
+        see Serial.on_match
+        """
+        matcher = StreamMatcher(patterns)
+
+        def listener(data):
+            for match in matcher.feed(data):
+                callback(match)
+
+        self.ports[name].listeners.append(listener)
+        return listener
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._loop, name="uart_mux", daemon=True)
+        self.thread.start()
+        log.logger.info(f"uart mux start, {len(self.ports)} ports")
+
+    def stop(self):
+        """
+        stop the loop, read what is left in the ports and close every writer
+        """
+        self.running = False
+        self._wake()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            ports = list(self.ports.values())
+        for port in ports:
+            if not port.closed:
+                self._read(port, None)
+            self._close_port(port)
+        log.logger.info(f"uart mux stop, {self.wakeups} wakeups, cpu {self.cpu:.2f}s")
+
+    def close(self):
+        self.stop()
+        self.selector.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _wake(self):
+        try:
+            os.write(self.wake_w, b"\0")
+        except BlockingIOError:
+            pass
+
+    def _close_port(self, port):
+        self._flush(port)
+        if port.pending:
+            # the loop is gone, wait for the writer instead of dropping
+            port.writer.write(bytes(port.pending))
+            port.pending.clear()
+        port.writer.close()
+
+    def _loop(self):
+        c0 = time.thread_time()
+        turn = 0
+        try:
+            while self.running:
+                events = self.selector.select(timeout=1.0)
+                self.wakeups += 1
+                ready = [key.data for key, _ in events if key.data is not None]
+                if len(ready) < len(events):
+                    try:
+                        while os.read(self.wake_r, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                if ready:
+                    # rotating start, the same port is not always served first
+                    turn = (turn + 1) % len(ready)
+                    for port in ready[turn:] + ready[:turn]:
+                        self._read(port, self.max_read_per_turn, ready=True)
+                with self.lock:
+                    ports = list(self.ports.values())
+                for port in ports:
+                    # the writer queue may have room again
+                    if port.pending:
+                        self._flush(port)
+        except Exception:
+            log.logger.error(traceback.format_exc())
+        finally:
+            self.cpu += time.thread_time() - c0
+
+    def _read(self, port, quota, ready=False):
+        """
+        read port until it has no data or quota bytes are read
+        Args:
+            port: MuxPort
+            quota: bytes, None for no limit
+            ready: the selector reported port readable
+
+        Returns:
+
+        """
+        got = 0
+        while quota is None or got < quota:
+            try:
+                data = os.read(port.fd, self.read_size)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                # EIO: the other side of the port is gone, eg: usb serial unplugged or pty master closed
+                self._lost(port, e)
+                break
+            if not data:
+                # pyserial sets VMIN=0, a drained tty reads b"" instead of EAGAIN. only readable without data
+                # means the device is gone, as in pyserial read
+                if ready and not got:
+                    self._lost(port, "readable but no data")
+                break
+            got += len(data)
+            port.reads += 1
+            port.bytes += len(data)
+            self._store(port, data)
+            for listener in port.listeners:
+                try:
+                    listener(data)
+                except Exception:
+                    log.logger.error(traceback.format_exc())
+
+    def _store(self, port, data):
+        writer = port.writer
+        if port.pending:
+            self._flush(port)
+        if not port.pending and not writer.batches.full():
+            writer.stamp()
+            writer.write(data)
+            return
+        if len(port.pending) + len(data) > self.buffer_limit:
+            port.overruns += 1
+            port.dropped += len(data)
+            return
+        port.pending += data
+
+    def _flush(self, port):
+        """
+        hand pending data to the writer while its queue has room, write() never blocks the loop
+        """
+        if port.pending and not port.writer.batches.full():
+            port.writer.stamp()
+            port.writer.write(bytes(port.pending))
+            port.pending.clear()
+
+    def _lost(self, port, reason):
+        port.errors += 1
+        if port.closed:
+            return
+        port.closed = True
+        with self.lock:
+            try:
+                self.selector.unregister(port.fd)
+            except (KeyError, ValueError):
+                pass
+        log.logger.warning(f"uart mux port {port.name} lost: {reason}")
+
+    def stats(self):
+        """
+        Returns: {port name: counters}, see MuxPort.stats
+
+        """
+        with self.lock:
+            return {name: port.stats() for name, port in self.ports.items()}
+
+
+if __name__ == '__main__':
+    import sys
+
+    from bench.suite import run_suite
+
+    # no uart needed: pty pairs fed by a child process, one mux thread against a thread per port
+    sys.exit(0 if run_suite(["uart_mux"]) else 1)
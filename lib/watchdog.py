@@ -0,0 +1,240 @@
+import heapq
+import itertools
+import os
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+from lib.log_tools import log
+
+
+class CaseTimeout(Exception):
+    """
+    raised in the case thread when a case or phase deadline expires, by check_deadline or when the block ends
+    """
+
+
+_local = threading.local()
+
+
+def running_commands():
+    """
+    kill callables of the running commands of this thread, see watch_command
+    Returns: list
+
+    """
+    commands = getattr(_local, "commands", None)
+    if commands is None:
+        commands = _local.commands = []
+    return commands
+
+
+def check_deadline():
+    """
+    raise CaseTimeout if a deadline of this thread has expired, called by commands and waits of the case,
+    eg: cmder, _process_cmd, Serial.expect
+    Returns:
+
+    """
+    for deadline in getattr(_local, "deadlines", ()):
+        if deadline.expired:
+            raise CaseTimeout(deadline.message)
+
+
+@contextmanager
+def watch_command(kill):
+    """
+    register a running command of this thread, it is killed when a deadline of the thread expires
+    Args:
+        kill: callable killing the command, eg: the process tree of the command
+
+    Returns:
+
+    """
+    commands = running_commands()
+    commands.append(kill)
+    try:
+        yield
+    finally:
+        commands.remove(kill)
+
+
+class Deadline:
+    """
+    time limit of a block of the current thread, see Watchdog.deadline
+    """
+
+    def __init__(self, watchdog, name, timeout):
+        self.watchdog = watchdog
+        self.name = name
+        self.timeout = timeout
+        self.thread_id = threading.get_ident()
+        self.commands = running_commands()
+        self.deadlines = getattr(_local, "deadlines", None)
+        if self.deadlines is None:
+            self.deadlines = _local.deadlines = []
+        self.expire_at = None
+        self.expired = False
+        self.closed = False
+        self.lock = threading.Lock()
+
+    @property
+    def message(self):
+        return f"{self.name} timeout after {self.timeout}s"
+
+    def expire(self):
+        """
+        called by the watchdog thread: kill the running commands of the thread, which then raises CaseTimeout
+        at its next check_deadline. called again hang_grace seconds later if the block is still running
+        Returns: seconds until the next call, None for no more calls
+
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            if self.expired:
+                self._hung()
+                return None
+            self.expired = True
+            log.logger.error(f"{self.message}, kill {len(self.commands)} running commands")
+            for kill in list(self.commands):
+                try:
+                    kill()
+                except Exception as e:
+                    log.logger.error(f"kill command fail: {e}")
+            return self.watchdog.hang_grace
+
+    def _hung(self):
+        """
+        the thread did not leave the block, eg: a python loop without commands, log where it is
+        and let the worker process exit by on_hang, a thread can not be killed
+        """
+        frame = sys._current_frames().get(self.thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+        log.logger.error(f"{self.message}, still running {self.watchdog.hang_grace}s later:\n{stack}")
+        if self.watchdog.on_hang is not None:
+            self.watchdog.on_hang(self)
+
+    def __enter__(self):
+        if self.timeout is not None:
+            self.expire_at = time.monotonic() + self.timeout
+            self.deadlines.append(self)
+            self.watchdog.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.timeout is None:
+            return False
+        with self.lock:
+            self.closed = True
+        self.deadlines.remove(self)
+        self.watchdog.cancel(self)
+        if not self.expired:
+            return False
+        if exc_type is CaseTimeout:
+            # raised by check_deadline, for this deadline or an outer one
+            return False
+        raise CaseTimeout(self.message) from None
+
+
+class Watchdog:
+    """
+    one background thread watching the deadlines of all case threads.
+    when a deadline expires the running commands of its thread are killed with their process trees,
+    and the thread raises CaseTimeout at its next check_deadline (every command and uart expect checks)
+    or when the block ends. no exception is injected into the thread, it could fire inside a lock or a handler.
+    a thread still in the block hang_grace seconds later is logged with its stack and on_hang is called,
+    device workers set it to exit the process, the parent records the job as failed.
+    """
+    # seconds after the expiry before a thread still in the block is hung, None for no check
+    hang_grace = 60
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        # heap of (expire_at, seq, deadline)
+        self.heap = []
+        self.seq = itertools.count()
+        self.thread = None
+        self.pid = None
+        # callable(deadline) called by the watchdog thread for a hung case, eg: exit the worker process
+        self.on_hang = None
+
+    def deadline(self, name, timeout):
+        """
+        time limit of the with block, no-op if timeout is None
+        Args:
+            name: eg: "BasicTestcase test_step"
+            timeout: seconds
+
+        Returns: Deadline, a context manager raising CaseTimeout when the time is up
+
+        """
+        return Deadline(self, name, timeout)
+
+    def add(self, deadline):
+        with self.cond:
+            # the thread does not survive fork
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.heap = []
+                self.thread = threading.Thread(target=self._loop, name="watchdog", daemon=True)
+                self.thread.start()
+            heapq.heappush(self.heap, (deadline.expire_at, next(self.seq), deadline))
+            if self.heap[0][2] is deadline:
+                self.cond.notify()
+
+    def cancel(self, deadline):
+        with self.cond:
+            # removed lazily by the watchdog thread, only wake it up if it waits for this one
+            if self.heap and self.heap[0][2] is deadline:
+                heapq.heappop(self.heap)
+                self.cond.notify()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                while not self.heap or self.heap[0][2].closed:
+                    if self.heap:
+                        heapq.heappop(self.heap)
+                    else:
+                        self.cond.wait()
+                expire_at, _, deadline = self.heap[0]
+                wait = expire_at - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                heapq.heappop(self.heap)
+            again = deadline.expire()
+            if again is not None:
+                with self.cond:
+                    deadline.expire_at = time.monotonic() + again
+                    heapq.heappush(self.heap, (deadline.expire_at, next(self.seq), deadline))
+
+
+watchdog = Watchdog()
+
+if __name__ == '__main__':
+    # the running commands are registered in lib.watchdog, not in this __main__ module
+    from lib.basic_test_tools import BasicTestTools
+    from lib.watchdog import CaseTimeout, watchdog
+
+    try:
+        with watchdog.deadline("demo", 1):
+            # killed by the watchdog after 1s
+            print(BasicTestTools.cmder("sleep 30"))
+    except CaseTimeout as e:
+        print(f"CaseTimeout: {e}")
+
+    # overhead of a deadline and a watched command around short commands
+    times = 200
+    for watched in (False, True):
+        t0 = time.perf_counter()
+        for _ in range(times):
+            if watched:
+                with watchdog.deadline("bench", 60):
+                    BasicTestTools.cmder("true")
+            else:
+                BasicTestTools.cmder("true")
+        print(f"watched={watched}: {(time.perf_counter() - t0) / times * 1000:.2f} ms per cmder")
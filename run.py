@@ -1,6 +1,8 @@
 from importlib import import_module
 
 from lib.api import run_it, init_api, init_setting
+from lib.case_index import CaseIndex
+from lib.settings import Setting
 
 
 class CaseRunner:
@@ -21,7 +23,23 @@ class CaseRunner:
         Returns:
 
         """
-        pass
+        return CaseIndex.path_to_module(case_path)
+
+    @staticmethod
+    def find_case_file(case_name):
+        """
+        find the file of a case by name from the case index, without importing the case files
+        Args:
+            case_name:
+
+        Returns: case file path
+
+        """
+        found = CaseIndex().update().find(case_name)
+        if len(found) != 1:
+            raise ValueError(f"{len(found)} cases named {case_name} in {Setting.CASE_PATH}: "
+                             f"{[case['file'] for case in found]}")
+        return found[0]["file"]
 
     @property
     def case_path(self):
@@ -33,11 +51,12 @@ class CaseRunner:
 
     @init_setting
     @init_api
-    def run_one(self, case_name, **kwargs):
+    def run_one(self, case_name, runner=None, **kwargs):
         """
         run one case
         Args:
             case_name:
+            runner: run_it by default, or lib.stress.run_stress
             **kwargs:
 
         Returns:
@@ -46,7 +65,7 @@ class CaseRunner:
         test_suite = import_module(self.case_path)
         assert hasattr(test_suite, case_name)
         case = getattr(test_suite, case_name)
-        run_it(case, **kwargs)
+        return (runner or run_it)(case, **kwargs)
 
 
 if __name__ == '__main__':
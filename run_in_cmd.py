@@ -1,17 +1,84 @@
 import argparse
+import sys
 
-from run import CaseRunner
 
-parser = argparse.ArgumentParser("run test case in cmd")
-parser.add_argument("-pn", dest="product_name", type=str, help="product name")
-parser.add_argument("-b", dest="branch", type=str, help="branch")
-parser.add_argument("-s", dest="sn", type=str, help="sn", default="")
-parser.add_argument("-f", dest="case_file", type=str, help="case file")
-parser.add_argument("-n", dest="case_name", type=str, help="case name")
-parser.add_argument("-t", dest="times", type=int, default=1, help="run times")
+def main(argv=None):
+    """
+    command line entry, also the only code run by __main__: device workers started by spawn (windows)
+    import this file again and must not run the command line
+    """
+    parser = argparse.ArgumentParser("run test case in cmd")
+    parser.add_argument("-pn", dest="product_name", type=str, help="product name")
+    parser.add_argument("-b", dest="branch", type=str, help="branch")
+    parser.add_argument("-s", dest="sn", type=str, nargs="+", default=[""],
+                        help="sn, several sn or 'all' run the case on the devices in parallel")
+    parser.add_argument("-f", dest="case_file", type=str, help="case file, found from the case index if not given")
+    parser.add_argument("-n", dest="case_name", type=str, help="case name")
+    parser.add_argument("-l", dest="list_cases", action="store_true", help="list cases, filtered by -n")
+    parser.add_argument("-t", dest="times", type=int, default=1, help="run times")
+    parser.add_argument("-j", dest="jobs", type=int, default=None, help="max parallel devices")
+    parser.add_argument("--stress", action="store_true", help="stress mode, one case log with iteration markers")
+    parser.add_argument("--max-fail", dest="max_failures", type=int, default=None, help="stress stops after N failures")
+    parser.add_argument("--job-list", dest="job_list", type=str, default=None,
+                        help="json list of jobs run on the device pool of -s (default all), see lib/scheduler.py")
+    parser.add_argument("--tag", dest="tags", type=str, nargs="+", default=[],
+                        help="capability tags of the pool devices, eg: SN1=wifi,sim SN2=wifi")
 
-args = parser.parse_args()
+    args = parser.parse_args(argv)
 
-CaseRunner(args.case_file).run_one(args.case_name, times=args.times, product_name=args.product_name,
-                                   branch=args.branch,
-                                   sn=args.sn)
+    if args.list_cases:
+        from lib.case_index import CaseIndex
+
+        for case in CaseIndex().update().cases():
+            if args.case_name is None or args.case_name.lower() in case["name"].lower():
+                params = ", ".join(p["name"] if p["default"] is None else f"{p['name']}={p['default']}"
+                                   for p in case["params"])
+                print(f"{case['file']}:{case['lineno']} {case['name']}({params}) {case['doc']}")
+        return 0
+
+    if args.job_list:
+        from lib.scheduler import DeviceScheduler, load_jobs
+
+        tags = {}
+        for tag in args.tags:
+            sn, sep, tag_list = tag.partition("=")
+            if not sep or not sn:
+                parser.error(f"--tag {tag}: expected SN=tag1,tag2")
+            tags[sn] = tag_list.split(",")
+        scheduler = DeviceScheduler("all" if args.sn in ([""], ["all"]) else args.sn, tags=tags)
+        for job in load_jobs(args.job_list):
+            for k, v in (("product_name", args.product_name), ("branch", args.branch)):
+                if v is not None:
+                    job.kwargs.setdefault(k, v)
+            scheduler.add_job(job)
+        return 0 if all(scheduler.run().values()) else 1
+
+    from run import CaseRunner
+
+    if args.case_file is None:
+        args.case_file = CaseRunner.find_case_file(args.case_name)
+
+    run_kwargs = {}
+    if args.stress:
+        from lib.stress import run_stress
+
+        run_kwargs = {"runner": run_stress, "max_failures": args.max_failures}
+
+    # exit code 1 if any run of the case did not pass, on any device
+    if len(args.sn) == 1 and args.sn[0] != "all":
+        from lib.parallel import case_passed
+
+        result = CaseRunner(args.case_file).run_one(args.case_name, times=args.times, product_name=args.product_name,
+                                                    branch=args.branch,
+                                                    sn=args.sn[0], **run_kwargs)
+        return 0 if case_passed(result) else 1
+    else:
+        from lib.parallel import run_on_devices
+
+        results = run_on_devices(args.case_file, args.case_name, args.sn, times=args.times, jobs=args.jobs,
+                                 product_name=args.product_name, branch=args.branch, **run_kwargs)
+        return 0 if results and all(results.values()) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
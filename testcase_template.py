@@ -1,23 +1,44 @@
 import time
 import traceback
 from abc import ABCMeta
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
 
 from lib.log_tools import log, save_test_result, add_handler_to_case, rename_log_dir
 from lib.settings import Setting
+from lib.trace import span, tracing
+from lib.watchdog import CaseTimeout, watchdog
 
 
 class BasicTestcase(metaclass=ABCMeta):
     """
     the very basic testcase template
     """
+    # seconds, None for no limit. timeout covers set_up + test_step and defaults to Setting.case_timeout,
+    # tear_down always runs and is only limited by tear_down_timeout.
+    # on expiry the running commands are killed and the case result is timeout
+    timeout = None
+    set_up_timeout = None
+    test_step_timeout = None
+    tear_down_timeout = None
+    # write trace.json of the phases, commands and spans to the log dir, default Setting.trace
+    trace = None
 
     def __init__(self, sn=""):
         self.__sign = "*" * 20
         self.case_name = self.__class__.__name__
-        self.log_dir = Setting.LOG_PATH.joinpath(f"{self.case_name}{time.strftime('%Y%m%d%H%M%S')}")
+        # microseconds keep the log dirs of iterations in the same second apart
+        self.log_dir = Setting.LOG_PATH.joinpath(f"{self.case_name}{datetime.now().strftime('%Y%m%d%H%M%S_%f')}")
         # may rename log dir according to result of test
         self.log_dir_appendix = ""
+        # log dir names saved with the results, see rename_log_dir
+        self.recorded_log_dirs = set()
         self.case_log = self.log_dir.joinpath("case.log")
+        # set by run_it
+        self.iteration = 1
+        self.params = {}
+        self.status = "none"
 
         from lib.api import api
         if api is None:
@@ -26,6 +47,13 @@ class BasicTestcase(metaclass=ABCMeta):
             self.sn = api.sn
             api.case_log_dir = self.log_dir
 
+    @property
+    def final_log_dir(self):
+        """
+        log dir after rename_log_dir, the one saved with the results
+        """
+        return Path(f"{self.log_dir}{self.log_dir_appendix}")
+
     def set_up(self):
         log.logger.info(f"{self.__sign}{self.case_name} start{self.__sign}")
 
@@ -36,20 +64,48 @@ class BasicTestcase(metaclass=ABCMeta):
         log.logger.info(f"{self.__sign}{self.case_name} end{self.__sign}")
 
     def run(self):
+        """
+        run the case once
+        Returns: status of the case, pass/fail/timeout/none
+
+        """
         self.log_dir.mkdir(parents=True, exist_ok=True)
         log.logger.info(f"{self.case_name} start run before setup")
-        test_result = f"{self.case_name} none"
-        try:
-            self.set_up()
-            self.test_step()
-            test_result = f"{self.case_name} pass"
-        except Exception:
-            log.logger.error(traceback.format_exc())
-            test_result = f"{self.case_name} fail"
-        finally:
-            self.tear_down()
-            save_test_result(test_result, self.sn)
+        status = "none"
+        t0 = time.time()
+        trace = Setting.trace if self.trace is None else self.trace
+        with tracing(self.case_name, self.log_dir.joinpath("trace.json")) if trace else nullcontext():
+            try:
+                with watchdog.deadline(self.case_name, Setting.case_timeout if self.timeout is None else self.timeout):
+                    with watchdog.deadline(f"{self.case_name} set_up", self.set_up_timeout), \
+                            span("set_up", "phase"):
+                        self.set_up()
+                    with watchdog.deadline(f"{self.case_name} test_step", self.test_step_timeout), \
+                            span("test_step", "phase"):
+                        self.test_step()
+                status = "pass"
+            except CaseTimeout as e:
+                log.logger.error(e)
+                status = "timeout"
+            except Exception:
+                log.logger.error(traceback.format_exc())
+                status = "fail"
+            finally:
+                try:
+                    with watchdog.deadline(f"{self.case_name} tear_down", self.tear_down_timeout), \
+                            span("tear_down", "phase"):
+                        self.tear_down()
+                except CaseTimeout as e:
+                    log.logger.error(e)
+                    status = "timeout"
+                # the dir is renamed after the case log is closed, the results link the renamed one
+                log_dir = self.final_log_dir
+                self.recorded_log_dirs.add(log_dir)
+                save_test_result(f"{self.case_name} {status}", self.sn, status=status, iteration=self.iteration,
+                                 params=self.params, duration=time.time() - t0, log_dir=log_dir)
         log.logger.info(f"{self.case_name} finish run after teardown")
+        self.status = status
+        return status
 
     def run_with_case_log(self):
         add_handler_to_case(self)